@@ -0,0 +1,352 @@
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
+from multiprocessing import cpu_count
+from typing import Dict, List
+
+from synthetic_corpora import write_openwebtext_archive, write_tokenizer, write_wikiextractor_folder, write_wikipedia_corpus
+
+
+FORMAT_LOGGING = '%(levelname)s: %(message)s'
+logging.basicConfig(format=FORMAT_LOGGING)
+logging.getLogger().setLevel(logging.INFO)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LANG_FILE = os.path.join(ROOT, "wikipedia", "lang_maps", "lang_dict_eng_ita.json")
+# read files in blocks of this size when counting lines
+BLOCK_SIZE = 16 * 1024 * 1024
+# seconds between samples of the memory of the processes of a script
+SAMPLING_INTERVAL = 0.05
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+# benchmarked commands, in the order in which they are run. each stage lists the stages whose outputs it reads and its
+# inputs, whose lines and bytes give the throughput. stages reading compressed archives are measured on their output instead
+def get_stages(corpora: str, work: str, processes: int) -> Dict[str, Dict]:
+    tokenizer = os.path.join(corpora, "tokenizer")
+    preprocessed = os.path.join(work, "wiki_preprocessed.txt")
+    # the two datasets stand for two languages of the multilingual dataset
+    words = os.path.join(work, "enwiki-words.tsv")
+    tokens = os.path.join(work, "itwiki-tokens.tsv")
+    paragraphs = os.path.join(work, "paragraphs.tsv")
+    p = str(processes)
+
+    stages = OrderedDict()
+    stages['extract_openwebtext'] = {
+        'command': ["openwebtext/extract_and_clean.py", "-i", os.path.join(corpora, "openwebtext.tar.xz"),
+                    "-o", os.path.join(work, "openwebtext.txt"), "-f", "-p", p],
+        'output': os.path.join(work, "openwebtext.txt"),
+    }
+    stages['extract_openwebtext_streaming'] = {
+        'command': stages['extract_openwebtext']['command'] + ["--streaming"],
+        'output': os.path.join(work, "openwebtext.txt"),
+    }
+    stages['preprocess'] = {
+        'command': ["preprocess.py", "-i", os.path.join(corpora, "wiki.txt"), "-o", preprocessed, "-f", "-p", p],
+        'inputs': [os.path.join(corpora, "wiki.txt")],
+    }
+    stages['dedup'] = {
+        'command': ["dedup.py", "-i", preprocessed, "-o", os.path.join(work, "wiki_dedup.txt"), "-f", "-p", p, "--near_dedup"],
+        'inputs': [preprocessed],
+        'requires': ['preprocess'],
+    }
+    stages['create_dataset_words'] = {
+        'command': ["create_dataset.py", "-i", preprocessed, "-o", words, "-f", "--processes", p, "--separate_documents"],
+        'inputs': [preprocessed],
+        'requires': ['preprocess'],
+    }
+    stages['create_dataset_tokenizer'] = {
+        'command': ["create_dataset.py", "-i", preprocessed, "-o", tokens, "-f", "--processes", p, "--separate_documents",
+                    "--fill_for_tokenizer", tokenizer, "--target_len", "128"],
+        'inputs': [preprocessed],
+        'requires': ['preprocess'],
+    }
+    # same stage tokenizing with a single fast tokenizer in the main process instead of a tokenizer per worker process
+    stages['create_dataset_tokenizer_threads'] = {
+        'command': ["create_dataset.py", "-i", preprocessed, "-o", os.path.join(work, "itwiki-tokens-threads.tsv"), "-f",
+                    "--processes", p, "--separate_documents", "--fill_for_tokenizer", tokenizer, "--target_len", "128",
+                    "--engine", "threads"],
+        'inputs': [preprocessed],
+        'requires': ['preprocess'],
+    }
+    # buckets are given less memory than the dataset takes, so that rows are scattered in a few of them
+    for mode, options in (('rounds', []), ('buckets', ["--memory_limit", "16"]), ('offsets', [])):
+        stages[f'shuffle_{mode}'] = {
+            'command': ["shuffle.py", "-i", tokens, "-o", os.path.join(work, f"shuffled_{mode}.tsv"), "-f", "--mode", mode] + options,
+            'inputs': [tokens],
+            'requires': ['create_dataset_tokenizer'],
+        }
+    for mode in ('concat', 'raw', 'interleave'):
+        stages[f'multilingual_{mode}'] = {
+            'command': ["multilingual_dataset.py", "-i", words, tokens, "-o", os.path.join(work, f"multilingual_{mode}.tsv"),
+                        "-f", "--lang_file", LANG_FILE, "--mode", mode, "--processes", p],
+            'inputs': [words, tokens],
+            'requires': ['create_dataset_words', 'create_dataset_tokenizer'],
+        }
+    # the same steps of preprocess, create_dataset_tokenizer and shuffle in a single pass
+    stages['pipeline'] = {
+        'command': ["pipeline.py", "-i", os.path.join(corpora, "wiki.txt"), "-o", os.path.join(work, "pipeline.tsv"), "-f",
+                    "--processes", p, "--separate_documents", "--fill_for_tokenizer", tokenizer, "--target_len", "128"],
+        'inputs': [os.path.join(corpora, "wiki.txt")],
+    }
+    stages['pipeline_openwebtext'] = {
+        'command': ["pipeline.py", "-i", os.path.join(corpora, "openwebtext.tar.xz"), "-o", os.path.join(work, "pipeline_openwebtext.tsv"),
+                    "-f", "--processes", p, "--fill_for_tokenizer", tokenizer, "--target_len", "128"],
+        'output': os.path.join(work, "pipeline_openwebtext.tsv"),
+    }
+    stages['paragraph_dataset'] = {
+        'command': ["weaved_dataset/create_paragraph_dataset.py", "-i", os.path.join(corpora, "wikiextractor"),
+                    "-o", paragraphs, "-p", p],
+        'inputs': [os.path.join(corpora, "wikiextractor")],
+    }
+    stages['weaved_pairs'] = {
+        'command': ["weaved_dataset/create_weaved_pairs_dataset.py", "-i", paragraphs, "-o", os.path.join(work, "pairs.tsv"),
+                    "-maxsl", "128", "-p", p],
+        'inputs': [paragraphs],
+        'requires': ['paragraph_dataset'],
+    }
+    return stages
+
+
+# selected stages and the ones whose outputs they need, in the order in which they are defined
+def resolve_stages(stages: Dict[str, Dict], selected: List[str]) -> List[str]:
+    needed = set()
+
+    def add(name):
+        assert name in stages, f"Unknown stage {name}, available stages are {', '.join(stages)}"
+        if name not in needed:
+            needed.add(name)
+            for required in stages[name].get('requires', []):
+                add(required)
+
+    for name in selected:
+        add(name)
+    return [name for name in stages if name in needed]
+
+
+# files of a list of files and folders
+def list_files(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, names in sorted(os.walk(path)):
+                files += [os.path.join(folder, name) for name in sorted(names)]
+        else:
+            files.append(path)
+    return files
+
+
+def count_lines_and_bytes(paths: List[str]):
+    lines = 0
+    size = 0
+    for filename in list_files(paths):
+        with open(filename, 'rb') as in_file:
+            for block in iter(lambda: in_file.read(BLOCK_SIZE), b''):
+                lines += block.count(b"\n")
+                size += len(block)
+    return lines, size
+
+
+# the resident memory high-water mark of a process starts from the one of the process that forked it, so scripts are started
+# by this small launcher instead of the benchmark process itself, which reports the peak of the largest of them
+LAUNCHER = """
+import resource, subprocess, sys
+code = subprocess.run(sys.argv[2:]).returncode
+with open(sys.argv[1], 'w') as out_file:
+    out_file.write(str(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+sys.exit(code)
+"""
+
+
+# resident memory of all the descendants of a process in bytes, pages shared by more processes are counted for each of them.
+# read from /proc, None on other systems
+def get_descendants_rss(pid: int) -> int:
+    if not os.path.isdir("/proc"):
+        return None
+    children = defaultdict(list)
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as in_file:
+                    children[int(in_file.read().rsplit(")", 1)[1].split()[1])].append(int(entry))
+            except (OSError, IndexError):
+                pass
+
+    total = 0
+    pending = list(children[pid])
+    while pending:
+        child = pending.pop()
+        pending += children[child]
+        try:
+            with open(f"/proc/{child}/statm") as in_file:
+                total += int(in_file.read().split()[1]) * PAGE_SIZE
+        except OSError:
+            pass
+    return total
+
+
+# sample the memory of all the processes of a script until `stop` is set and keep the peak in `peak`
+def sample_memory(pid: int, stop: threading.Event, peak: List[int]):
+    while not stop.wait(SAMPLING_INTERVAL):
+        rss = get_descendants_rss(pid)
+        if rss is None:
+            break
+        peak[0] = max(peak[0], rss)
+
+
+# run a script and return its wall time, the peak resident memory of its largest process and the peak sum over
+# all its processes, in MB
+def run_command(command: List[str], log_file: str):
+    rusage_file = f"{log_file}.rusage"
+    peak = [0]
+    stop = threading.Event()
+
+    with open(log_file, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", LAUNCHER, rusage_file, sys.executable] + command,
+                                   cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+        sampler = threading.Thread(target=sample_memory, args=(process.pid, stop, peak), daemon=True)
+        sampler.start()
+        process.wait()
+        seconds = time.perf_counter() - start
+        stop.set()
+        sampler.join()
+
+    if process.returncode != 0:
+        with open(log_file) as log:
+            tail = log.read()[-2000:]
+        raise RuntimeError(f"Command {' '.join(command)} failed with code {process.returncode}:\n{tail}")
+
+    # linux reports kilobytes, macos bytes
+    with open(rusage_file) as in_file:
+        peak_rss = int(in_file.read()) / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    os.remove(rusage_file)
+    return seconds, peak_rss, (peak[0] / 1024 / 1024 if peak[0] > 0 else None)
+
+
+def run_stage(stage: Dict, log_file: str) -> Dict:
+    seconds, peak_rss, peak_total_rss = run_command(stage['command'], log_file)
+    lines, size = count_lines_and_bytes(stage['inputs'] if 'inputs' in stage else [stage['output']])
+    return {
+        'seconds': round(seconds, 3),
+        'lines': lines,
+        'bytes': size,
+        'lines_per_second': round(lines / seconds, 1),
+        'mb_per_second': round(size / seconds / 1024 / 1024, 3),
+        'peak_rss_mb': round(peak_rss, 1),
+        'peak_total_rss_mb': round(peak_total_rss, 1) if peak_total_rss is not None else None,
+        'command': " ".join(stage['command']),
+    }
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def generate_corpora(corpora: str, size_mb: int, seed: int):
+    size = size_mb * 1024 * 1024
+    os.makedirs(corpora, exist_ok=True)
+    if not os.path.isfile(os.path.join(corpora, "wiki.txt")):
+        logging.info("Generating synthetic wikipedia corpus")
+        write_wikipedia_corpus(os.path.join(corpora, "wiki.txt"), size, seed=seed)
+    if not os.path.isdir(os.path.join(corpora, "wikiextractor")):
+        logging.info("Generating synthetic wikiextractor folder")
+        write_wikiextractor_folder(os.path.join(corpora, "wikiextractor"), size, seed=seed)
+    if not os.path.isfile(os.path.join(corpora, "openwebtext.tar.xz")):
+        logging.info("Generating synthetic openwebtext archive")
+        write_openwebtext_archive(os.path.join(corpora, "openwebtext.tar.xz"), size, seed=seed)
+    if not os.path.isdir(os.path.join(corpora, "tokenizer")):
+        logging.info("Training local tokenizer")
+        write_tokenizer(os.path.join(corpora, "tokenizer"), os.path.join(corpora, "wiki.txt"))
+
+
+# print the change of throughput and memory of each stage with respect to a previous run
+def compare(results: Dict, previous_file: str):
+    with open(previous_file) as in_file:
+        previous = json.load(in_file)
+    print(f"Compared to {previous_file} (commit {previous.get('commit')}):")
+    for name, stage in results['stages'].items():
+        if name not in previous['stages']:
+            continue
+        old = previous['stages'][name]
+        print(f"  {name:<32} lines/s {stage['lines_per_second'] / old['lines_per_second']:>6.2f}x   "
+              f"MB/s {stage['mb_per_second'] / old['mb_per_second']:>6.2f}x   "
+              f"peak RSS {stage['peak_rss_mb'] / old['peak_rss_mb']:>6.2f}x")
+
+
+def main(args):
+    work = tempfile.mkdtemp(prefix="benchmarks-", dir=args.work_dir)
+    corpora = args.corpora_folder if args.corpora_folder is not None else os.path.join(work, "corpora")
+    generate_corpora(corpora, args.size_mb, args.seed)
+
+    stages = get_stages(corpora, work, args.processes)
+    names = resolve_stages(stages, args.stages if args.stages is not None else list(stages))
+
+    results = {
+        'commit': get_commit(),
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': cpu_count(),
+        'processes': args.processes,
+        'size_mb': args.size_mb,
+        'seed': args.seed,
+        'stages': OrderedDict(),
+    }
+
+    # no network access is needed, the tokenizer is local
+    os.environ['HF_HUB_OFFLINE'] = "1"
+    try:
+        for name in names:
+            logging.info(f"Running {name}")
+            results['stages'][name] = run_stage(stages[name], os.path.join(work, f"{name}.log"))
+            stage = results['stages'][name]
+            logging.info(f"- {stage['seconds']}s, {stage['lines_per_second']} lines/s, {stage['mb_per_second']} MB/s, "
+                         f"peak RSS {stage['peak_rss_mb']} MB, all processes {stage['peak_total_rss_mb']} MB")
+    finally:
+        if not args.keep:
+            shutil.rmtree(work)
+
+    with open(args.output_json, 'w') as out_file:
+        json.dump(results, out_file, indent=2)
+    logging.info(f"Results written to {args.output_json}")
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Benchmark every script on synthetic corpora, reporting throughput and peak memory")
+
+    parser.add_argument('-o', '--output_json', type=str, required=True, help="Json file where results are written")
+    parser.add_argument('--stages', type=str, nargs='+', default=None, required=False,
+                        help="Stages to run, by default all. Stages whose outputs are needed are run as well")
+    parser.add_argument('--size_mb', type=int, default=50, required=False,
+                        help="Approximate size in MB of the text of each synthetic corpus")
+    parser.add_argument('--seed', type=int, default=0, required=False, help="Seed of the synthetic corpora")
+    parser.add_argument('--processes', type=int, default=cpu_count(), required=False,
+                        help="Number of processes given to every script")
+    parser.add_argument('--corpora_folder', type=str, default=None, required=False,
+                        help="Reuse the corpora of this folder, generating only the missing ones, instead of creating them for each run")
+    parser.add_argument('--work_dir', type=str, default=None, required=False,
+                        help="Folder where a temporary folder with the outputs is created, defaults to the system one")
+    parser.add_argument('--keep', action="store_true", help="Keep outputs and logs of the scripts")
+    parser.add_argument('--compare', type=str, default=None, required=False,
+                        help="Json file of a previous run to compare results with")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,158 @@
+import io
+import lzma
+import os
+import random
+import tarfile
+from argparse import ArgumentParser
+from typing import List, Tuple
+
+# synthetic corpora with the same structure of the real ones, so that every script can be benchmarked offline.
+# words are drawn from a zipfian vocabulary of made-up words, with some accented and quoted ones to exercise
+# unicode handling and tsv quoting
+VOCABULARY_SIZE = 30000
+SYLLABLES = [c + v for c in "bcdfghklmnprstvz" for v in "aeiou"]
+ACCENTS = "èüñàøé"
+# size of each file of the wikiextractor folder
+WIKIEXTRACTOR_FILE_SIZE = 1024 * 1024
+# number of documents in each container of the openwebtext archive
+OPENWEBTEXT_DOCUMENTS_PER_CONTAINER = 200
+XZ_PRESET = 1
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+
+
+class Vocabulary:
+
+    def __init__(self, seed: int = 0, size: int = VOCABULARY_SIZE):
+        self.rng = random.Random(seed)
+        words = set()
+        while len(words) < size:
+            word = "".join(self.rng.choices(SYLLABLES, k=self.rng.choice((1, 2, 2, 3, 3, 4))))
+            if self.rng.random() < 0.05:
+                word += self.rng.choice(ACCENTS)
+            words.add(word)
+        self.words = sorted(words, key=len)
+        cumulative = 0.0
+        self.cum_weights = []
+        for rank in range(1, size + 1):
+            cumulative += 1.0 / rank
+            self.cum_weights.append(cumulative)
+
+    def sentence(self) -> str:
+        words = self.rng.choices(self.words, cum_weights=self.cum_weights, k=self.rng.randint(4, 30))
+        if self.rng.random() < 0.05:
+            position = self.rng.randrange(len(words))
+            words[position] = f'"{words[position]}"'
+        return words[0].capitalize() + " " + " ".join(words[1:]) + self.rng.choice(".....?!")
+
+    def paragraph(self) -> str:
+        return " ".join(self.sentence() for _ in range(self.rng.randint(1, 8)))
+
+    def title(self) -> str:
+        return " ".join(word.capitalize() for word in self.rng.choices(self.words[:5000], k=self.rng.randint(1, 4)))
+
+    # title and paragraphs of a document
+    def document(self) -> Tuple[str, List[str]]:
+        return self.title(), [self.paragraph() for _ in range(self.rng.randint(1, 12))]
+
+
+# wikipedia dump extracted to a single file: a paragraph per line, the first being the title, and an empty line after each document
+def write_wikipedia_corpus(filename: str, size: int, seed: int = 0):
+    vocabulary = Vocabulary(seed)
+    written = 0
+    with open(filename, 'w') as out_file:
+        while written < size:
+            title, paragraphs = vocabulary.document()
+            text = title + "\n" + "\n".join(paragraphs) + "\n\n"
+            out_file.write(text)
+            written += len(text.encode('utf-8'))
+
+
+# wikipedia dump extracted by wikiextractor to a folder: subfolders `AA`, `AB`, ... of files `wiki_00`, `wiki_01`, ...
+# containing `<doc>` elements
+def write_wikiextractor_folder(folder: str, size: int, seed: int = 0):
+    vocabulary = Vocabulary(seed)
+    written = 0
+    file_index = 0
+    doc_id = 0
+    while written < size:
+        subfolder = os.path.join(folder, "A" + chr(ord("A") + file_index // 100))
+        os.makedirs(subfolder, exist_ok=True)
+        with open(os.path.join(subfolder, f"wiki_{file_index % 100:02d}"), 'w') as out_file:
+            file_written = 0
+            while file_written < WIKIEXTRACTOR_FILE_SIZE and written + file_written < size:
+                title, paragraphs = vocabulary.document()
+                text = (f'<doc id="{doc_id}" url="https://en.wikipedia.org/wiki?curid={doc_id}" title="{title}">\n'
+                        + title + "\n\n" + "\n".join(paragraphs) + "\n</doc>\n")
+                out_file.write(text)
+                file_written += len(text.encode('utf-8'))
+                doc_id += 1
+        written += file_written
+        file_index += 1
+
+
+# openwebtext archive: a tar.xz of xz compressed tars of documents, with empty lines inside documents as web pages have.
+# a fast compression preset is used, decompression speed is about the same of the real archive
+def write_openwebtext_archive(filename: str, size: int, seed: int = 0):
+    vocabulary = Vocabulary(seed)
+    written = 0
+    container = 0
+    with tarfile.open(filename, 'w:xz', preset=XZ_PRESET) as outer:
+        while written < size:
+            buffer = io.BytesIO()
+            with tarfile.open(fileobj=buffer, mode='w') as inner:
+                for document in range(OPENWEBTEXT_DOCUMENTS_PER_CONTAINER):
+                    _, paragraphs = vocabulary.document()
+                    data = "\n".join(p + ("\n" if vocabulary.rng.random() < 0.3 else "") for p in paragraphs).encode('utf-8')
+                    info = tarfile.TarInfo(f"{container:07d}-{document:032x}.txt")
+                    info.size = len(data)
+                    inner.addfile(info, io.BytesIO(data))
+                    written += len(data)
+            data = lzma.compress(buffer.getvalue(), preset=XZ_PRESET)
+            info = tarfile.TarInfo(f"urlsf_subset00-{container}_data.xz")
+            info.size = len(data)
+            outer.addfile(info, io.BytesIO(data))
+            container += 1
+
+
+# local stand-in for a pre-trained tokenizer: a wordpiece tokenizer trained on `corpus_file`, saved to `folder`
+# so that it can be loaded with `AutoTokenizer.from_pretrained(folder)` without network access
+def write_tokenizer(folder: str, corpus_file: str, vocab_size: int = 8000):
+    from tokenizers import Tokenizer, decoders, models, normalizers, pre_tokenizers, processors, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.WordPiece(unk_token="[UNK]"))
+    tokenizer.normalizer = normalizers.BertNormalizer(lowercase=False)
+    tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+    tokenizer.decoder = decoders.WordPiece()
+    tokenizer.train([corpus_file], trainers.WordPieceTrainer(vocab_size=vocab_size, special_tokens=SPECIAL_TOKENS, show_progress=False))
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="[CLS] $A [SEP]",
+        pair="[CLS] $A [SEP] $B [SEP]",
+        special_tokens=[(token, tokenizer.token_to_id(token)) for token in ("[CLS]", "[SEP]")],
+    )
+
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        unk_token="[UNK]",
+        pad_token="[PAD]",
+        cls_token="[CLS]",
+        sep_token="[SEP]",
+        mask_token="[MASK]",
+    ).save_pretrained(folder)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Generate synthetic wikipedia and openwebtext corpora and a local tokenizer")
+
+    parser.add_argument('-o', '--output_folder', type=str, required=True, help="Folder where corpora are written")
+    parser.add_argument('--size_mb', type=int, default=50, required=False, help="Approximate size in MB of the text of each corpus")
+    parser.add_argument('--seed', type=int, default=0, required=False, help="Seed of the generated text")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    size = args.size_mb * 1024 * 1024
+    write_wikipedia_corpus(os.path.join(args.output_folder, "wiki.txt"), size, seed=args.seed)
+    write_wikiextractor_folder(os.path.join(args.output_folder, "wikiextractor"), size, seed=args.seed)
+    write_openwebtext_archive(os.path.join(args.output_folder, "openwebtext.tar.xz"), size, seed=args.seed)
+    write_tokenizer(os.path.join(args.output_folder, "tokenizer"), os.path.join(args.output_folder, "wiki.txt"))
+    print('Done.')
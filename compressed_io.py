@@ -0,0 +1,429 @@
+import bisect
+import gzip
+import io
+import lzma
+import os
+import queue
+import struct
+import threading
+import zlib
+from typing import Dict, List, Tuple
+
+
+# files are compressed or decompressed based on their extension:
+#  - `.gz`: gzip, a new member is started after every checkpoint
+#  - `.xz`: xz, a new stream is started after every checkpoint
+#  - `.zst`: zstandard in the seekable format, independent frames of `ZSTD_FRAME_SIZE` uncompressed bytes followed by
+#    a seek table, so that byte ranges of the uncompressed data can be read without decompressing the whole file.
+#    requires `pip install zstandard`
+# plain and seekable zstandard files can be split in byte ranges and randomly accessed, other files are read sequentially
+COMPRESSIONS = {'.gz': 'gz', '.xz': 'xz', '.zst': 'zst'}
+COMPRESSION_LEVELS = {'gz': 6, 'xz': 6, 'zst': 3}
+# data is decompressed and compressed by background threads in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+# maximum number of chunks waiting in the queue of a background thread
+QUEUE_SIZE = 8
+ZSTD_FRAME_SIZE = 1024 * 1024
+
+# seek table of the zstandard seekable format, stored in a skippable frame at the end of the file
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER = struct.Struct('<IBI')
+SEEK_TABLE_ENTRY = struct.Struct('<II')
+SKIPPABLE_HEADER = struct.Struct('<II')
+CHECKSUM_FLAG = 0x80
+
+
+def get_compression(filename: str) -> str:
+    return COMPRESSIONS.get(os.path.splitext(str(filename))[1])
+
+
+# name of a file without the compression extension, if any
+def strip_compression_suffix(filename: str) -> str:
+    filename = str(filename)
+    return os.path.splitext(filename)[0] if get_compression(filename) is not None else filename
+
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading and writing .zst files requires the zstandard package, install it with `pip install zstandard`")
+    return zstandard
+
+
+# entries (compressed size, uncompressed size) of the frames of a seekable zstandard file, None if it has no seek table
+def read_seek_table(in_file) -> List[Tuple[int, int]]:
+    size = in_file.seek(0, os.SEEK_END)
+    if size < SEEK_TABLE_FOOTER.size + SKIPPABLE_HEADER.size:
+        return None
+
+    in_file.seek(size - SEEK_TABLE_FOOTER.size)
+    n_frames, descriptor, magic = SEEK_TABLE_FOOTER.unpack(in_file.read(SEEK_TABLE_FOOTER.size))
+    if magic != SEEKABLE_MAGIC:
+        return None
+
+    entry_size = SEEK_TABLE_ENTRY.size + (4 if descriptor & CHECKSUM_FLAG else 0)
+    table_size = n_frames * entry_size
+    in_file.seek(size - SEEK_TABLE_FOOTER.size - table_size - SKIPPABLE_HEADER.size)
+    skippable_magic, frame_size = SKIPPABLE_HEADER.unpack(in_file.read(SKIPPABLE_HEADER.size))
+    assert skippable_magic == SKIPPABLE_MAGIC and frame_size == table_size + SEEK_TABLE_FOOTER.size, (
+        f"Corrupted seek table in {in_file.name}"
+    )
+
+    table = in_file.read(table_size)
+    return [SEEK_TABLE_ENTRY.unpack_from(table, i * entry_size) for i in range(n_frames)]
+
+
+def is_seekable_zstd(filename: str) -> bool:
+    with open(filename, 'rb') as in_file:
+        return read_seek_table(in_file) is not None
+
+
+# whether byte ranges of the uncompressed data of a file can be read directly
+def is_seekable(filename: str) -> bool:
+    compression = get_compression(filename)
+    return compression is None or (compression == 'zst' and is_seekable_zstd(filename))
+
+
+# size of the uncompressed data of a file, None if it can be known only by decompressing it
+def get_file_size(filename: str) -> int:
+    compression = get_compression(filename)
+    if compression is None:
+        return os.path.getsize(filename)
+    if compression == 'zst':
+        with open(filename, 'rb') as in_file:
+            frames = read_seek_table(in_file)
+        if frames is not None:
+            return sum(uncompressed for _, uncompressed in frames)
+    return None
+
+
+# random access to the uncompressed data of a seekable zstandard file, decompressing only the frames that are read
+class SeekableZstdReader(io.RawIOBase):
+
+    def __init__(self, filename: str):
+        zstandard = import_zstandard()
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.in_file = open(filename, 'rb')
+        frames = read_seek_table(self.in_file)
+        assert frames is not None, f"File {filename} is not a seekable zstandard file"
+
+        self.compressed_offsets = [0]
+        self.offsets = [0]
+        for compressed, uncompressed in frames:
+            self.compressed_offsets.append(self.compressed_offsets[-1] + compressed)
+            self.offsets.append(self.offsets[-1] + uncompressed)
+        self.position = 0
+        # last decompressed frame, consecutive reads usually fall in it
+        self.frame_index = None
+        self.frame = b''
+
+    def get_frame(self, index: int) -> bytes:
+        if index != self.frame_index:
+            self.in_file.seek(self.compressed_offsets[index])
+            data = self.in_file.read(self.compressed_offsets[index + 1] - self.compressed_offsets[index])
+            self.frame = self.decompressor.decompressobj().decompress(data)
+            self.frame_index = index
+        return self.frame
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.offsets[-1] or len(buffer) == 0:
+            return 0
+        index = bisect.bisect_right(self.offsets, self.position) - 1
+        frame = self.get_frame(index)
+        start = self.position - self.offsets[index]
+        n = min(len(buffer), len(frame) - start)
+        buffer[:n] = frame[start:start + n]
+        self.position += n
+        return n
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.offsets[-1]
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.in_file.close()
+        super().close()
+
+
+# decompress a file in a background thread, that reads ahead at most `QUEUE_SIZE` chunks.
+# the thread starts at the first read, seeking stops it and moves the underlying file
+class ThreadedReader(io.RawIOBase):
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.position = raw.tell() if raw.seekable() else 0
+        self.pending = memoryview(b'')
+        self.eof = False
+        self.thread = None
+
+    def start_thread(self):
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop_thread(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                data = self.raw.read(CHUNK_SIZE)
+            except Exception as e:
+                data = e
+            # stop waiting for space in the queue if the reader is stopped
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(data, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(data, Exception) or not data:
+                break
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if len(self.pending) == 0:
+            if self.eof:
+                return 0
+            if self.thread is None:
+                self.start_thread()
+            data = self.queue.get()
+            if isinstance(data, Exception):
+                raise data
+            if not data:
+                self.eof = True
+                return 0
+            self.pending = memoryview(data)
+
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        self.position += n
+        return n
+
+    def seekable(self) -> bool:
+        return True
+
+    # streams that cannot seek are moved forward by reading and discarding data
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset, whence = self.position + offset, os.SEEK_SET
+        if not self.raw.seekable():
+            if whence != os.SEEK_SET or offset < self.position:
+                raise io.UnsupportedOperation("Compressed stream can only seek forward")
+            buffer = bytearray(CHUNK_SIZE)
+            while self.position < offset and self.readinto(memoryview(buffer)[:offset - self.position]) > 0:
+                pass
+            return self.position
+        self.stop_thread()
+        self.position = self.raw.seek(offset, whence)
+        self.pending = memoryview(b'')
+        self.eof = False
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.stop_thread()
+            self.raw.close()
+        super().close()
+
+
+# compress data to a file. a checkpoint ends the current gzip member, xz stream or zstandard frame, so that the file
+# can be truncated at the offset returned by `state` and written again from there with `resume_state`
+class CompressedWriter(io.RawIOBase):
+
+    def __init__(self, filename: str, resume_state: Dict = None):
+        self.compression = get_compression(filename)
+        assert self.compression is not None, f"File {filename} does not have a compression extension"
+        if self.compression == 'zst':
+            self.zstd_compressor = import_zstandard().ZstdCompressor(level=COMPRESSION_LEVELS['zst'])
+
+        if resume_state is not None:
+            os.truncate(filename, resume_state['offset'])
+            self.out_file = open(filename, 'ab')
+            self.frames = [tuple(frame) for frame in resume_state.get('frames', [])]
+        else:
+            self.out_file = open(filename, 'wb')
+            self.frames = []
+
+        self.compressor = None
+        self.frame = []
+        self.frame_size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        if self.compression == 'zst':
+            self.frame.append(data)
+            self.frame_size += len(data)
+            while self.frame_size >= ZSTD_FRAME_SIZE:
+                self.write_frame(ZSTD_FRAME_SIZE)
+        else:
+            if self.compressor is None:
+                if self.compression == 'gz':
+                    self.compressor = zlib.compressobj(COMPRESSION_LEVELS['gz'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                else:
+                    self.compressor = lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=COMPRESSION_LEVELS['xz'])
+            self.out_file.write(self.compressor.compress(data))
+        return len(data)
+
+    # compress the first `size` buffered bytes in a frame of their own
+    def write_frame(self, size: int):
+        data = b''.join(self.frame)
+        compressed = self.zstd_compressor.compress(data[:size])
+        self.out_file.write(compressed)
+        self.frames.append((len(compressed), size))
+        rest = data[size:]
+        self.frame = [rest] if len(rest) > 0 else []
+        self.frame_size = len(rest)
+
+    def end_member(self):
+        if self.compression == 'zst':
+            if self.frame_size > 0:
+                self.write_frame(self.frame_size)
+        elif self.compressor is not None:
+            self.out_file.write(self.compressor.flush())
+            self.compressor = None
+
+    # flush data to disk and return what is needed to resume writing after it
+    def state(self) -> Dict:
+        self.end_member()
+        self.out_file.flush()
+        os.fsync(self.out_file.fileno())
+        res = {'offset': self.out_file.tell()}
+        if self.compression == 'zst':
+            res['frames'] = [list(frame) for frame in self.frames]
+        return res
+
+    def close(self):
+        if not self.closed:
+            self.end_member()
+            if self.compression == 'zst':
+                table = b''.join(SEEK_TABLE_ENTRY.pack(*frame) for frame in self.frames)
+                table += SEEK_TABLE_FOOTER.pack(len(self.frames), 0, SEEKABLE_MAGIC)
+                self.out_file.write(SKIPPABLE_HEADER.pack(SKIPPABLE_MAGIC, len(table)) + table)
+            self.out_file.close()
+        super().close()
+
+
+# hand data to a background thread that compresses and writes it, waiting only if `QUEUE_SIZE` chunks are pending
+class ThreadedWriter(io.RawIOBase):
+
+    def __init__(self, raw: CompressedWriter):
+        self.raw = raw
+        self.error = None
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            try:
+                if data is None:
+                    break
+                if self.error is None:
+                    self.raw.write(data)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.check()
+        data = bytes(data)
+        self.queue.put(data)
+        return len(data)
+
+    # wait for the pending chunks and return the state of the compressed file
+    def state(self) -> Dict:
+        self.queue.join()
+        self.check()
+        return self.raw.state()
+
+    def close(self):
+        if not self.closed:
+            self.queue.put(None)
+            self.thread.join()
+            self.raw.close()
+            self.check()
+        super().close()
+
+
+# buffered compressed output, with the `state` of the underlying compressed file
+class CompressedOutput(io.BufferedWriter):
+
+    def state(self) -> Dict:
+        self.flush()
+        return self.raw.state()
+
+
+# raw decompressed stream of a compressed file
+def open_compressed_input(filename: str):
+    compression = get_compression(filename)
+    if compression == 'gz':
+        return gzip.GzipFile(filename, 'rb')
+    if compression == 'xz':
+        return lzma.LZMAFile(filename, 'rb')
+    if is_seekable_zstd(filename):
+        return SeekableZstdReader(filename)
+    return import_zstandard().ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True, closefd=True)
+
+
+# open a file for reading (`rb`, `r`) or writing (`wb`, `w`), compressing or decompressing it in a background thread
+# if its extension is one of the compressed ones. `resume_state` is the `state` of a compressed output that was
+# interrupted, writing starts again from it. `threaded=False` reads and writes in the calling thread, for random access
+def open_file(filename: str, mode: str = 'rb', threaded: bool = True, resume_state: Dict = None, newline: str = None):
+    assert mode in ('rb', 'r', 'rt', 'wb', 'w', 'wt'), f"Unsupported mode {mode}"
+    text = 'b' not in mode
+    if get_compression(filename) is None:
+        return open(filename, mode, newline=newline) if text else open(filename, mode)
+
+    if mode.startswith('r'):
+        raw = open_compressed_input(filename)
+        binary = io.BufferedReader(ThreadedReader(raw) if threaded else raw, buffer_size=CHUNK_SIZE)
+    else:
+        raw = CompressedWriter(filename, resume_state=resume_state)
+        binary = CompressedOutput(ThreadedWriter(raw) if threaded else raw, buffer_size=CHUNK_SIZE)
+
+    return io.TextIOWrapper(binary, encoding='utf-8', newline=newline) if text else binary
@@ -2,53 +2,200 @@ import os
 from argparse import ArgumentParser
 import csv
 import logging
-from typing import List
-import transformers
+import queue
+import threading
+import time
+from typing import Dict, List, Tuple
 from tqdm import tqdm
 from multiprocessing import cpu_count, Process, Queue
+from compressed_io import open_file
+from file_utils import (
+    clip_ranges,
+    get_checkpoint_file,
+    get_document_aligned_ranges,
+    load_checkpoint,
+    read_lines_in_range,
+    remove_checkpoint,
+    save_checkpoint
+)
+from tokenized_dataset import TokenizedDatasetWriter, get_tokenized_dataset_files
+from parquet_dataset import ROW_GROUP_MB, ParquetDatasetWriter
+from shared_tokenizer import LazyTokenizer, share_tokenizer
+from length_cache import LengthCache, consolidate_cache, get_cache_folder
+from metrics import MetricsRegistry, MetricsReporter, ProcessMetrics, add_metrics_arguments
+from sharding import (
+    add_sharded_output_arguments,
+    get_input_offsets,
+    get_input_size,
+    get_sharding_kwargs,
+    open_output,
+    output_exists
+)
 
 
 FORMAT_LOGGING = '%(levelname)s: %(message)s'
 logging.basicConfig(format=FORMAT_LOGGING)
 logging.getLogger().setLevel(logging.INFO)
 args_tokenizer = {'return_token_type_ids': False, 'return_attention_mask': False, 'return_length': True}
+args_tokenizer_ids = {'return_token_type_ids': False, 'return_attention_mask': False, 'add_special_tokens': False}
 
 
-# process a batch of lines with a tokenizer
-def parse_line(lines: str, tokenizer: transformers.PreTrainedTokenizer):
+# process a batch of lines with a tokenizer. if `return_ids`, lines are replaced by their token ids.
+# lengths are read from the length cache, if given, and only missing lines are tokenized
+def parse_line(lines: str, tokenizer: LazyTokenizer, return_ids: bool = False, length_cache: LengthCache = None):
     lines = [line.strip() for line in lines]
     lines = [line + '.' if not line.endswith('.') and len(line) > 0 else line for line in lines]
+    if len(lines) == 0:
+        return zip()
+    if length_cache is not None and tokenizer is not None and not return_ids:
+        return zip(lines, length_cache.get_lengths(lines, lambda missing: tokenizer(missing, **args_tokenizer)['length']))
+    if return_ids:
+        ids = tokenizer(lines, **args_tokenizer_ids)['input_ids']
+        return zip(ids, [len(x) for x in ids])
     return zip(lines, tokenizer(lines, **args_tokenizer)['length']) if tokenizer is not None else zip(lines, [None] * len(lines))
 
 
-# process a set of lines in a separate process with a dedicated tokenizer
-def worker(in_queue: Queue, out_queue: Queue, tokenizer_name: str = None, accumulate: int = 1):
-    tokenizer = transformers.AutoTokenizer.from_pretrained(tokenizer_name) if tokenizer_name else None
-    acc = list()
+# parse a batch of lines, counting lines and tokens and the time spent in tokenizer calls
+def parse_batch(lines: List[str], tokenizer, metrics: ProcessMetrics, return_ids: bool = False, length_cache: LengthCache = None):
+    start = time.perf_counter()
+    results = list(parse_line(lines, tokenizer, return_ids=return_ids, length_cache=length_cache))
+    if tokenizer is not None:
+        metrics.add('tokenize_seconds', time.perf_counter() - start)
+        metrics.add('tokenize_batches', 1)
+        metrics.add('tokens', sum(length for _, length in results))
+    metrics.add('lines', len(lines))
+    return results
+
+
+# process batches of lines in a separate process or, with the threads engine, in a thread of the main process.
+# every batch is sent back with its sequence number as a single unit, along with the input offset where it ends
+def worker(
+    in_queue: Queue,
+    out_queue: Queue,
+    tokenizer: LazyTokenizer = None,
+    return_ids: bool = False,
+    length_cache_folder: str = None,
+    metrics: ProcessMetrics = None
+):
+    length_cache = LengthCache(length_cache_folder) if length_cache_folder is not None else None
+    metrics = metrics if metrics is not None else ProcessMetrics()
+    metrics.start()
     while True:
-        new_line = in_queue.get()
-        if new_line is None:
-            for res in parse_line(acc, tokenizer):
-                out_queue.put(res)
+        batch = metrics.get(in_queue)
+        if batch is None:
             out_queue.put(None)
             break
 
-        acc.append(new_line)
-        if len(acc) >= accumulate:
-            for res in parse_line(acc, tokenizer):
-                out_queue.put(res)
-            acc.clear()
+        seq, lines, end_offset = batch
+        results = parse_batch(lines, tokenizer, metrics, return_ids=return_ids, length_cache=length_cache)
+        metrics.put(out_queue, (seq, results, True, end_offset))
+    metrics.finish()
+
+
+# process whole byte ranges of the input files in a separate process, without going through an input queue.
+# shards are given as (filename, file_offset, start, end), offsets are reported in the concatenation of the files.
+# results of a shard are sent back in batches with the shard sequence number, the last one closes the unit
+# if a packer is given, workers send back packed rows grouped by the input line that completed them
+def shard_worker(
+    shards: List[Tuple[int, Tuple[str, int, int, int]]],
+    out_queue: Queue,
+    tokenizer: LazyTokenizer = None,
+    accumulate: int = 1,
+    return_ids: bool = False,
+    packer_kwargs: dict = None,
+    length_cache_folder: str = None,
+    metrics: ProcessMetrics = None
+):
+    length_cache = LengthCache(length_cache_folder) if length_cache_folder is not None else None
+    packer = Packer(**packer_kwargs) if packer_kwargs is not None else None
+    metrics = metrics if metrics is not None else ProcessMetrics()
+    metrics.start()
 
+    def process(lines):
+        results = parse_batch(lines, tokenizer, metrics, return_ids=return_ids, length_cache=length_cache)
+        return results if packer is None else pack_results(packer, results)
 
-# read from input and fill input queue
-def filler(filename: str, in_queues: List[Queue], n_cpus: int):
-    with open(filename) as in_fi:
-        i = 0
-        for line in in_fi:
-            in_queues[i].put(line)
-            i = (i + 1) % n_cpus
+    acc = list()
+    for seq, (filename, file_offset, start, end) in shards:
+        last_position = start
+        for new_line, position in read_lines_in_range(filename, start, end, with_positions=True):
+            acc.append(new_line)
+            if len(acc) >= accumulate:
+                metrics.add('bytes', position - last_position)
+                last_position = position
+                metrics.put(out_queue, (seq, process(acc), False, file_offset + position))
+                acc.clear()
+
+        metrics.add('bytes', end - last_position)
+        results = process(acc)
+        acc.clear()
+        # shards start right after the end of a document, so the accumulator is always empty between them.
+        # only the last shard may leave a row that the serial packer would write at the end
+        if packer is not None:
+            tail = packer.flush()
+            if len(tail) > 0:
+                results.append((tail, True))
+        metrics.put(out_queue, (seq, results, True, file_offset + end))
+    out_queue.put(None)
+    metrics.finish()
+
+
+# read from input files, given with the offset of each one in their concatenation, and fill input queues
+# with sequence-numbered batches of lines, starting from `start_offset`
+def filler(
+    input_files: List[Tuple[str, int]],
+    in_queues: List[Queue],
+    n_cpus: int,
+    accumulate: int = 1,
+    start_offset: int = 0,
+    metrics: ProcessMetrics = None
+):
+    metrics = metrics if metrics is not None else ProcessMetrics()
+    metrics.start()
+    seq = 0
+    acc = list()
+    last_position = start_offset
+    for i, (filename, file_offset) in enumerate(input_files):
+        # the next file starts where this one ends
+        if i + 1 < len(input_files) and input_files[i + 1][1] <= start_offset:
+            continue
+
+        with open_file(filename, 'rb') as in_fi:
+            position = max(start_offset, file_offset)
+            in_fi.seek(position - file_offset)
+            for line in in_fi:
+                acc.append(line.decode('utf-8'))
+                position += len(line)
+                if len(acc) >= accumulate:
+                    metrics.add('bytes', position - last_position)
+                    last_position = position
+                    metrics.put(in_queues[seq % n_cpus], (seq, acc, position))
+                    seq += 1
+                    acc = list()
+    if len(acc) > 0:
+        metrics.add('bytes', position - last_position)
+        metrics.put(in_queues[seq % n_cpus], (seq, acc, position))
     for i in range(len(in_queues)):
         in_queues[i].put(None)
+    metrics.finish()
+
+
+# read batches from the workers in sequence order and yield their results, the input offset
+# where they end and whether they close a unit of work.
+# units of work are assigned round-robin, so the next one is always at the head of a known queue
+def read_batches_in_order(out_queues: List[Queue], metrics: ProcessMetrics = None):
+    metrics = metrics if metrics is not None else ProcessMetrics()
+    seq = 0
+    while True:
+        res = metrics.get(out_queues[seq % len(out_queues)])
+        if res is None:
+            break
+
+        batch_seq, results, last, end_offset = res
+        assert batch_seq == seq, f"Expected a batch with sequence number {seq}, got {batch_seq}"
+        yield results, end_offset, last
+        if last:
+            seq += 1
 
 
 # heuristically split a paragraph in 2+ pieces of which the first is respecting the target_len requirement
@@ -80,145 +227,424 @@ def split_line_heuristic(line: str, line_len: int, target_len: int):
     return res
 
 
-# read from out_queue and write to file
+# split a sequence of token ids in pieces of target_len tokens, the last should be given to the accumulator
+def split_ids(ids: List[int], ids_len: int, target_len: int):
+    return [(ids[i:i + target_len], len(ids[i:i + target_len])) for i in range(0, ids_len, target_len)]
+
+
+# greedily pack consecutive lines in rows of at most target_len tokens.
+# lines may be strings or lists of token ids, the latter are concatenated and split exactly
+class Packer:
+
+    def __init__(
+        self,
+        target_len: int = 510,
+        separate_documents: bool = False,
+        no_split_long_paragraphs: bool = False,
+        token_ids: bool = False
+    ):
+        self.target_len = target_len
+        self.separate_documents = separate_documents
+        self.no_split_long_paragraphs = no_split_long_paragraphs
+        self.token_ids = token_ids
+
+        # used to accumulate sequences
+        self.accumulator = None
+        self.accumulator_len = 0
+
+    def join(self, accumulator, line):
+        if self.token_ids:
+            return accumulator + line
+        return accumulator + " " + line if len(accumulator) > 0 else line
+
+    # new feature to split also very long single paragraphs
+    def split_accumulator(self):
+        if self.accumulator_len > self.target_len and not self.no_split_long_paragraphs:
+            split = split_ids if self.token_ids else split_line_heuristic
+            splitted_line = split(self.accumulator, self.accumulator_len, self.target_len)
+            self.accumulator, self.accumulator_len = splitted_line[-1]
+            return [sentence for sentence, _ in splitted_line[:-1]]
+        return []
+
+    # add a line with its length in tokens and return the rows that are complete
+    def add(self, line, line_len: int):
+        # empty lines are used to separate documents
+        if (self.separate_documents and len(line) == 0) and self.accumulator is not None:
+            rows = [self.accumulator]
+            self.accumulator = None
+            self.accumulator_len = None
+            return rows
+
+        # if we have an empty accumulator let's use the new line to init it
+        if self.accumulator is None:
+            self.accumulator = line
+            self.accumulator_len = line_len
+            return self.split_accumulator()
+
+        # if adding the new sequence is still under the max len
+        if self.accumulator_len + line_len <= self.target_len:
+            self.accumulator = self.join(self.accumulator, line)
+            self.accumulator_len += line_len
+            return []
+
+        # if we went over, write and init accu with actual line
+        rows = [self.accumulator]
+        self.accumulator = line
+        self.accumulator_len = line_len
+        return rows + self.split_accumulator()
+
+    def state(self) -> Dict:
+        return {'accumulator': self.accumulator, 'accumulator_len': self.accumulator_len}
+
+    def load_state(self, state: Dict):
+        self.accumulator = state['accumulator']
+        self.accumulator_len = state['accumulator_len']
+
+    # return the last accumulated row, if any
+    def flush(self):
+        rows = [self.accumulator] if self.accumulator is not None and len(self.accumulator) > 0 else []
+        self.accumulator = None
+        self.accumulator_len = 0
+        return rows
+
+
+# pack results of a worker, returning groups of (rows, is_tail) for the input lines that completed some rows
+def pack_results(packer: Packer, results):
+    groups = []
+    for line, line_len in results:
+        rows = packer.add(line, line_len)
+        if len(rows) > 0:
+            groups.append((rows, False))
+    return groups
+
+
+# write rows of [id, text] to a tsv file, or to shards of it if `sharding_kwargs` are given.
+# `resume_state` is the value of `state()` saved by a previous interrupted run
+class TsvWriter:
+
+    def __init__(self, filename: str, resume_state: Dict = None, sharding_kwargs: Dict = None):
+        self.out_file = open_output(filename, sharding_kwargs, resume_state=resume_state)
+        self.writer = csv.writer(self.out_file, delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+    def write(self, row_id: int, text: str):
+        self.writer.writerow([row_id, text])
+
+    # flush data to disk and return what is needed to resume writing after the last row
+    def state(self) -> Dict:
+        return self.out_file.state()
+
+    def close(self):
+        self.out_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# read from out_queue and write to file.
+# every `checkpoint_interval` seconds the state needed to resume the run is saved to `checkpoint_file`
 def writer(
     out_queues: List[Queue],
     filename: str,
-    n_cpus: int,
     limit: int = None,
     min_word_per_sentence: int = 1,
     separate_documents: bool = False,
     target_len: int = 510,
-    no_split_long_paragraphs: bool = False
+    no_split_long_paragraphs: bool = False,
+    output_format: str = 'tsv',
+    vocab_size: int = None,
+    packed_by_workers: bool = False,
+    checkpoint_file: str = None,
+    checkpoint_interval: int = 300,
+    checkpoint_config: Dict = None,
+    resume_checkpoint: Dict = None,
+    sharding_kwargs: Dict = None,
+    row_group_mb: int = ROW_GROUP_MB,
+    metrics: ProcessMetrics = None
 ):
-
-    # used to accumulate sequences
-    accumulator = None
-    accumulator_len = 0
+    metrics = metrics if metrics is not None else ProcessMetrics()
+    metrics.start()
+
+    packer = Packer(
+        target_len=target_len,
+        separate_documents=separate_documents,
+        no_split_long_paragraphs=no_split_long_paragraphs,
+        token_ids=output_format == 'bin'
+    )
     written_lines = 0
-    terminated = 0
-    pbar = tqdm(desc="Writing to output file")
-    i = 0
-
-    with open(filename, "w") as out_file:
-        writer = csv.writer(out_file, delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        while True:
-            
-            res = out_queues[i].get()
-            i = (i + 1) % n_cpus
-
-            if res is None:
-                terminated += 1
-                if terminated == n_cpus:
-                    break
-                else:
-                    continue
-
-            # unpack
-            line, line_len = res
-
-            # without tokenizer write line by line
-            if line_len is None:
-                if len(line.strip()) > 0 and len(line.split()) >= min_word_per_sentence:
-                    writer.writerow([written_lines, line])
-                    written_lines += 1
-                    pbar.update()
-
-            # length of actual line in tokens
-            else:
-                # empty lines are used to separate documents
-                if (separate_documents and len(line) == 0) and accumulator is not None: 
-                    writer.writerow([written_lines, accumulator])
-                    written_lines += 1
-                    pbar.update()
-                    accumulator = None
-                    accumulator_len = None
-
-                # if we have an empty accumulator let's use the new line to init it
-                elif accumulator is None:
-                    accumulator = line
-                    accumulator_len = line_len
-
-                    # new feature to split also very long single paragraphs
-                    if accumulator_len > target_len and not no_split_long_paragraphs:
-                        splitted_line = split_line_heuristic(accumulator, accumulator_len, target_len)
-                        for sentence, _ in splitted_line[:-1]:
-                            writer.writerow([written_lines, sentence])
-                            written_lines += 1
-                            pbar.update()
-                        accumulator, accumulator_len = splitted_line[-1]
-
-                # if adding the new sequence is still under the max len
-                elif accumulator_len + line_len <= target_len:
-                    accumulator = accumulator + " " + line if len(accumulator) > 0 else line
-                    accumulator_len += line_len
-
-                # if we went over, write and init accu with actual line
+    resume_state = None
+    if resume_checkpoint is not None:
+        packer.load_state(resume_checkpoint['packer'])
+        written_lines = resume_checkpoint['written_lines']
+        resume_state = resume_checkpoint['output']
+    pbar = tqdm(desc="Writing to output file", initial=written_lines)
+    last_checkpoint = time.time()
+
+    if output_format == 'bin':
+        out_writer = TokenizedDatasetWriter(filename, vocab_size, resume_state=resume_state)
+    elif output_format == 'parquet':
+        out_writer = ParquetDatasetWriter(filename, row_group_mb=row_group_mb)
+    else:
+        out_writer = TsvWriter(filename, resume_state=resume_state, sharding_kwargs=sharding_kwargs)
+
+    with out_writer:
+        reached_limit = False
+        for results, end_offset, last in read_batches_in_order(out_queues, metrics=metrics):
+            batch_start_lines = written_lines
+            for line, line_len in results:
+
+                # rows already packed by the workers, just write them in order
+                if packed_by_workers:
+                    rows, is_tail = line, line_len
+                    # like below, the last accumulated row is written only if there is no limit
+                    if is_tail and limit is not None:
+                        break
+                    for row in rows:
+                        out_writer.write(written_lines, row)
+                        written_lines += 1
+                        pbar.update()
+
+                # without tokenizer write line by line
+                elif line_len is None:
+                    if len(line.strip()) > 0 and len(line.split()) >= min_word_per_sentence:
+                        out_writer.write(written_lines, line)
+                        written_lines += 1
+                        pbar.update()
+
+                # length of actual line in tokens
                 else:
-                    writer.writerow([written_lines, accumulator])
-                    written_lines += 1
-                    pbar.update()
-                    accumulator = line
-                    accumulator_len = line_len
-
-                    # new feature to split also very long single paragraphs
-                    if accumulator_len > target_len and not no_split_long_paragraphs:
-                        splitted_line = split_line_heuristic(accumulator, accumulator_len, target_len)
-                        for sentence, _ in splitted_line[:-1]:
-                            writer.writerow([written_lines, sentence])
-                            written_lines += 1
-                            pbar.update()
-                        accumulator, accumulator_len = splitted_line[-1]
-
-            if limit is not None and written_lines >= limit:
+                    for row in packer.add(line, line_len):
+                        out_writer.write(written_lines, row)
+                        written_lines += 1
+                        pbar.update()
+
+                if limit is not None and written_lines >= limit:
+                    reached_limit = True
+                    break
+
+            metrics.add('rows', written_lines - batch_start_lines)
+            if reached_limit:
                 break
 
+            # packers of the workers are empty only at the end of a unit
+            if checkpoint_file is not None and (last or not packed_by_workers) and time.time() - last_checkpoint >= checkpoint_interval:
+                save_checkpoint(checkpoint_file, {
+                    'config': checkpoint_config,
+                    'input_offset': end_offset,
+                    'written_lines': written_lines,
+                    'output': out_writer.state(),
+                    'packer': packer.state()
+                })
+                last_checkpoint = time.time()
+
         # if last accumulator was not written because for cycle ended before, write it now
-        if limit is None and accumulator is not None and len(accumulator) > 0:
-            writer.writerow([written_lines, accumulator])
-            written_lines += 1
-            pbar.update()
+        if limit is None:
+            for row in packer.flush():
+                out_writer.write(written_lines, row)
+                written_lines += 1
+                metrics.add('rows', 1)
+                pbar.update()
 
         pbar.close()
-        logging.info(f"Written {written_lines} lines successfully.")
+
+    metrics.finish()
+    if checkpoint_file is not None:
+        remove_checkpoint(checkpoint_file)
+    logging.info(f"Written {written_lines} lines successfully.")
 
 
 def main(args):
     
     logging.info(f"Checking I/O files")
-    if os.path.isfile(args.output_file):
-        assert args.force_overwrite, f"Cannot overwrite {args.output_file}, add -f option if you are cocky"
-        os.remove(args.output_file)
     assert os.path.isfile(args.input_file), f"Input file {args.input_file} does not exist"
 
-    logging.info("Creating queues")
-    in_queues = [Queue() for _ in range(args.processes)]
-    out_queues = [Queue() for _ in range(args.processes)]
+    # parameters that must not change between a run and its resumption
+    checkpoint_file = get_checkpoint_file(args.output_file)
+    checkpoint_config = {
+        'input_file': os.path.abspath(args.input_file),
+        'input_size': get_input_size(args.input_file),
+        'fill_for_tokenizer': args.fill_for_tokenizer,
+        'min_word_per_sentence': args.min_word_per_sentence,
+        'separate_documents': args.separate_documents,
+        'target_len': args.target_len,
+        'no_split_long_paragraphs': args.no_split_long_paragraphs,
+        'output_format': args.output_format,
+        'sharded_input': args.sharded_input,
+        'shard_size': args.shard_size,
+        'pack_in_workers': args.pack_in_workers,
+        'shard_rows': args.shard_rows,
+        'shard_bytes': args.shard_bytes,
+    }
+    sharding_kwargs = get_sharding_kwargs(args)
+    assert sharding_kwargs is None or args.output_format == 'tsv', "Sharded output is available only for tsv files"
+    assert not args.resume or args.output_format != 'parquet', "Parquet outputs cannot be resumed"
+
+    resume_checkpoint = None
+    output_files = get_tokenized_dataset_files(args.output_file) if args.output_format == 'bin' else [args.output_file]
+    if args.resume and os.path.isfile(checkpoint_file):
+        resume_checkpoint = load_checkpoint(checkpoint_file)
+        assert resume_checkpoint['config'] == checkpoint_config, (
+            f"Checkpoint {checkpoint_file} was created with different parameters: {resume_checkpoint['config']}"
+        )
+        for output_file in output_files:
+            assert sharding_kwargs is not None or os.path.isfile(output_file), f"Cannot resume, output file {output_file} does not exist"
+        logging.info(f"Resuming from input byte {resume_checkpoint['input_offset']} with {resume_checkpoint['written_lines']} lines already written")
+    else:
+        for output_file in output_files:
+            if output_exists(output_file):
+                assert args.force_overwrite, f"Cannot overwrite {output_file}, add -f option if you are cocky"
+            if os.path.isfile(output_file):
+                os.remove(output_file)
+        remove_checkpoint(checkpoint_file)
+    start_offset = resume_checkpoint['input_offset'] if resume_checkpoint is not None else 0
+
+    if args.pack_in_workers:
+        assert args.sharded_input and args.separate_documents and args.fill_for_tokenizer is not None, (
+            "Packing in workers requires --sharded_input, --separate_documents and --fill_for_tokenizer"
+        )
 
-    logging.info("Spawning producer")
-    filler_process = Process(target=filler, args=(args.input_file, in_queues, args.processes))
+    # the tokenizer is loaded once here and shared with the workers
+    tokenizer = share_tokenizer(args.fill_for_tokenizer)
+
+    # a fast tokenizer encodes a batch in parallel native threads, releasing the GIL: with the threads engine a single
+    # tokenizer is fed by a reader thread and read by a writer thread of this process, so nothing is copied between
+    # processes. slow tokenizers hold the GIL while encoding, so they still need a process each
+    if args.engine == 'threads':
+        assert not args.sharded_input, "Sharded input is available only with the processes engine"
+        if tokenizer is not None:
+            # the native thread pool is sized when the tokenizer encodes its first batch
+            os.environ.setdefault('RAYON_NUM_THREADS', str(args.processes))
+            if not tokenizer.get().is_fast:
+                logging.warning(f"Tokenizer {args.fill_for_tokenizer} is not a fast tokenizer, falling back to the processes engine")
+                args.engine = 'processes'
+    threaded = args.engine == 'threads'
+    n_workers = 1 if threaded else args.processes
+
+    # threads of this process take the place of the processes with the threads engine
+    def spawn(target, args, kwargs):
+        if threaded:
+            return threading.Thread(target=target, args=args, kwargs=kwargs, daemon=True)
+        return Process(target=target, args=args, kwargs=kwargs)
+
+    vocab_size = None
+    if args.output_format == 'bin':
+        assert args.fill_for_tokenizer is not None, "Binary output requires a tokenizer, set --fill_for_tokenizer"
+        vocab_size = len(tokenizer.get())
+        logging.info(f"Writing token ids with a vocabulary of {vocab_size} tokens")
+
+    length_cache_folder = None
+    if args.length_cache is not None and args.fill_for_tokenizer is not None:
+        if args.output_format == 'bin':
+            logging.warning("Length cache is not used when writing token ids")
+        else:
+            length_cache_folder = get_cache_folder(args.length_cache, args.fill_for_tokenizer)
+            logging.info(f"Consolidating length cache in {length_cache_folder}")
+            consolidate_cache(length_cache_folder)
+
+    logging.info("Creating queues")
+    # queues are bounded so that a slow writer blocks the workers instead of filling the memory
+    out_queues = [(queue.Queue if threaded else Queue)(maxsize=args.queue_size) for _ in range(n_workers)]
+    queues = {'output': out_queues}
+
+    # counters of every process, shared with the main process that reports them
+    registry = None
+    if args.metrics_file is not None:
+        process_names = ([] if args.sharded_input else ['filler']) + [f"worker-{i}" for i in range(n_workers)] + ['writer']
+        registry = MetricsRegistry(process_names)
+
+    def get_metrics(name):
+        return registry.get(name) if registry is not None else None
+
+    # shards of an input manifest are read one after the other, offsets are in their concatenation
+    input_files = get_input_offsets(args.input_file)
+
+    if args.sharded_input:
+        logging.info("Splitting input file in shards")
+        # shards do not depend on where the run is resumed, the first is eventually cut at the resume offset.
+        # shards of an input manifest start with a new document, so they are split further on their own
+        shards = [
+            (filename, file_offset, start, end)
+            for filename, file_offset in input_files
+            for start, end in clip_ranges(get_document_aligned_ranges(filename, args.shard_size), start_offset - file_offset)
+        ]
+        logging.info(f"Input file split in {len(shards)} shards")
+        filler_process = None
+
+        # documents are independent, so each worker can pack the documents of its shards
+        packer_kwargs = {
+            'target_len': args.target_len,
+            'separate_documents': args.separate_documents,
+            'no_split_long_paragraphs': args.no_split_long_paragraphs,
+            'token_ids': args.output_format == 'bin'
+        } if args.pack_in_workers else None
+
+        logging.info("Spawning workers")
+        # shards are assigned round-robin so that the writer can read them back in order
+        workers = [
+            Process(target=shard_worker,
+                    args=(list(enumerate(shards))[i::args.processes], out_queues[i]),
+                    kwargs={'tokenizer': tokenizer,
+                            'accumulate': args.batch_tokenization,
+                            'return_ids': args.output_format == 'bin',
+                            'packer_kwargs': packer_kwargs,
+                            'length_cache_folder': length_cache_folder,
+                            'metrics': get_metrics(f"worker-{i}")}) for i in range(args.processes)]
+    else:
+        in_queues = [(queue.Queue if threaded else Queue)(maxsize=args.queue_size) for _ in range(n_workers)]
+        queues['input'] = in_queues
+
+        logging.info("Spawning producer")
+        filler_process = spawn(target=filler,
+                               args=(input_files, in_queues, n_workers),
+                               kwargs={'accumulate': args.batch_tokenization,
+                                       'start_offset': start_offset,
+                                       'metrics': get_metrics('filler')})
+
+        logging.info("Spawning workers")
+        workers = [
+            spawn(target=worker,
+                  args=(in_queues[i], out_queues[i]),
+                  kwargs={'tokenizer': tokenizer,
+                          'return_ids': args.output_format == 'bin',
+                          'length_cache_folder': length_cache_folder,
+                          'metrics': get_metrics(f"worker-{i}")}) for i in range(n_workers)]
+
+    reporter = None
+    if registry is not None:
+        logging.info(f"Writing metrics to {args.metrics_file} every {args.metrics_interval} seconds")
+        reporter = MetricsReporter(registry, queues, args.metrics_file, metrics_format=args.metrics_format,
+                                   interval=args.metrics_interval, script='create_dataset')
+        reporter.start()
 
-    logging.info("Spawning workers")
-    workers = [
-        Process(target=worker,
-                args=(in_queues[i], out_queues[i]),
-                kwargs={'tokenizer_name': args.fill_for_tokenizer, 'accumulate': args.batch_tokenization}) for i in range(args.processes)]
-    
     logging.info("Starting workers")
     for w in workers:
         w.start()
 
-    logging.info("Starting producer")
-    filler_process.start()
+    if filler_process is not None:
+        logging.info("Starting producer")
+        filler_process.start()
 
     logging.info("Spawning writer")
-    writer_process = Process(target=writer, 
-                             args=(out_queues, args.output_file, args.processes), 
+    writer_process = spawn(target=writer,
+                             args=(out_queues, args.output_file),
                              kwargs={'limit': args.limit,
                                       'min_word_per_sentence': args.min_word_per_sentence,
                                       'separate_documents': args.separate_documents,
                                       'target_len': args.target_len,
-                                      'no_split_long_paragraphs': args.no_split_long_paragraphs
+                                      'no_split_long_paragraphs': args.no_split_long_paragraphs,
+                                      'output_format': args.output_format,
+                                      'vocab_size': vocab_size,
+                                      'packed_by_workers': args.pack_in_workers,
+                                      # parquet files are valid only once they are closed, so no checkpoint is saved
+                                      'checkpoint_file': checkpoint_file if args.output_format != 'parquet' else None,
+                                      'checkpoint_interval': args.checkpoint_interval,
+                                      'checkpoint_config': checkpoint_config,
+                                      'resume_checkpoint': resume_checkpoint,
+                                      'sharding_kwargs': sharding_kwargs,
+                                      'row_group_mb': args.row_group_mb,
+                                      'metrics': get_metrics('writer')
                                     }
                             )
 
@@ -227,11 +653,16 @@ def main(args):
 
     logging.info("Waiting for processes to finish")
     writer_process.join()
+    if reporter is not None:
+        reporter.stop()
+    # daemon threads end with this process
+    if threaded:
+        return
     for w in workers:
         if w.is_alive():
             w.terminate()
 
-    if filler_process.is_alive():
+    if filler_process is not None and filler_process.is_alive():
         filler_process.terminate()
 
 
@@ -241,7 +672,7 @@ if __name__ == "__main__":
 
     # Global level parameters
     parser.add_argument('-i', '--input_file', type=str, required=True,
-                        help="Preprocessed dataset")
+                        help="Preprocessed dataset, or the manifest of a sharded one")
     parser.add_argument('-l', '--limit', type=int, required=False, default=None,
                         help='Limit of rows in output file')
     parser.add_argument('-m', '--min_word_per_sentence', type=int, required=False, default=1,
@@ -259,6 +690,30 @@ if __name__ == "__main__":
     parser.add_argument('--target_len', type=int, default=128, required=False)
     parser.add_argument('--batch_tokenization', type=int, default=1024, required=False)
     parser.add_argument('--no_split_long_paragraphs', action="store_true")
+    parser.add_argument('--output_format', type=str, default='tsv', required=False, choices=['tsv', 'bin', 'parquet'],
+                        help="Write text rows to a tsv file, packed token ids to .bin and .idx files or text rows to a parquet file")
+    parser.add_argument('--row_group_mb', type=int, default=ROW_GROUP_MB, required=False,
+                        help="Approximate MB of text in each row group of parquet output")
+    parser.add_argument('--pack_in_workers', action="store_true",
+                        help="Pack documents in the workers, the writer only writes rows in order. "
+                             "Requires --sharded_input and --separate_documents")
+    parser.add_argument('--length_cache', type=str, default=None, required=False,
+                        help="Folder where lengths of tokenized paragraphs are cached and reused by later runs with the same tokenizer")
+    parser.add_argument('--checkpoint_interval', type=int, default=300, required=False,
+                        help="Seconds between checkpoints of the run, saved to <output_file>.checkpoint.json")
+    parser.add_argument('--resume', action="store_true",
+                        help="Resume an interrupted run from its last checkpoint")
+    parser.add_argument('--queue_size', type=int, default=8, required=False,
+                        help="Maximum number of batches waiting in each queue between the processes")
+    parser.add_argument('--engine', type=str, default='processes', required=False, choices=['processes', 'threads'],
+                        help="Tokenize in parallel processes, each with its own tokenizer, or with a single fast tokenizer "
+                             "that encodes batches with --processes native threads, fed and read by threads of the main process")
+    parser.add_argument('--sharded_input', action="store_true",
+                        help="Let each worker read its own byte ranges of the input instead of using a single reader process")
+    parser.add_argument('--shard_size', type=int, default=64 * 1024 * 1024, required=False,
+                        help="Approximate size in bytes of each input shard, shards are aligned to document boundaries")
+    add_sharded_output_arguments(parser)
+    add_metrics_arguments(parser)
 
     # get NameSpace of paramters
     args = parser.parse_args()
@@ -0,0 +1,213 @@
+import csv
+import io
+import json
+import logging
+import os
+import threading
+from argparse import ArgumentParser
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from typing import Dict, Iterator, List
+
+import numpy as np
+from tqdm import tqdm
+
+from compressed_io import open_file
+from sharding import get_input_shards, read_tsv_rows
+from shared_tokenizer import LazyTokenizer, share_tokenizer
+from tokenized_dataset import TokenizedDataset
+from tsv_index import count_rows, locate_rows
+
+
+FORMAT_LOGGING = '%(levelname)s: %(message)s'
+logging.basicConfig(format=FORMAT_LOGGING)
+logging.getLogger().setLevel(logging.INFO)
+csv.field_size_limit(csv.field_size_limit() * 3)
+
+PERCENTILES = [1, 5, 25, 50, 75, 90, 95, 99]
+
+# tokenizer of each worker process
+tokenizer = None
+
+
+def init_tokenizer(shared_tokenizer: LazyTokenizer):
+    global tokenizer
+    tokenizer = shared_tokenizer
+
+
+# length of a batch of texts in tokens, special tokens included, or in words if no tokenizer is given
+def get_lengths(texts: List[str]) -> np.ndarray:
+    texts = [text.strip() for text in texts]
+    if tokenizer is None:
+        return np.array([len(text.split(" ")) for text in texts], dtype=np.int64)
+    return np.array(tokenizer(texts, return_attention_mask=False, return_token_type_ids=False, return_length=True)['length'], dtype=np.int64)
+
+
+# streaming statistics of lengths, kept as the number of rows with each length.
+# percentiles and histograms are exact and memory does not depend on the number of rows
+class LengthStatistics:
+
+    def __init__(self):
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, lengths: np.ndarray):
+        counts = np.bincount(lengths)
+        if len(counts) > len(self.counts):
+            counts[:len(self.counts)] += self.counts
+            self.counts = counts
+        else:
+            self.counts[:len(counts)] += counts
+
+    @property
+    def rows(self) -> int:
+        return int(self.counts.sum())
+
+    def percentile(self, q: float) -> int:
+        cumulative = np.cumsum(self.counts)
+        return int(np.searchsorted(cumulative, q / 100 * cumulative[-1]))
+
+    def report(self, target_len: int = None, bins: int = 20) -> Dict:
+        lengths = np.arange(len(self.counts))
+        rows = self.rows
+        assert rows > 0, "No rows to compute statistics on"
+
+        total = int((self.counts * lengths).sum())
+        mean = total / rows
+        res = {
+            'rows': rows,
+            'total': total,
+            'mean': mean,
+            'std': float(np.sqrt((self.counts * (lengths - mean) ** 2).sum() / rows)),
+            'min': int(np.flatnonzero(self.counts)[0]),
+            'max': int(len(self.counts) - 1),
+            'percentiles': {str(q): self.percentile(q) for q in PERCENTILES},
+        }
+
+        edges = np.unique(np.linspace(0, len(self.counts), bins + 1).astype(np.int64))
+        res['histogram'] = [
+            {'from': int(start), 'to': int(end), 'rows': int(self.counts[start:end].sum())} for start, end in zip(edges[:-1], edges[1:])
+        ]
+
+        # share of the target length filled by the rows and rows that would be truncated
+        if target_len is not None:
+            res['target_len'] = target_len
+            res['fill_ratio'] = float((self.counts * np.minimum(lengths, target_len)).sum() / (rows * target_len))
+            res['over_target'] = float(self.counts[target_len + 1:].sum() / rows)
+        return res
+
+
+def print_report(report: Dict, unit: str):
+    print(f"Rows: {report['rows']}, {unit}: {report['total']}")
+    print(f"Average {unit} per row: {report['mean']:.2f} (std {report['std']:.2f}, min {report['min']}, max {report['max']})")
+    print("Percentiles: " + ", ".join(f"p{q}={v}" for q, v in report['percentiles'].items()))
+    if 'fill_ratio' in report:
+        print(f"Fill ratio against target length {report['target_len']}: {report['fill_ratio']:.4f}, "
+              f"rows longer than target: {report['over_target']:.4f}")
+
+    print("Histogram:")
+    largest = max(bucket['rows'] for bucket in report['histogram'])
+    for bucket in report['histogram']:
+        bar = '#' * int(round(50 * bucket['rows'] / largest)) if largest > 0 else ''
+        print(f"  [{bucket['from']:>6}, {bucket['to']:>6}) {bucket['rows']:>10} {bar}")
+
+
+# texts of the given column of all the rows of a tsv file or of the shards of a manifest
+def read_all_texts(input_file: str, column: int) -> Iterator[str]:
+    for row in read_tsv_rows(input_file):
+        yield row[column]
+
+
+# texts of `sample` rows drawn at random: rows are counted (or read from the manifest) and located with
+# a scan of the files, then only the sampled rows are read and parsed
+def read_sampled_texts(input_file: str, column: int, sample: int, seed: int) -> Iterator[str]:
+    shards = [(filename, rows if rows is not None else count_rows(filename)) for filename, rows in get_input_shards(input_file)]
+    starts = np.cumsum([0] + [rows for _, rows in shards])
+    indices = np.sort(np.random.default_rng(seed).choice(starts[-1], min(sample, starts[-1]), replace=False))
+
+    for (filename, _), start, end in zip(shards, starts[:-1], starts[1:]):
+        local = indices[(indices >= start) & (indices < end)] - start
+        ranges = locate_rows(filename, local)
+        with open_file(filename, 'rb', threaded=False) as in_file:
+            for row_start, row_end in ranges:
+                in_file.seek(row_start)
+                raw = in_file.read(row_end - row_start).decode('utf-8')
+                row = next(csv.reader(io.StringIO(raw, newline=None), delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL))
+                yield row[column]
+
+
+# read batches of texts, waiting for a free slot before reading the next one
+def yield_batches(texts: Iterator[str], batch_size: int, slots: threading.Semaphore):
+    while True:
+        batch = list(islice(texts, batch_size))
+        if len(batch) == 0:
+            break
+        slots.acquire()
+        yield batch
+
+
+def main(args):
+
+    stats = LengthStatistics()
+
+    # rows of pre-tokenized datasets already have a length in tokens
+    if os.path.splitext(args.input_file)[1] in ('.bin', '.idx'):
+        dataset = TokenizedDataset(args.input_file)
+        lengths = np.diff(dataset.offsets)
+        if args.sample is not None:
+            lengths = np.random.default_rng(args.seed).choice(lengths, min(args.sample, len(lengths)), replace=False)
+        stats.add(lengths)
+        unit = 'tokens'
+
+    else:
+        if args.sample is not None:
+            texts = read_sampled_texts(args.input_file, args.column, args.sample, args.seed)
+        else:
+            texts = read_all_texts(args.input_file, args.column)
+
+        # batches are tokenized in parallel, at most two per process are waiting in memory
+        slots = threading.Semaphore(2 * args.processes)
+        with Pool(args.processes, initializer=init_tokenizer, initargs=(share_tokenizer(args.tokenizer),)) as p:
+            with tqdm(desc="Measuring rows", total=args.sample) as pbar:
+                for lengths in p.imap(get_lengths, yield_batches(texts, args.batch_size, slots)):
+                    slots.release()
+                    stats.add(lengths)
+                    pbar.update(len(lengths))
+        unit = 'tokens' if args.tokenizer is not None else 'words'
+
+    report = stats.report(target_len=args.target_len, bins=args.bins)
+    report['unit'] = unit
+    print_report(report, unit)
+
+    if args.output_json is not None:
+        with open(args.output_json, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser("Measure the distribution of the lengths of the rows of a dataset in tokens or words")
+
+    # Global level parameters
+    parser.add_argument('-i', '--input_file', type=str, required=True,
+                        help="Dataset created by create_dataset.py, its manifest if sharded or its .bin/.idx files")
+    parser.add_argument('--tokenizer', type=str, default=None, required=False,
+                        help="Path of some pre-trained tokenizer, if omitted lengths are measured in words")
+    parser.add_argument('--column', default=1, required=False, type=int, help="Column id of the sentences")
+    parser.add_argument('--sample', default=None, required=False, type=int,
+                        help="Number of rows drawn at random from the whole dataset, by default all rows are measured")
+    parser.add_argument('--seed', default=999, required=False, type=int, help="Seed used to sample rows")
+    parser.add_argument('--target_len', default=None, required=False, type=int,
+                        help="Target length used to create the dataset, to report how much of it rows fill")
+    parser.add_argument('--bins', default=20, required=False, type=int, help="Number of bins of the histogram")
+    parser.add_argument('--processes', default=cpu_count(), required=False, type=int,
+                        help="Number of processes tokenizing rows in parallel")
+    parser.add_argument('--batch_size', default=1000, required=False, type=int,
+                        help="Number of rows tokenized at once by a process")
+    parser.add_argument('--output_json', default=None, required=False, type=str,
+                        help="Also save statistics to this json file")
+
+    # get NameSpace of paramters
+    args = parser.parse_args()
+
+    assert os.path.isfile(args.input_file), f"File {args.input_file} does not exist"
+
+    main(args)
@@ -0,0 +1,464 @@
+import io
+import logging
+import os
+import threading
+import time
+import zlib
+from argparse import ArgumentParser
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import numpy as np
+from tqdm import tqdm
+
+from compressed_io import open_file
+from file_utils import save_json
+from length_cache import hash_paragraphs
+from metrics import ScriptMetrics, TimedTask, add_metrics_arguments
+from preprocess import get_blocks
+from shared_tokenizer import load_tokenizer
+from sharding import (
+    add_sharded_output_arguments,
+    get_input_size,
+    get_sharding_kwargs,
+    is_manifest,
+    open_output,
+    output_exists
+)
+
+
+FORMAT_LOGGING = '%(levelname)s: %(message)s'
+logging.basicConfig(format=FORMAT_LOGGING)
+logging.getLogger().setLevel(logging.INFO)
+
+# minhash values are multiply-shift hashes of 32-bit shingle hashes: the high 32 bits of a * x + b modulo 2**64,
+# with random 64-bit multipliers and offsets, that need no division
+MAX_HASH = np.uint64((1 << 32) - 1)
+SHINGLE_MULTIPLIER = np.uint64(0x100000001b3)
+# number of shingles whose minhash values are computed at once, to bound the memory of a worker
+MINHASH_CHUNK = 16 * 1024
+
+
+# splitmix64 finalizer, to spread the bits of keys built by combining values
+def mix64(keys: np.ndarray) -> np.ndarray:
+    keys = keys ^ (keys >> np.uint64(30))
+    keys = keys * np.uint64(0xbf58476d1ce4e5b9)
+    keys = keys ^ (keys >> np.uint64(27))
+    keys = keys * np.uint64(0x94d049bb133111eb)
+    return keys ^ (keys >> np.uint64(31))
+
+
+# set of 64-bit keys in a numpy array with open addressing and linear probing, where 0 marks an empty slot.
+# it takes about 14 bytes per key and doubles its size when it is 75% full
+class HashSet64:
+
+    def __init__(self, capacity: int = 1 << 20, max_load: float = 0.75):
+        assert capacity > 0 and capacity & (capacity - 1) == 0, "Capacity must be a power of 2"
+        self.table = np.zeros(capacity, dtype=np.uint64)
+        self.max_load = max_load
+        self.size = 0
+
+    # insert distinct non-zero keys, returning which of them were already in the set
+    def _insert(self, keys: np.ndarray) -> np.ndarray:
+        mask = np.uint64(len(self.table) - 1)
+        slots = keys & mask
+        present = np.zeros(len(keys), dtype=bool)
+        pending = np.arange(len(keys))
+        while len(pending) > 0:
+            current = self.table[slots[pending]]
+            done = current == keys[pending]
+            present[pending[done]] = True
+
+            # keys probing the same empty slot take it one at a time
+            empty = np.flatnonzero(current == 0)
+            if len(empty) > 0:
+                _, first = np.unique(slots[pending[empty]], return_index=True)
+                winners = pending[empty[first]]
+                self.table[slots[winners]] = keys[winners]
+                done[empty[first]] = True
+
+            pending = pending[~done]
+            slots[pending] = (slots[pending] + np.uint64(1)) & mask
+
+        self.size += int(len(keys) - present.sum())
+        return present
+
+    def _grow(self, size: int):
+        capacity = len(self.table)
+        while size > self.max_load * capacity:
+            capacity *= 2
+        if capacity > len(self.table):
+            keys = self.table[self.table != 0]
+            self.table = np.zeros(capacity, dtype=np.uint64)
+            self.size = 0
+            self._insert(keys)
+
+    # add keys in order, returning for each of them whether it was added before, also earlier in the same call
+    def add(self, keys: np.ndarray) -> np.ndarray:
+        # 0 marks empty slots, a key is confused with 1 only with probability 2**-64
+        keys = np.maximum(keys.astype(np.uint64), np.uint64(1))
+        unique, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        self._grow(self.size + len(unique))
+        seen = self._insert(unique)[inverse]
+        seen[np.setdiff1d(np.arange(len(keys)), first, assume_unique=True)] = True
+        return seen
+
+    def memory(self) -> int:
+        return self.table.nbytes
+
+
+# bloom filter of 64-bit keys with a fixed size, whose bit positions are derived from the key by double hashing.
+# keys are never missed, while new keys are reported as added before with the false positive rate of the filter
+class BloomFilter:
+
+    def __init__(self, size_bytes: int, num_hashes: int = 7):
+        assert size_bytes > 0 and num_hashes > 0, "Bloom filters need a positive size and number of hashes"
+        self.bits = np.zeros(size_bytes, dtype=np.uint8)
+        self.num_bits = np.uint64(size_bytes * 8)
+        self.num_hashes = num_hashes
+        self.size = 0
+
+    def _positions(self, keys: np.ndarray) -> np.ndarray:
+        step = mix64(keys) | np.uint64(1)
+        return np.stack([(keys + np.uint64(i) * step) % self.num_bits for i in range(self.num_hashes)], axis=1)
+
+    # add keys in order, returning for each of them whether it was added before, also earlier in the same call
+    def add(self, keys: np.ndarray) -> np.ndarray:
+        unique, first, inverse = np.unique(keys.astype(np.uint64), return_index=True, return_inverse=True)
+        positions = self._positions(unique)
+        bytes_, bits = positions >> np.uint64(3), (positions & np.uint64(7)).astype(np.uint8)
+        present = np.all(self.bits[bytes_] & (np.uint8(1) << bits) != 0, axis=1)
+        np.bitwise_or.at(self.bits, bytes_.ravel(), np.uint8(1) << bits.ravel())
+
+        self.size += int(len(unique) - present.sum())
+        seen = present[inverse]
+        seen[np.setdiff1d(np.arange(len(keys)), first, assume_unique=True)] = True
+        return seen
+
+    # probability that a new key is reported as added before, given the keys added so far
+    def false_positive_rate(self) -> float:
+        return float((1 - np.exp(-self.num_hashes * self.size / float(self.num_bits))) ** self.num_hashes)
+
+    def memory(self) -> int:
+        return self.bits.nbytes
+
+
+def create_index(index: str, bloom_mb: int, bloom_hashes: int):
+    if index == 'bloom':
+        return BloomFilter(bloom_mb * 1024 * 1024, num_hashes=bloom_hashes)
+    return HashSet64()
+
+
+# odd multipliers and offsets of the universal hashes that approximate `num_perm` random permutations
+def get_permutations(num_perm: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 1 << 64, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 1 << 64, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+# 32-bit hashes of the shingles of `shingle_size` consecutive lowercased words of each paragraph.
+# paragraphs shorter than a shingle have a single shingle with all their words.
+# return the hashes of all the shingles and the index of the first shingle of each paragraph
+def get_shingles(texts: List[str], shingle_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    counts = np.zeros(len(texts), dtype=np.int64)
+    words = []
+    for i, text in enumerate(texts):
+        hashes = list(map(zlib.crc32, text.lower().encode('utf-8').split()))
+        counts[i] = len(hashes)
+        words.extend(hashes)
+    words = np.array(words, dtype=np.uint64)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    # shingles start at every word that leaves room for a full shingle, or at the first word of short paragraphs
+    paragraph = np.repeat(np.arange(len(texts)), counts)
+    positions = np.arange(len(words))
+    valid = (positions + shingle_size <= ends[paragraph]) | (positions == starts[paragraph])
+    shingles = np.zeros(len(words), dtype=np.uint64)
+    for j in range(shingle_size):
+        inside = positions + j < ends[paragraph]
+        factor = np.uint64(pow(int(SHINGLE_MULTIPLIER), j, 1 << 64))
+        shingles[inside] += words[positions[inside] + j] * factor
+    shingles = (shingles ^ (shingles >> np.uint64(32))) & MAX_HASH
+
+    counts = np.bincount(paragraph[valid], minlength=len(texts))
+    return shingles[valid], np.cumsum(counts) - counts
+
+
+# minhash signature of each paragraph, combined in one 64-bit key for each of the `bands` bands.
+# paragraphs with a band key in common are candidate near-duplicates
+def get_band_keys(texts: List[str], shingle_size: int, bands: int, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    assert len(a) % bands == 0, "Number of permutations must be a multiple of the number of bands"
+    shingles, firsts = get_shingles(texts, shingle_size)
+    ends = np.append(firsts[1:], len(shingles))
+    signatures = np.zeros((len(texts), len(a)), dtype=np.uint64)
+
+    # paragraphs are processed in chunks of about MINHASH_CHUNK shingles. values of a permutation are contiguous,
+    # which makes the minimum over the shingles of each paragraph faster
+    start = 0
+    while start < len(texts):
+        end = max(int(np.searchsorted(firsts, firsts[start] + MINHASH_CHUNK, side='right')), start + 1)
+        values = a[:, None] * shingles[None, firsts[start]:ends[end - 1]]
+        values += b[:, None]
+        values >>= np.uint64(32)
+        signatures[start:end] = np.minimum.reduceat(values, firsts[start:end] - firsts[start], axis=1).T
+        start = end
+
+    rows = signatures.reshape(len(texts), bands, -1)
+    keys = np.zeros((len(texts), bands), dtype=np.uint64)
+    for r in range(rows.shape[2]):
+        keys = keys * SHINGLE_MULTIPLIER + rows[:, :, r]
+    return mix64(keys ^ mix64(np.arange(1, bands + 1, dtype=np.uint64))[None, :])
+
+
+# read the lines of a block of the input, as given by `preprocess.get_blocks`, and compute the keys of its paragraphs:
+# the 64-bit hash of their text and, for near-deduplication, their band keys. lines that are empty, with less than
+# `min_words` words or first of a document, its title in pre-processed wikipedia, are never removed and have no keys.
+# whether the first line of the block starts a document depends on the previous block, so it is left to the caller
+def hash_block(
+    block: Union[Tuple[str, int, int, int], Tuple[bytes, int]],
+    min_words: int = 0,
+    near_dedup: bool = False,
+    shingle_size: int = 5,
+    num_perm: int = 128,
+    bands: int = 16,
+    seed: int = 0
+):
+    if len(block) == 2:
+        data, end = block
+    else:
+        filename, start, end, file_offset = block
+        with open_file(filename, 'rb', threaded=False) as in_f:
+            in_f.seek(start)
+            data = in_f.read(end - start)
+        end += file_offset
+    # split lines with universal newlines, as when reading the file in text mode
+    lines = list(io.StringIO(data.decode('utf-8'), newline=None))
+
+    texts = [line.strip() for line in lines]
+    candidates = np.array([
+        i for i, text in enumerate(texts)
+        if len(text) > 0 and len(text.split()) >= min_words and (i == 0 or len(texts[i - 1]) > 0)
+    ], dtype=np.int64)
+    texts = [texts[i] for i in candidates]
+    hashes = hash_paragraphs(texts)
+    band_keys = None
+    if near_dedup:
+        band_keys = get_band_keys(texts, shingle_size, bands, *get_permutations(num_perm, seed)) if len(texts) > 0 else np.zeros((0, bands), dtype=np.uint64)
+    return lines, candidates, hashes, band_keys, end
+
+
+# counts of what was read and removed, in paragraphs, documents, bytes, words and, with a tokenizer, tokens
+class DedupReport:
+
+    def __init__(self, tokenizer=None):
+        self.tokenizer = tokenizer
+        self.counts = {
+            'paragraphs': 0, 'documents': 0, 'bytes': 0, 'words': 0,
+            'removed_exact_paragraphs': 0, 'removed_near_paragraphs': 0, 'removed_documents': 0,
+            'removed_bytes': 0, 'removed_words': 0
+        }
+        if tokenizer is not None:
+            self.counts['removed_tokens'] = 0
+
+    def add_removed(self, texts: List[str]):
+        if len(texts) == 0:
+            return
+        self.counts['removed_bytes'] += sum(len(text.encode('utf-8')) + 1 for text in texts)
+        self.counts['removed_words'] += sum(len(text.split()) for text in texts)
+        if self.tokenizer is not None:
+            lengths = self.tokenizer(texts, add_special_tokens=False, return_attention_mask=False,
+                                     return_token_type_ids=False, return_length=True)['length']
+            self.counts['removed_tokens'] += int(sum(lengths))
+
+    def log(self):
+        removed = self.counts['removed_exact_paragraphs'] + self.counts['removed_near_paragraphs']
+        share = removed / max(self.counts['paragraphs'], 1)
+        logging.info(f"Removed {removed} of {self.counts['paragraphs']} paragraphs ({share:.2%}): "
+                     f"{self.counts['removed_exact_paragraphs']} exact and {self.counts['removed_near_paragraphs']} near duplicates")
+        logging.info(f"Removed {self.counts['removed_documents']} of {self.counts['documents']} documents entirely, "
+                     f"{self.counts['removed_bytes']} of {self.counts['bytes']} bytes and {self.counts['removed_words']} of {self.counts['words']} words")
+        if self.tokenizer is not None:
+            logging.info(f"Removed {self.counts['removed_tokens']} tokens")
+
+
+def main(args):
+
+    logging.info(f'Deduplicating {args.input_file} to {args.output_file}...')
+
+    exact_index = create_index(args.index, args.bloom_mb, args.bloom_hashes)
+    near_index = create_index(args.index, args.bloom_mb, args.bloom_hashes) if args.near_dedup else None
+    report = DedupReport(load_tokenizer(args.tokenizer) if args.tokenizer is not None else None)
+    start_time = time.time()
+
+    # workers read blocks of the input and hash their paragraphs, in order of arrival the main process decides which
+    # ones were already seen and writes the others. at most two blocks per process are waiting in memory
+    slots = threading.Semaphore(2 * args.processes)
+    blocks = get_blocks(args.input_file, args.block_size, 0, slots)
+    hash_kwargs = {'min_words': args.min_words, 'near_dedup': args.near_dedup, 'shingle_size': args.shingle_size,
+                   'num_perm': args.num_perm, 'bands': args.bands, 'seed': args.seed}
+    hash_task = TimedTask(partial(hash_block, **hash_kwargs))
+
+    # a document is dropped, with the empty line that closes it, when all the paragraphs after its title are removed.
+    # the title is held until one of them is kept
+    kept_in_document, removed_in_document = 0, 0
+    held = []
+    document_start = True
+    input_offset = 0
+    with open_output(args.output_file, get_sharding_kwargs(args), document_separator="\n\n") as out_f:
+        with Pool(args.processes) as p, ScriptMetrics(args, 'dedup', pool=True) as metrics:
+            with tqdm(total=get_input_size(args.input_file), desc="Deduplicating file", unit='B', unit_scale=True) as pbar:
+                for lines, candidates, hashes, band_keys, end in metrics.results(p.imap(hash_task, blocks)):
+                    slots.release()
+                    pbar.update(end - input_offset)
+                    metrics.main.add('bytes', end - input_offset)
+                    metrics.main.add('lines', len(lines))
+                    input_offset = end
+
+                    # the first line of the block is the first of a document if the previous block ended with an empty line
+                    if document_start and len(candidates) > 0 and candidates[0] == 0:
+                        candidates, hashes = candidates[1:], hashes[1:]
+                        band_keys = band_keys[1:] if band_keys is not None else None
+                    if len(lines) > 0:
+                        document_start = len(lines[-1].strip()) == 0
+
+                    exact = exact_index.add(hashes)
+                    near = np.zeros(len(candidates), dtype=bool)
+                    if near_index is not None:
+                        near = near_index.add(band_keys.ravel()).reshape(band_keys.shape).any(axis=1) & ~exact
+                    removed = np.zeros(len(lines), dtype=bool)
+                    removed[candidates[exact | near]] = True
+                    report.counts['removed_exact_paragraphs'] += int(exact.sum())
+                    report.counts['removed_near_paragraphs'] += int(near.sum())
+
+                    output = []
+                    # titles and empty lines of dropped documents
+                    dropped = []
+                    for line, line_removed in zip(lines, removed.tolist()):
+                        text = line.strip()
+                        report.counts['bytes'] += len(line.encode('utf-8'))
+                        if len(text) == 0:
+                            if len(held) > 0 or kept_in_document > 0 or removed_in_document > 0:
+                                report.counts['documents'] += 1
+                            if kept_in_document == 0 and removed_in_document > 0:
+                                report.counts['removed_documents'] += 1
+                                dropped += [held_line.strip() for held_line in held] + [text]
+                            else:
+                                output += held
+                                output.append(line)
+                            kept_in_document, removed_in_document = 0, 0
+                            held = []
+                            continue
+
+                        report.counts['paragraphs'] += 1
+                        report.counts['words'] += len(text.split())
+                        if len(held) == 0 and kept_in_document == 0 and removed_in_document == 0:
+                            held.append(line)
+                        elif line_removed:
+                            removed_in_document += 1
+                        else:
+                            kept_in_document += 1
+                            output += held
+                            output.append(line)
+                            held = []
+                    report.add_removed([lines[i].strip() for i in np.flatnonzero(removed)] + dropped)
+                    metrics.main.add('rows', len(output))
+                    out_f.write("".join(output))
+
+        # last document may not be closed by an empty line
+        if len(held) > 0 or kept_in_document > 0 or removed_in_document > 0:
+            report.counts['documents'] += 1
+        if kept_in_document == 0 and removed_in_document > 0:
+            report.counts['removed_documents'] += 1
+            report.add_removed([held_line.strip() for held_line in held])
+        else:
+            out_f.write("".join(held))
+
+    report.log()
+    indexes = {'exact': exact_index, 'near': near_index}
+    for name, index in indexes.items():
+        if index is not None:
+            logging.info(f"Index of {name} duplicates holds {index.size} keys in {index.memory() / 1024 / 1024:.1f} MB")
+            if isinstance(index, BloomFilter):
+                logging.info(f"Estimated false positive rate of the {name} bloom filter: {index.false_positive_rate():.4%}")
+
+    if args.report_file is not None:
+        save_json(args.report_file, {
+            'input_file': os.path.abspath(args.input_file),
+            'output_file': os.path.abspath(args.output_file),
+            'seconds': time.time() - start_time,
+            **report.counts,
+            'indexes': {
+                name: {
+                    'keys': index.size,
+                    'memory_bytes': index.memory(),
+                    **({'false_positive_rate': index.false_positive_rate()} if isinstance(index, BloomFilter) else {})
+                } for name, index in indexes.items() if index is not None
+            },
+            'config': {key: value for key, value in vars(args).items() if key not in ('input_file', 'output_file', 'report_file')}
+        })
+        logging.info(f"Report written to {args.report_file}")
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser("Remove exact and near-duplicate paragraphs from a pre-processed file")
+
+    # Global level parameters
+    parser.add_argument('-i', '--input_file', type=str, required=True,
+                        help="Pre-processed file with a paragraph per line and empty lines between documents, or the manifest of a sharded output")
+    parser.add_argument('-o', '--output_file', type=str, required=False, default=None,
+                        help='Specify an output file, defaults to <input_file>-dedup')
+    parser.add_argument('-f', '--force_overwrite', action="store_true",
+                        help='Overwrite output file if it does already exist')
+    parser.add_argument('-p', '--processes', type=int, default=cpu_count(),
+                        help='Number of processes hashing paragraphs')
+    parser.add_argument('-b', '--block_size', type=int, default=4 * 1024 * 1024,
+                        help='Size in bytes of the blocks of input lines hashed by a process at once.')
+    parser.add_argument('--min_words', type=int, default=0,
+                        help='Paragraphs with less words are always kept')
+    parser.add_argument('--index', type=str, default='set', choices=['set', 'bloom'],
+                        help="Keep the keys of the paragraphs seen so far in an exact hash set, that grows by about 14 bytes per key, "
+                             "or in bloom filters of fixed size, that may remove a few unique paragraphs")
+    parser.add_argument('--bloom_mb', type=int, default=1024,
+                        help='Size in MB of each bloom filter, one for exact and one for near duplicates')
+    parser.add_argument('--bloom_hashes', type=int, default=7,
+                        help='Number of bits set for each key in the bloom filters')
+    parser.add_argument('--near_dedup', action="store_true",
+                        help='Also remove paragraphs similar to a previous one, found with MinHash-LSH')
+    parser.add_argument('--shingle_size', type=int, default=5,
+                        help='Number of consecutive words of the shingles compared by MinHash')
+    parser.add_argument('--num_perm', type=int, default=128,
+                        help='Number of MinHash permutations')
+    parser.add_argument('--bands', type=int, default=16,
+                        help='Number of LSH bands, paragraphs whose signatures are equal in a band are near duplicates. '
+                             'The Jaccard similarity above which paragraphs are likely removed is about (1 / bands) ** (bands / num_perm)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the MinHash permutations')
+    parser.add_argument('--tokenizer', type=str, default=None,
+                        help='Path of some pre-trained tokenizer, to report the number of tokens removed')
+    parser.add_argument('--report_file', type=str, default=None,
+                        help='Also save the counts of removed paragraphs, documents, bytes, words and tokens to this json file')
+    add_sharded_output_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+
+    assert os.path.isfile(args.input_file), (
+        f"Input file {args.input_file} does not exist"
+    )
+    assert args.num_perm % args.bands == 0, "--num_perm must be a multiple of --bands"
+
+    if args.output_file is None:
+        assert not is_manifest(args.input_file), "Output file must be specified when reading a manifest"
+        input_dump_file_in = Path(args.input_file)
+        args.output_file = input_dump_file_in.parent / f'{input_dump_file_in.stem}-dedup{input_dump_file_in.suffix}'
+
+    assert not output_exists(args.output_file) or args.force_overwrite, (
+        f"Output file {args.output_file} does already exist"
+    )
+
+    main(args)
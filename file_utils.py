@@ -0,0 +1,156 @@
+import json
+import os
+from typing import Dict, Iterator, List, Tuple
+
+from compressed_io import get_file_size, open_file
+
+
+# size of a file that is split in byte ranges, which must be plain or seekable zstandard
+def get_range_file_size(filename: str) -> int:
+    file_size = get_file_size(filename)
+    assert file_size is not None, f"File {filename} can only be read sequentially, use a plain or .zst file to split it in ranges"
+    return file_size
+
+
+# split a file in ranges of about `shard_size` bytes, each starting at the beginning of a document.
+# documents are separated by empty lines, so a range starts right after an empty line that follows some text
+def get_document_aligned_ranges(filename: str, shard_size: int) -> List[Tuple[int, int]]:
+    assert shard_size > 0, "Shard size must be a positive number of bytes"
+
+    file_size = get_range_file_size(filename)
+    offsets = [0]
+
+    with open_file(filename, 'rb', threaded=False) as in_fi:
+        for nominal in range(shard_size, file_size, shard_size):
+            if nominal <= offsets[-1]:
+                continue
+
+            # complete the line that contains the byte just before the nominal offset
+            in_fi.seek(nominal - 1)
+            position = nominal - 1 + len(in_fi.readline())
+
+            # the line preceding the first one we read is unknown, so it is not trusted as document content
+            previous_empty = True
+            while True:
+                line = in_fi.readline()
+                if not line:
+                    position = file_size
+                    break
+                position += len(line)
+                # same definition of empty line used when packing documents
+                empty = len(line.decode('utf-8', errors='ignore').strip()) == 0
+                if empty and not previous_empty:
+                    break
+                previous_empty = empty
+
+            if position >= file_size:
+                break
+            offsets.append(position)
+
+    offsets.append(file_size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+# split a file, from `start` to the end, in ranges of about `block_size` bytes, each ending at the end of a line
+def get_line_aligned_ranges(filename: str, block_size: int, start: int = 0) -> List[Tuple[int, int]]:
+    assert block_size > 0, "Block size must be a positive number of bytes"
+
+    file_size = get_range_file_size(filename)
+    ranges = []
+
+    with open_file(filename, 'rb', threaded=False) as in_fi:
+        position = start
+        while position < file_size:
+            end = position + block_size
+            if end >= file_size:
+                end = file_size
+            else:
+                # complete the line that contains the last byte of the block
+                in_fi.seek(end - 1)
+                end = end - 1 + len(in_fi.readline())
+            ranges.append((position, end))
+            position = end
+
+    return ranges
+
+
+# yield the lines of a file contained in the byte range [start, end).
+# if `with_positions`, yield also the offset of the end of each line
+def read_lines_in_range(filename: str, start: int, end: int, with_positions: bool = False) -> Iterator[str]:
+    with open_file(filename, 'rb') as in_fi:
+        in_fi.seek(start)
+        position = start
+        while position < end:
+            line = in_fi.readline()
+            if not line:
+                break
+            position += len(line)
+            yield (line.decode('utf-8'), position) if with_positions else line.decode('utf-8')
+
+
+# read a file that may be compressed, from `start` to the end, in blocks of about `block_size` bytes ending at the end
+# of a line. yield each block with the offset of its end, for inputs that cannot be split in ranges
+def read_line_aligned_blocks(filename: str, block_size: int, start: int = 0) -> Iterator[Tuple[bytes, int]]:
+    assert block_size > 0, "Block size must be a positive number of bytes"
+
+    with open_file(filename, 'rb') as in_fi:
+        in_fi.seek(start)
+        position = start
+        while True:
+            block = in_fi.read(block_size)
+            if not block:
+                break
+            if not block.endswith(b"\n"):
+                block += in_fi.readline()
+            position += len(block)
+            yield block, position
+
+
+# remove the ranges that end before `offset` and make the first remaining range start from it
+def clip_ranges(ranges: List[Tuple[int, int]], offset: int) -> List[Tuple[int, int]]:
+    return [(max(start, offset), end) for start, end in ranges if end > offset]
+
+
+# path of the checkpoint of a run writing to `output_file`
+def get_checkpoint_file(output_file: str) -> str:
+    return f"{output_file}.checkpoint.json"
+
+
+# temporary file where a json file is written before replacing it
+def get_tmp_file(filename: str) -> str:
+    return f"{filename}.tmp"
+
+
+# atomically write a json file, so that a run killed while saving still has the previous version.
+# the temporary file is removed if writing fails or is interrupted
+def save_json(filename: str, data: Dict):
+    tmp_file = get_tmp_file(filename)
+    try:
+        with open(tmp_file, 'w') as out_fi:
+            json.dump(data, out_fi)
+            out_fi.flush()
+            os.fsync(out_fi.fileno())
+        os.replace(tmp_file, filename)
+    except BaseException:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def save_checkpoint(checkpoint_file: str, state: Dict):
+    save_json(checkpoint_file, state)
+
+
+# a temporary file left by a run killed while saving the checkpoint is removed, the checkpoint is the last complete one
+def load_checkpoint(checkpoint_file: str) -> Dict:
+    if os.path.isfile(get_tmp_file(checkpoint_file)):
+        os.remove(get_tmp_file(checkpoint_file))
+    with open(checkpoint_file) as in_fi:
+        return json.load(in_fi)
+
+
+# remove the checkpoint of a run, if any, with its temporary file
+def remove_checkpoint(checkpoint_file: str):
+    for filename in (checkpoint_file, get_tmp_file(checkpoint_file)):
+        if os.path.isfile(filename):
+            os.remove(filename)
@@ -0,0 +1,149 @@
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import uuid
+from typing import Callable, List
+
+import numpy as np
+
+
+# records of the cache: 64-bit hash of the paragraph and its length in tokens
+RECORD_DTYPE = np.dtype([('key', '<u8'), ('length', '<u4')])
+# keys of all the previous runs, sorted, in the first row and their lengths in the second one, replaced at once by the
+# consolidation. rows are contiguous, so that keys are searched in a memory map of the file without copying them
+CACHE_FILE = 'cache.npy'
+# held exclusively while consolidating, and shared while creating a part
+LOCK_FILE = 'lock'
+# records appended by a worker, locked by it as long as it is running
+PART_PREFIX = 'part-'
+
+
+# folder of the cache for a given tokenizer, identified by its name, the transformers version
+# and, for local tokenizers, the content of their files
+def get_cache_folder(cache_dir: str, tokenizer_name: str) -> str:
+    import transformers
+
+    identity = hashlib.blake2b(digest_size=8)
+    identity.update(f"{tokenizer_name}\0{transformers.__version__}".encode('utf-8'))
+    if os.path.isdir(tokenizer_name):
+        for name in sorted(os.listdir(tokenizer_name)):
+            path = os.path.join(tokenizer_name, name)
+            if os.path.isfile(path):
+                identity.update(name.encode('utf-8'))
+                with open(path, 'rb') as in_fi:
+                    identity.update(in_fi.read())
+
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', os.path.basename(os.path.normpath(tokenizer_name)))
+    return os.path.join(cache_dir, f"{safe_name}-{identity.hexdigest()}")
+
+
+# 64-bit hashes of a list of paragraphs
+def hash_paragraphs(lines: List[str]) -> np.ndarray:
+    return np.array(
+        [int.from_bytes(hashlib.blake2b(line.encode('utf-8'), digest_size=8).digest(), 'little') for line in lines],
+        dtype=np.uint64
+    )
+
+
+# lock a file, without waiting unless `blocking`. False if it is locked by another process
+def lock_file(file, exclusive: bool = True, blocking: bool = True) -> bool:
+    try:
+        fcntl.flock(file, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if blocking else fcntl.LOCK_NB))
+        return True
+    except BlockingIOError:
+        return False
+
+
+# merge the parts of the workers that are gone into the sorted records of the cache.
+# runs starting together consolidate one at a time, and parts still locked by the workers of live runs are left
+# to a later consolidation, so that their new records are not lost
+def consolidate_cache(cache_folder: str):
+    os.makedirs(cache_folder, exist_ok=True)
+
+    with open(os.path.join(cache_folder, LOCK_FILE), 'a') as lock:
+        lock_file(lock)
+
+        parts = []
+        try:
+            for name in sorted(os.listdir(cache_folder)):
+                if name.startswith(PART_PREFIX):
+                    part = open(os.path.join(cache_folder, name), 'rb')
+                    if lock_file(part, blocking=False):
+                        parts.append(part)
+                    else:
+                        part.close()
+            if len(parts) == 0:
+                return
+
+            cache = [np.zeros((2, 0), dtype=np.uint64)]
+            if os.path.isfile(os.path.join(cache_folder, CACHE_FILE)):
+                cache.append(np.load(os.path.join(cache_folder, CACHE_FILE)))
+            for part in parts:
+                # a process killed while appending may have left an incomplete record
+                data = np.frombuffer(part.read(), dtype=np.uint8)
+                records = data[:len(data) - len(data) % RECORD_DTYPE.itemsize].view(RECORD_DTYPE)
+                cache.append(np.stack([records['key'], records['length'].astype(np.uint64)]))
+
+            cache = np.concatenate(cache, axis=1)
+            _, first = np.unique(cache[0], return_index=True)
+            cache = np.ascontiguousarray(cache[:, first])
+
+            # keys and lengths are replaced at once, so that runs loading the cache always read matching ones
+            tmp_file = os.path.join(cache_folder, f"tmp-{uuid.uuid4().hex}-{CACHE_FILE}")
+            with open(tmp_file, 'wb') as out_fi:
+                np.save(out_fi, cache)
+            os.replace(tmp_file, os.path.join(cache_folder, CACHE_FILE))
+
+            for part in parts:
+                os.remove(part.name)
+            logging.info(f"Length cache {cache_folder} contains {cache.shape[1]} paragraphs")
+        finally:
+            for part in parts:
+                part.close()
+
+
+# lengths of paragraphs computed by previous runs, new lengths are appended to a part file of this process
+class LengthCache:
+
+    def __init__(self, cache_folder: str):
+        self.cache_folder = cache_folder
+        cache = np.zeros((2, 0), dtype=np.uint64)
+        if os.path.isfile(os.path.join(cache_folder, CACHE_FILE)):
+            cache = np.load(os.path.join(cache_folder, CACHE_FILE), mmap_mode='r')
+        self.keys, self.lengths = cache
+        self.part_file = None
+
+    # lengths of the given paragraphs, computing with `compute_lengths` only those not in the cache
+    def get_lengths(self, lines: List[str], compute_lengths: Callable[[List[str]], List[int]]) -> List[int]:
+        hashes = hash_paragraphs(lines)
+        res = np.full(len(lines), -1, dtype=np.int64)
+
+        if len(self.keys) > 0:
+            positions = np.minimum(np.searchsorted(self.keys, hashes), len(self.keys) - 1)
+            found = self.keys[positions] == hashes
+            res[found] = self.lengths[positions[found]]
+
+        missing = np.flatnonzero(res < 0)
+        if len(missing) > 0:
+            computed = compute_lengths([lines[i] for i in missing])
+            res[missing] = computed
+            self.add(hashes[missing], res[missing])
+
+        return res.tolist()
+
+    def add(self, hashes: np.ndarray, lengths: np.ndarray):
+        records = np.empty(len(hashes), dtype=RECORD_DTYPE)
+        records['key'] = hashes
+        records['length'] = lengths
+
+        if self.part_file is None:
+            # the part is locked before a consolidation can see it, and stays locked until this process ends
+            with open(os.path.join(self.cache_folder, LOCK_FILE), 'a') as lock:
+                lock_file(lock, exclusive=False)
+                self.part_file = open(os.path.join(self.cache_folder, f"{PART_PREFIX}{os.getpid()}-{uuid.uuid4().hex}.bin"), 'ab')
+                lock_file(self.part_file)
+        # workers may be terminated at any time, so records are flushed immediately
+        self.part_file.write(records.tobytes())
+        self.part_file.flush()
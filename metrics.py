@@ -0,0 +1,341 @@
+import json
+import os
+import threading
+import time
+from argparse import ArgumentParser
+from multiprocessing.sharedctypes import RawArray
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+
+# counters kept by each process of a pipeline:
+#  - busy_seconds: time spent doing work, that is not waiting on a queue
+#  - wait_input_seconds / wait_output_seconds: time blocked reading from an input queue or writing to an output queue
+#  - tokenize_seconds / tokenize_batches: time spent in tokenizer calls and number of calls
+#  - lines, tokens, bytes, rows: lines processed, their tokens, input bytes read and output rows written
+FIELDS = [
+    'busy_seconds',
+    'wait_input_seconds',
+    'wait_output_seconds',
+    'tokenize_seconds',
+    'tokenize_batches',
+    'lines',
+    'tokens',
+    'bytes',
+    'rows',
+]
+FIELD_INDEX = {field: i for i, field in enumerate(FIELDS)}
+# the counters of each process are followed by its current state, an index in STATES, and the time when it began
+STATES = [None, 'busy_seconds', 'wait_input_seconds', 'wait_output_seconds']
+STATE_INDEX = len(FIELDS)
+SINCE_INDEX = len(FIELDS) + 1
+SLOT_SIZE = len(FIELDS) + 2
+SECONDS_FIELDS = ['busy_seconds', 'wait_input_seconds', 'wait_output_seconds']
+COUNT_FIELDS = ['lines', 'tokens', 'bytes', 'rows']
+METRICS_FORMATS = ['jsonl', 'prometheus']
+PROMETHEUS_PREFIX = 'prepare_datasets'
+# seconds between samples of the size of the queues
+QUEUE_SAMPLING_INTERVAL = 0.5
+
+
+def add_metrics_arguments(parser: ArgumentParser):
+    parser.add_argument('--metrics_file', type=str, default=None, required=False,
+                        help="Periodically write queue sizes, utilization of the processes and throughput to this file")
+    parser.add_argument('--metrics_format', type=str, default='jsonl', required=False, choices=METRICS_FORMATS,
+                        help="Append a json line for every report or rewrite a prometheus textfile with the last one")
+    parser.add_argument('--metrics_interval', type=float, default=10.0, required=False,
+                        help="Seconds between metrics reports")
+
+
+# counters of a single process, stored in memory shared with the process reporting them.
+# every process writes only its own counters, so no lock is needed. without shared memory all calls do nothing.
+# after `start`, a process is either busy or waiting on a queue: the current state and when it began are shared as well,
+# so that reports include the time spent in the current state
+class ProcessMetrics:
+
+    def __init__(self, values: RawArray = None, index: int = 0):
+        self.values = values
+        self.offset = index * SLOT_SIZE
+
+    def add(self, field: str, value: float):
+        if self.values is not None:
+            self.values[self.offset + FIELD_INDEX[field]] += value
+
+    # close the current state, adding its time to its counter, and begin a new one
+    def set_state(self, field: str):
+        if self.values is not None:
+            now = time.time()
+            current = STATES[int(self.values[self.offset + STATE_INDEX])]
+            if current is not None:
+                self.add(current, now - self.values[self.offset + SINCE_INDEX])
+            self.values[self.offset + STATE_INDEX] = STATES.index(field)
+            self.values[self.offset + SINCE_INDEX] = now
+
+    def started(self) -> bool:
+        return self.values is not None and self.values[self.offset + STATE_INDEX] > 0
+
+    def start(self):
+        self.set_state('busy_seconds')
+
+    def finish(self):
+        self.set_state(None)
+
+    # get from a queue, counting the time spent waiting as blocked on the input
+    def get(self, queue):
+        if not self.started():
+            return queue.get()
+        self.set_state('wait_input_seconds')
+        item = queue.get()
+        self.set_state('busy_seconds')
+        return item
+
+    # put to a queue, counting the time spent waiting as blocked on the output
+    def put(self, queue, item):
+        if not self.started():
+            return queue.put(item)
+        self.set_state('wait_output_seconds')
+        queue.put(item)
+        self.set_state('busy_seconds')
+
+    # iterate over results computed by other processes, counting the time spent waiting for them as blocked on the input
+    def iterate(self, results: Iterator):
+        if not self.started():
+            yield from results
+            return
+        results = iter(results)
+        while True:
+            self.set_state('wait_input_seconds')
+            try:
+                item = next(results)
+            except StopIteration:
+                return
+            finally:
+                self.set_state('busy_seconds')
+            yield item
+
+    # counters at time `now`, including the time spent in the current state
+    def snapshot(self, now: float) -> Dict[str, float]:
+        res = {field: self.values[self.offset + i] for i, field in enumerate(FIELDS)}
+        current = STATES[int(self.values[self.offset + STATE_INDEX])]
+        if current is not None:
+            res[current] += max(now - self.values[self.offset + SINCE_INDEX], 0.0)
+        return res
+
+
+# counters of all the processes of a pipeline, created before starting them.
+# `processes` are the names of the processes, each of them is given its own `ProcessMetrics` with `get`
+class MetricsRegistry:
+
+    def __init__(self, processes: List[str]):
+        self.processes = processes
+        self.values = RawArray('d', len(processes) * SLOT_SIZE)
+
+    def get(self, name: str) -> ProcessMetrics:
+        return ProcessMetrics(self.values, self.processes.index(name))
+
+    def snapshot(self, now: float) -> Dict[str, Dict[str, float]]:
+        return {name: self.get(name).snapshot(now) for name in self.processes}
+
+
+# size of a multiprocessing queue, None where the system does not provide it
+def get_queue_size(queue) -> int:
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return None
+
+
+# thread of the main process that samples the sizes of the queues between the processes and periodically writes a report
+# with the counters of the registry, either appending a json line or rewriting a prometheus textfile.
+# `queues` are lists of queues by role, for example {'input': in_queues, 'output': out_queues}
+class MetricsReporter:
+
+    def __init__(
+        self,
+        registry: MetricsRegistry,
+        queues: Dict[str, List],
+        filename: str,
+        metrics_format: str = 'jsonl',
+        interval: float = 10.0,
+        script: str = None
+    ):
+        assert metrics_format in METRICS_FORMATS, f"Metrics format must be one of {METRICS_FORMATS}"
+        assert interval > 0, "Metrics interval must be a positive number of seconds"
+
+        self.registry = registry
+        self.queues = queues
+        self.filename = filename
+        self.metrics_format = metrics_format
+        self.interval = interval
+        self.script = script
+
+        self.start_time = time.time()
+        self.last_time = self.start_time
+        self.last_snapshot = registry.snapshot(self.start_time)
+        self.queue_samples = {role: [[] for _ in queues[role]] for role in queues}
+
+        if metrics_format == 'jsonl' and os.path.isfile(filename):
+            os.remove(filename)
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        next_report = self.start_time + self.interval
+        while not self.stop_event.wait(min(QUEUE_SAMPLING_INTERVAL, self.interval)):
+            self.sample_queues()
+            if time.time() >= next_report:
+                self.report()
+                next_report += self.interval
+
+    # stop sampling and write a last report
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.sample_queues()
+        self.report()
+
+    def sample_queues(self):
+        for role, queues in self.queues.items():
+            for samples, queue in zip(self.queue_samples[role], queues):
+                size = get_queue_size(queue)
+                if size is not None:
+                    samples.append(size)
+
+    # queue sizes since the last report: last sample, mean and max
+    def queue_report(self) -> Dict[str, List[Dict]]:
+        res = {}
+        for role, queues in self.queue_samples.items():
+            res[role] = [
+                {'size': samples[-1], 'mean': sum(samples) / len(samples), 'max': max(samples)} if len(samples) > 0 else None
+                for samples in queues
+            ]
+            self.queue_samples[role] = [[] for _ in queues]
+        return res
+
+    def build_report(self) -> Dict:
+        now = time.time()
+        interval = max(now - self.last_time, 1e-9)
+        snapshot = self.registry.snapshot(now)
+
+        processes = {}
+        for name, values in snapshot.items():
+            previous = self.last_snapshot[name]
+            processes[name] = dict(values)
+            # share of the time since the last report that the process was busy or blocked
+            for field in SECONDS_FIELDS:
+                processes[name][field.replace('_seconds', '_ratio')] = (values[field] - previous[field]) / interval
+            if values['tokenize_batches'] > 0:
+                processes[name]['mean_tokenize_batch_seconds'] = values['tokenize_seconds'] / values['tokenize_batches']
+
+        totals = {field: sum(values[field] for values in snapshot.values()) for field in COUNT_FIELDS}
+        rates = {
+            f"{field}_per_second": (totals[field] - sum(values[field] for values in self.last_snapshot.values())) / interval
+            for field in COUNT_FIELDS
+        }
+
+        self.last_time = now
+        self.last_snapshot = snapshot
+        return {
+            'script': self.script,
+            'time': now,
+            'elapsed_seconds': now - self.start_time,
+            'queues': self.queue_report(),
+            'processes': processes,
+            'totals': totals,
+            'rates': rates,
+        }
+
+    def report(self):
+        report = self.build_report()
+        if self.metrics_format == 'jsonl':
+            with open(self.filename, 'a') as out_file:
+                out_file.write(json.dumps(report) + "\n")
+        else:
+            # textfiles are replaced atomically, so that the collector never reads a partial one
+            tmp_file = f"{self.filename}.tmp"
+            with open(tmp_file, 'w') as out_file:
+                out_file.write(format_prometheus(report))
+            os.replace(tmp_file, self.filename)
+
+
+# report in the prometheus text exposition format
+def format_prometheus(report: Dict) -> str:
+    lines = []
+    script = report['script'] or ''
+
+    def metric(name, kind, description, samples):
+        lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {description}")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}")
+        for labels, value in samples:
+            labels = ",".join(f'{key}="{label}"' for key, label in [('script', script)] + labels)
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}{{{labels}}} {value}")
+
+    metric('elapsed_seconds', 'gauge', "Seconds since the start of the run", [([], report['elapsed_seconds'])])
+    for key, description in (('size', "Items in the queue"), ('mean', "Mean items in the queue since the last report"),
+                             ('max', "Max items in the queue since the last report")):
+        metric(f'queue_{key}', 'gauge', description, [
+            ([('queue', role), ('index', str(i))], sizes[key])
+            for role, queues in report['queues'].items() for i, sizes in enumerate(queues) if sizes is not None
+        ])
+    for field in FIELDS:
+        metric(f'process_{field}_total', 'counter', f"Process {field.replace('_', ' ')}", [
+            ([('process', name)], values[field]) for name, values in report['processes'].items()
+        ])
+    for field in SECONDS_FIELDS:
+        ratio = field.replace('_seconds', '_ratio')
+        metric(f'process_{ratio}', 'gauge', f"Share of time {field.replace('_seconds', '').replace('_', ' ')} since the last report", [
+            ([('process', name)], values[ratio]) for name, values in report['processes'].items()
+        ])
+    for field in COUNT_FIELDS:
+        metric(f'{field}_per_second', 'gauge', f"{field.capitalize()} per second since the last report",
+               [([], report['rates'][f"{field}_per_second"])])
+    return "\n".join(lines) + "\n"
+
+
+# metrics of a script whose main process reads the input and writes the output, optionally handing tasks to a pool
+# of workers. workers do not share memory with the main process: they measure the time of each task and send it back
+# with its result, so that `workers` reports their busy time summed over all of them.
+# without `--metrics_file` all counters do nothing
+class ScriptMetrics:
+
+    def __init__(self, args, script: str, pool: bool = False):
+        self.registry = None
+        self.reporter = None
+        if args.metrics_file is not None:
+            self.registry = MetricsRegistry(['main'] + (['workers'] if pool else []))
+            self.reporter = MetricsReporter(self.registry, {}, args.metrics_file, metrics_format=args.metrics_format,
+                                            interval=args.metrics_interval, script=script)
+        self.main = self.registry.get('main') if self.registry is not None else ProcessMetrics()
+        self.workers = self.registry.get('workers') if pool and self.registry is not None else ProcessMetrics()
+
+    # results of tasks run by a pool with `TimedTask`, adding their time to the workers
+    def results(self, results: Iterator[Tuple[Any, float]]) -> Iterator:
+        for result, seconds in self.main.iterate(results):
+            self.workers.add('busy_seconds', seconds)
+            yield result
+
+    def __enter__(self):
+        if self.reporter is not None:
+            self.reporter.start()
+        self.main.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.main.finish()
+        if self.reporter is not None:
+            self.reporter.stop()
+
+
+# run `function` on a task in a worker of a pool, returning its result with the seconds it took
+class TimedTask:
+
+    def __init__(self, function: Callable):
+        self.function = function
+
+    def __call__(self, task) -> Tuple[Any, float]:
+        start = time.perf_counter()
+        result = self.function(task)
+        return result, time.perf_counter() - start
@@ -1,10 +1,31 @@
 import os
 from argparse import ArgumentParser
 import csv
+import io
 import json
+import shutil
+import tempfile
+from multiprocessing import Pool, cpu_count
 import logging
 import logging
+from functools import partial
+from itertools import islice
+import numpy as np
 from tqdm import tqdm
+from compressed_io import open_file
+from metrics import ProcessMetrics, ScriptMetrics, TimedTask, add_metrics_arguments
+from parquet_dataset import ROW_GROUP_MB, ParquetDatasetWriter
+from sharding import (
+    add_sharded_output_arguments,
+    get_input_shards,
+    get_sharding_kwargs,
+    is_manifest,
+    load_manifest,
+    open_output,
+    output_exists,
+    read_tsv_rows
+)
+from tsv_index import count_rows, iter_raw_rows
 
 
 FORMAT_LOGGING = '%(levelname)s: %(message)s'
@@ -16,10 +37,163 @@ def get_lang_from_wikipedia_filename(filename):
     """ Expected filename like `enwiki-dump-latest.tsv` ..."""
     return os.path.basename(filename).strip().lower().split("-")[0].replace("wiki", "")
 
+# number of rows of an input file, read from the manifest of sharded inputs
+def count_input_rows(filename):
+    if is_manifest(filename):
+        return load_manifest(filename)['rows']
+    return count_rows(filename)
+
+# yield the first `n` rows of a file, starting again from the beginning once they are over
+def cycle_rows(filename, n):
+    while True:
+        for line in islice(read_tsv_rows(filename), n):
+            yield line
+
+# write all the rows of each file, one file after the other
+def concatenate(args, lang_ids, writer, metrics: ProcessMetrics):
+    written_lines = 0
+    for filename, lang_id in tqdm(zip(args.input_files, lang_ids), desc="Processed files", position=0):
+
+        # remember the actual number of written lines
+        written_lines_file = 0
+        # input files may also be manifests of sharded datasets
+        filename_reader = read_tsv_rows(filename)
+
+        for line in tqdm(filename_reader, desc="Processing lines", position=1):
+            row = [written_lines, lang_id, line[1]] if lang_id is not None else [written_lines, line[1]]
+            writer.writerow(row)
+            metrics.add('rows', 1)
+            written_lines_file += 1
+            written_lines += 1
+
+            if args.limit and written_lines_file >= args.limit:
+                break
+
+        filename_reader.close()
+        logging.info(f"- Written {written_lines_file} lines from file {filename} with id {lang_id}")
+
+    return written_lines
+
+# read all the files at the same time and write blocks of rows of languages drawn with probabilities p ∝ n^alpha,
+# where n is the number of rows of a language. each language gets about p * total_rows rows, files of languages
+# that are upsampled are read again from the beginning. a block is drawn proportionally to the rows still missing
+# from each language, so languages are mixed evenly along the whole output
+def interleave(args, lang_ids, writer, metrics: ProcessMetrics):
+    counts = np.array([count_input_rows(filename) for filename in args.input_files], dtype=np.int64)
+    if args.limit:
+        counts = np.minimum(counts, args.limit)
+
+    probabilities = np.where(counts > 0, counts.astype(np.float64) ** args.alpha, 0.0)
+    probabilities /= probabilities.sum()
+    total_rows = args.total_rows if args.total_rows is not None else counts.sum()
+    targets = np.round(probabilities * total_rows).astype(np.int64)
+
+    for filename, lang_id, count, probability, target in zip(args.input_files, lang_ids, counts, probabilities, targets):
+        logging.info(f"- File {filename} with id {lang_id}: {count} lines, probability {probability:.4f}, "
+                     f"{target} lines to write ({target / count if count > 0 else 0:.2f}x)")
+
+    rng = np.random.default_rng(args.seed)
+    readers = [cycle_rows(filename, count) for filename, count in zip(args.input_files, counts)]
+    written = np.zeros(len(args.input_files), dtype=np.int64)
+    written_lines = 0
+
+    with tqdm(total=int(targets.sum()), desc="Interleaving lines") as pbar:
+        while True:
+            missing = targets - written
+            if missing.sum() == 0:
+                break
+
+            i = rng.choice(len(missing), p=missing / missing.sum())
+            block = min(args.block_size, missing[i])
+            for line in islice(readers[i], block):
+                row = [written_lines, lang_ids[i], line[1]] if lang_ids[i] is not None else [written_lines, line[1]]
+                writer.writerow(row)
+                written_lines += 1
+            written[i] += block
+            metrics.add('rows', block)
+            pbar.update(block)
+
+    return written_lines
+
+# write the first `rows` rows of a file to `part_file` with new ids starting from `first_id`, in a separate process.
+# the text field is copied as raw bytes and rows are parsed only if it is quoted or followed by other fields
+def rewrite_raw_rows(job):
+    filename, part_file, first_id, lang_id, rows = job
+    prefix = "" if lang_id is None else f"\t{lang_id}"
+
+    written_lines = 0
+    buffer = []
+    with open(part_file, 'wb') as out_file:
+        for raw in islice(iter_raw_rows(filename, progress=False), rows):
+            new_id = first_id + written_lines
+            text = raw[raw.find(b'\t') + 1:]
+            text = text[:-2] if text.endswith(b'\r\n') else text.rstrip(b'\n')
+
+            if b'"' in text or b'\t' in text:
+                # newlines are translated as when the file is read in text mode
+                line = next(csv.reader(io.StringIO(raw.decode('utf-8'), newline=None), delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL))
+                out = io.StringIO(newline='')
+                csv.writer(out, delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL).writerow(
+                    [new_id, lang_id, line[1]] if lang_id is not None else [new_id, line[1]]
+                )
+                buffer.append(out.getvalue().encode('utf-8'))
+            else:
+                buffer.append(f"{new_id}{prefix}\t".encode('utf-8') + text + b'\r\n')
+
+            written_lines += 1
+            if len(buffer) >= 10000:
+                out_file.write(b''.join(buffer))
+                buffer = []
+        out_file.write(b''.join(buffer))
+
+    return written_lines
+
+# same output of `concatenate`, produced by parallel processes. rows of each file (or shard of a manifest) are counted
+# first to get the id of their first row, then each file is rewritten to a temporary part and parts are concatenated
+def concatenate_raw(args, lang_ids, metrics: ScriptMetrics):
+    shards = [(filename, rows, i) for i, input_file in enumerate(args.input_files) for filename, rows in get_input_shards(input_file)]
+
+    with Pool(args.processes) as p:
+        to_count = [filename for filename, rows, _ in shards if rows is None]
+        logging.info(f"Counting rows of {len(to_count)} file(s)")
+        counts = iter(p.map(partial(count_rows, progress=False), to_count))
+        shards = [(filename, rows if rows is not None else next(counts), i) for filename, rows, i in shards]
+
+        # the limit applies to all the shards of an input file
+        jobs = []
+        taken = [0] * len(args.input_files)
+        first_id = 0
+        tmp_dir = args.tmp_dir if args.tmp_dir is not None else os.path.dirname(os.path.abspath(args.output_file))
+        with tempfile.TemporaryDirectory(dir=tmp_dir, prefix="multilingual-") as parts_dir:
+            for filename, rows, i in shards:
+                if args.limit:
+                    rows = min(rows, args.limit - taken[i])
+                taken[i] += rows
+                jobs.append((filename, os.path.join(parts_dir, f"part-{len(jobs)}.tsv"), first_id, lang_ids[i], rows))
+                first_id += rows
+
+            for written_lines, (filename, _, _, lang_id, rows) in zip(
+                metrics.results(p.imap(TimedTask(rewrite_raw_rows), jobs)), tqdm(jobs, desc="Rewritten files")
+            ):
+                assert written_lines == rows, f"File {filename} has {written_lines} rows instead of {rows}"
+                metrics.main.add('rows', written_lines)
+
+            for filename, lang_id, rows in zip(args.input_files, lang_ids, taken):
+                logging.info(f"- Written {rows} lines from file {filename} with id {lang_id}")
+
+            logging.info("Concatenating parts")
+            with open_file(args.output_file, 'wb') as out_file:
+                for _, part_file, _, _, _ in jobs:
+                    with open(part_file, 'rb') as in_file:
+                        shutil.copyfileobj(in_file, out_file, 16 * 1024 * 1024)
+                    os.remove(part_file)
+
+    return first_id
+
 def main(args):
 
     logging.info("Checking I/O files")
-    assert not os.path.isfile(args.output_file) or args.force_overwrite, (
+    assert not output_exists(args.output_file) or args.force_overwrite, (
         f"Cannot overwrite {args.output_file}, add -f option if you know what you are doing."
     )
     for f in args.input_files:
@@ -49,28 +223,28 @@ def main(args):
 
     logging.info(f"Creating dataset from {len(args.input_files)} input file(s)")
 
-    written_lines = 0
-    with open(args.output_file, "w") as out_file:
-        writer = csv.writer(out_file, delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    if args.mode == 'raw':
+        assert get_sharding_kwargs(args) is None, "Sharded output is not available with raw mode"
+        assert args.output_format == 'tsv', "Raw mode copies tsv rows, parquet output is not available"
+        with ScriptMetrics(args, 'multilingual_dataset', pool=True) as metrics:
+            written_lines = concatenate_raw(args, lang_ids, metrics)
+        logging.info(f"- Written a total of {written_lines}, done!")
+        return
 
-        for filename, lang_id in tqdm(zip(args.input_files, lang_ids), desc="Processed files", position=0):
-
-            # remember the actual number of written lines
-            written_lines_file = 0
-            with open(filename) as in_file:
-                filename_reader = csv.reader(in_file, delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-                for line in tqdm(filename_reader, desc="Processing lines", position=1):
-                    row = [written_lines, lang_id, line[1]] if lang_id is not None else [written_lines, line[1]]
-                    writer.writerow(row)
-                    written_lines_file += 1
-                    written_lines += 1
+    if args.output_format == 'parquet':
+        assert get_sharding_kwargs(args) is None, "Sharded output is available only for tsv files"
+        # parquet writers take the same rows of csv writers
+        writer = out_file = ParquetDatasetWriter(args.output_file, with_lang_id=lang_dict is not None, row_group_mb=args.row_group_mb)
+    else:
+        out_file = open_output(args.output_file, get_sharding_kwargs(args))
+        writer = csv.writer(out_file, delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL)
 
-                    if args.limit and written_lines_file >= args.limit:
-                        break
+    with out_file, ScriptMetrics(args, 'multilingual_dataset') as metrics:
+        if args.mode == 'interleave':
+            written_lines = interleave(args, lang_ids, writer, metrics.main)
+        else:
+            written_lines = concatenate(args, lang_ids, writer, metrics.main)
 
-                logging.info(f"- Written {written_lines_file} lines from file {filename} with id {lang_id}")
-    
     logging.info(f"- Written a total of {written_lines}, done!")
 
 
@@ -79,7 +253,7 @@ if __name__ == "__main__":
 
     # Global level parameters
     parser.add_argument('-i', '--input_files', type=str, required=True, nargs='+',
-                        help="List of input wikipedia processed dumps with one sentence per line")
+                        help="List of input wikipedia processed dumps with one sentence per line, or manifests of sharded ones")
     parser.add_argument('-l', '--limit', type=int, required=False, default=None,
                         help='Limit of sentences to be taken from each file')
     parser.add_argument('-o', '--output_file', type=str, required=True,
@@ -88,6 +262,27 @@ if __name__ == "__main__":
                         help="Specify an input language file with pairs of languages and ancronyms")
     parser.add_argument('-f', '--force_overwrite', action="store_true",
                         help='Overwrite output file if it does already exist')
+    parser.add_argument('--mode', type=str, required=False, default='concat', choices=['concat', 'raw', 'interleave'],
+                        help="Concatenate the files one after the other, do the same copying raw rows with parallel processes "
+                             "or interleave blocks of rows of all of them")
+    parser.add_argument('--alpha', type=float, required=False, default=0.7,
+                        help="Smoothing exponent of the probabilities of the languages when interleaving, p ∝ n^alpha")
+    parser.add_argument('--total_rows', type=int, required=False, default=None,
+                        help="Number of rows written when interleaving, defaults to the rows of all the files")
+    parser.add_argument('--block_size', type=int, required=False, default=1000,
+                        help="Number of consecutive rows of the same language when interleaving")
+    parser.add_argument('--seed', type=int, required=False, default=999,
+                        help="Seed used to draw the languages when interleaving")
+    parser.add_argument('--processes', type=int, required=False, default=cpu_count(),
+                        help="Number of processes counting and rewriting files in raw mode")
+    parser.add_argument('--tmp_dir', type=str, required=False, default=None,
+                        help="Folder for the temporary parts of raw mode, defaults to the folder of the output file")
+    parser.add_argument('--output_format', type=str, required=False, default='tsv', choices=['tsv', 'parquet'],
+                        help="Write rows to a tsv file or to a parquet file with integer id and lang_id columns")
+    parser.add_argument('--row_group_mb', type=int, required=False, default=ROW_GROUP_MB,
+                        help="Approximate MB of text in each row group of parquet output")
+    add_sharded_output_arguments(parser)
+    add_metrics_arguments(parser)
 
     # get NameSpace of paramters
     args = parser.parse_args()
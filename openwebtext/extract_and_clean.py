@@ -1,14 +1,20 @@
 import io
 import multiprocessing
 import os
+import sys
 import lzma
 import tarfile
 import logging
+import threading
 from pathlib import Path
 from tqdm import tqdm
 from argparse import ArgumentParser
 from multiprocessing import Pool
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import ScriptMetrics, TimedTask, add_metrics_arguments
+from sharding import add_sharded_output_arguments, get_sharding_kwargs, open_output, output_exists
+
 
 FORMAT_LOGGING = '%(levelname)s: %(message)s'
 logging.basicConfig(format=FORMAT_LOGGING)
@@ -27,6 +33,20 @@ def yield_extracted_files(members, tar):
     for member in tqdm(members, desc="Reading file containers", total=len(members)):
         yield tar.extractfile(member).read()
 
+# decompress the internal tar while reading it, so the container is never in memory decompressed: only its compressed
+# bytes, the document being read and the cleaned text of the container
+def stream_worker(input_file):
+    with tarfile.open(fileobj=lzma.LZMAFile(io.BytesIO(input_file)), mode='r|') as tar:
+        return "".join(clean_text(tar.extractfile(member_internal).read().decode('utf-8')) for member_internal in tar if member_internal.isfile())
+
+# read containers in a single pass over the archive. a slot is taken before a container is read into memory and given
+# back once its text is written, so at most as many containers as slots are read and not written yet
+def yield_streamed_files(tar, slots):
+    for member in tar:
+        if member.isfile():
+            slots.acquire()
+            yield tar.extractfile(member).read()
+
 def main(args):
 
     r"""
@@ -39,7 +59,8 @@ def main(args):
     """
 
     logging.info("Opening input compressed archive")
-    with open(args.output_file, "w") as out_file:
+    # documents end with an empty line, output shards are split only between them
+    with open_output(args.output_file, get_sharding_kwargs(args), document_separator="\n\n") as out_file:
         with tarfile.open(args.input_file, mode='r:xz') as tar:
 
             logging.info("Reading containers")
@@ -48,13 +69,35 @@ def main(args):
             input_containers = yield_extracted_files(members, tar)
             logging.info("Spawning processes")
 
-            with Pool(args.processes) as p:
+            with Pool(args.processes) as p, ScriptMetrics(args, 'extract_and_clean', pool=True) as metrics:
                 with tqdm(total=len(members), desc="Processing internal files") as pbar:
-                    for res in p.imap(worker, input_containers, chunksize=20):
+                    for res, member in zip(metrics.results(p.imap(TimedTask(worker), input_containers, chunksize=20)), members):
                         pbar.update()
+                        metrics.main.add('bytes', member.size)
                         for r in res:
+                            metrics.main.add('rows', r.count("\n"))
                             out_file.write(r)
 
+def main_streaming(args):
+
+    # outer archive is decompressed only once, while at most `buffer_size` containers are waiting or being processed
+    logging.info("Streaming input compressed archive")
+    slots = threading.Semaphore(args.buffer_size)
+    with open_output(args.output_file, get_sharding_kwargs(args), document_separator="\n\n") as out_file, open(args.input_file, 'rb') as in_file:
+        with tarfile.open(fileobj=in_file, mode='r|xz') as tar:
+
+            input_containers = yield_streamed_files(tar, slots)
+            logging.info("Spawning processes")
+
+            with Pool(args.processes) as p, ScriptMetrics(args, 'extract_and_clean', pool=True) as metrics:
+                with tqdm(total=os.path.getsize(args.input_file), desc="Processing containers", unit='B', unit_scale=True) as pbar:
+                    for res in metrics.results(p.imap(TimedTask(stream_worker), input_containers)):
+                        slots.release()
+                        metrics.main.add('bytes', in_file.tell() - pbar.n)
+                        metrics.main.add('rows', res.count("\n"))
+                        pbar.update(in_file.tell() - pbar.n)
+                        out_file.write(res)
+
 if __name__ == '__main__':
 
     parser = ArgumentParser()
@@ -62,6 +105,10 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output_file', type=str, required=False, default=None, help="Output txt file")
     parser.add_argument('-f', '--force', action="store_true", help="Overwrite output file if it exists")
     parser.add_argument('-p', '--processes', type=int, help="Number of parallel processes to spawn", default=multiprocessing.cpu_count())
+    parser.add_argument('-s', '--streaming', action="store_true", help="Decompress the archive in a single pass, streaming containers to the processes")
+    parser.add_argument('--buffer_size', type=int, help="Max containers in memory in streaming mode, defaults to twice the processes", default=None)
+    add_sharded_output_arguments(parser)
+    add_metrics_arguments(parser)
     args = parser.parse_args()
 
     if args.output_file is None:
@@ -73,8 +120,14 @@ if __name__ == '__main__':
     assert os.path.isfile(args.input_file), (
         f"Input file {args.input_file} does not exist!"
     )
-    assert args.force or not os.path.isfile(args.output_file), (
+    assert args.force or not output_exists(args.output_file), (
         f"Output file {args.output_file} does not exist, use `--force` to overwrite"
     )
 
-    main(args)
\ No newline at end of file
+    if args.buffer_size is None:
+        args.buffer_size = 2 * args.processes
+
+    if args.streaming:
+        main_streaming(args)
+    else:
+        main(args)
\ No newline at end of file
@@ -0,0 +1,80 @@
+from typing import List
+
+
+# parquet datasets have an `id` column (int64), an optional `lang_id` column (int32) and a `text` column stored as
+# large strings without dictionary encoding. rows are written in row groups of about `row_group_mb` MB of utf-8 text,
+# that Arrow and Spark readers load in parallel. ids are written with statistics, so that readers can skip row groups
+ROW_GROUP_MB = 128
+COMPRESSION = 'zstd'
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Writing parquet files requires the pyarrow package, install it with `pip install pyarrow`")
+    return pyarrow
+
+
+# write rows of a dataset to a parquet file, with the interface of csv writers and of `TsvWriter` but for `state`:
+# parquet files are valid only once their footer is written, so no checkpoint of them is saved
+class ParquetDatasetWriter:
+
+    def __init__(self, filename: str, with_lang_id: bool = False, row_group_mb: int = ROW_GROUP_MB):
+        assert row_group_mb > 0, "Row groups must be at least 1 MB"
+        self.pa = import_pyarrow()
+        self.with_lang_id = with_lang_id
+        self.row_group_size = row_group_mb * 1024 * 1024
+
+        fields = [self.pa.field('id', self.pa.int64(), nullable=False)]
+        if with_lang_id:
+            fields.append(self.pa.field('lang_id', self.pa.int32(), nullable=False))
+        fields.append(self.pa.field('text', self.pa.large_string(), nullable=False))
+        self.schema = self.pa.schema(fields)
+        self.writer = self.pa.parquet.ParquetWriter(
+            str(filename),
+            self.schema,
+            compression=COMPRESSION,
+            use_dictionary=False,
+            write_statistics=[name for name in self.schema.names if name != 'text']
+        )
+
+        self.columns = {name: [] for name in self.schema.names}
+        self.buffer_size = 0
+        self.rows = 0
+
+    def write(self, row_id: int, text: str, lang_id: int = None):
+        self.columns['id'].append(row_id)
+        if self.with_lang_id:
+            self.columns['lang_id'].append(lang_id)
+        self.columns['text'].append(text)
+        self.buffer_size += len(text.encode('utf-8'))
+        if self.buffer_size >= self.row_group_size:
+            self.flush_row_group()
+
+    # rows as written to tsv files: [id, text] or [id, lang_id, text]
+    def writerow(self, row: List):
+        if self.with_lang_id:
+            self.write(row[0], row[2], lang_id=row[1])
+        else:
+            self.write(row[0], row[1])
+
+    def flush_row_group(self):
+        rows = len(self.columns['id'])
+        if rows > 0:
+            table = self.pa.Table.from_pydict(self.columns, schema=self.schema)
+            self.writer.write_table(table, row_group_size=rows)
+            self.rows += rows
+            self.columns = {name: [] for name in self.schema.names}
+            self.buffer_size = 0
+
+    def close(self):
+        self.flush_row_group()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,396 @@
+import csv
+import io
+import itertools
+import logging
+import math
+import os
+import random
+import struct
+import tarfile
+import tempfile
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue, cpu_count
+from typing import Dict, Iterator, List, Tuple
+
+from tqdm import tqdm
+
+from create_dataset import Packer, parse_batch, read_batches_in_order
+from compressed_io import is_seekable, open_file
+from file_utils import get_line_aligned_ranges, read_line_aligned_blocks
+from metrics import MetricsRegistry, MetricsReporter, ProcessMetrics, add_metrics_arguments
+from openwebtext.extract_and_clean import stream_worker
+from preprocess import clean_texts
+from shared_tokenizer import LazyTokenizer, share_tokenizer
+from sharding import (
+    add_sharded_output_arguments,
+    get_input_offsets,
+    get_input_size,
+    get_sharding_kwargs,
+    open_output,
+    output_exists
+)
+
+
+FORMAT_LOGGING = '%(levelname)s: %(message)s'
+logging.basicConfig(format=FORMAT_LOGGING)
+logging.getLogger().setLevel(logging.INFO)
+
+# inputs with this suffix are openwebtext archives, whose documents are extracted on the fly
+ARCHIVE_SUFFIX = '.tar.xz'
+# approximate memory taken by a row held in a bucket, besides its text
+ROW_OVERHEAD = 40
+# rows spilled to disk are prefixed by their length
+LENGTH = struct.Struct('<I')
+# ratio between the size of the uncompressed input and the memory taken by its rows waiting to be shuffled,
+# and the one between the size of an archive and of its extracted text
+ROW_MEMORY_RATIO = 1.5
+ARCHIVE_RATIO = 8
+
+
+# read the input and fill the queues of the workers, round-robin, with sequence-numbered units of work:
+# line-aligned byte ranges of text files, line-aligned blocks of compressed files that can only be read sequentially
+# or containers of documents of an openwebtext archive
+def reader(input_file: str, in_queues: List[Queue], block_size: int, metrics: ProcessMetrics = None):
+    metrics = metrics if metrics is not None else ProcessMetrics()
+    metrics.start()
+    seq = 0
+
+    if input_file.endswith(ARCHIVE_SUFFIX):
+        # the outer archive is decompressed only once, containers are decompressed by the workers
+        with open(input_file, 'rb') as in_file, tarfile.open(fileobj=in_file, mode='r|xz') as tar:
+            for member in tar:
+                if member.isfile():
+                    container = tar.extractfile(member).read()
+                    metrics.add('bytes', len(container))
+                    metrics.put(in_queues[seq % len(in_queues)], (seq, ('container', container)))
+                    seq += 1
+    else:
+        for filename, _ in get_input_offsets(input_file):
+            if is_seekable(filename):
+                units = (('range', filename, start, end) for start, end in get_line_aligned_ranges(filename, block_size))
+            else:
+                units = (('block', data) for data, _ in read_line_aligned_blocks(filename, block_size))
+            for unit in units:
+                metrics.add('bytes', unit[3] - unit[2] if unit[0] == 'range' else len(unit[1]))
+                metrics.put(in_queues[seq % len(in_queues)], (seq, unit))
+                seq += 1
+
+    for in_queue in in_queues:
+        in_queue.put(None)
+    metrics.finish()
+
+
+# raw lines of a unit of work, as they would be read from the extracted file
+def read_unit(unit: Tuple) -> List[str]:
+    if unit[0] == 'container':
+        text = stream_worker(unit[1])
+    elif unit[0] == 'block':
+        text = unit[1].decode('utf-8')
+    else:
+        _, filename, start, end = unit
+        with open_file(filename, 'rb', threaded=False) as in_file:
+            in_file.seek(start)
+            text = in_file.read(end - start).decode('utf-8')
+    # split lines with universal newlines, as when preprocessing a file
+    return list(io.StringIO(text, newline=None))
+
+
+# extract, clean and tokenize units of work. cleaned lines are the ones of the preprocessed file, which are tokenized
+# in batches of `batch_size` lines. results of a unit are sent back with its sequence number as a single batch
+def worker(
+    in_queue: Queue,
+    out_queue: Queue,
+    tokenizer: LazyTokenizer = None,
+    batch_size: int = 1024,
+    metrics: ProcessMetrics = None
+):
+    metrics = metrics if metrics is not None else ProcessMetrics()
+    metrics.start()
+    while True:
+        unit = metrics.get(in_queue)
+        if unit is None:
+            out_queue.put(None)
+            break
+
+        seq, unit = unit
+        lines = [line for line in clean_texts(read_unit(unit)) if len(line) > 0]
+        results = []
+        for i in range(0, len(lines), batch_size):
+            results += parse_batch(lines[i:i + batch_size], tokenizer, metrics)
+        metrics.put(out_queue, (seq, results, True, None))
+    metrics.finish()
+
+
+# rows of the dataset, packed as `create_dataset.py` does from the lines of the preprocessed file
+def pack_rows(batches: Iterator, packer: Packer, min_word_per_sentence: int = 1) -> Iterator[str]:
+    for results, _, _ in batches:
+        for line, line_len in results:
+            # without tokenizer every line is a row
+            if line_len is None:
+                if len(line.strip()) > 0 and len(line.split()) >= min_word_per_sentence:
+                    yield line
+            else:
+                yield from packer.add(line, line_len)
+    yield from packer.flush()
+
+
+# number of buckets such that a bucket of the rows of the input takes on average half of `memory_limit` bytes.
+# the size of inputs that can only be read sequentially is estimated from the size of their file
+def get_shuffle_buckets(input_file: str, memory_limit: int, min_buckets: int = 1) -> int:
+    input_size = get_input_size(input_file) if not input_file.endswith(ARCHIVE_SUFFIX) else None
+    if input_size is None:
+        input_size = os.path.getsize(input_file) * ARCHIVE_RATIO
+    return max(min_buckets, math.ceil(2 * ROW_MEMORY_RATIO * input_size / memory_limit))
+
+
+# shuffle a stream of rows by scattering them in `n_buckets` random buckets, that are then shuffled one at a time.
+# buckets are kept in memory and spilled to temporary files only when they take more than `memory_limit` bytes.
+# when rows are read back, a bucket that takes more than `memory_limit` bytes is not loaded but scattered again
+# in smaller buckets, so that memory stays within `memory_limit` even when the number of buckets is too small
+class BucketShuffler:
+
+    def __init__(self, n_buckets: int, memory_limit: int, tmp_dir: str = None, seed: int = 999):
+        assert n_buckets > 0, "At least a bucket is needed"
+        self.n_buckets = n_buckets
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+        self.rng = random.Random(seed)
+
+        self.buckets = [[] for _ in range(n_buckets)]
+        self.bucket_memory = [0] * n_buckets
+        self.bucket_rows = [0] * n_buckets
+        self.memory = 0
+        self.spill_dir = None
+        self.rows = 0
+
+    def add(self, row: str):
+        self.add_data(row.encode('utf-8'))
+
+    def add_data(self, data: bytes):
+        i = self.rng.randrange(self.n_buckets)
+        self.buckets[i].append(data)
+        self.bucket_memory[i] += len(data) + ROW_OVERHEAD
+        self.bucket_rows[i] += 1
+        self.memory += len(data) + ROW_OVERHEAD
+        self.rows += 1
+        if self.memory > self.memory_limit:
+            self.spill()
+
+    def get_spill_file(self, i: int) -> str:
+        return os.path.join(self.spill_dir.name, f"bucket-{i}.bin")
+
+    def spill(self):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.TemporaryDirectory(dir=self.tmp_dir, prefix="pipeline-")
+            logging.info(f"Rows do not fit in memory, spilling buckets to {self.spill_dir.name}")
+        for i, bucket in enumerate(self.buckets):
+            if len(bucket) > 0:
+                with open(self.get_spill_file(i), 'ab') as out_file:
+                    out_file.writelines(LENGTH.pack(len(data)) + data for data in bucket)
+                bucket.clear()
+        self.memory = 0
+
+    # rows of a bucket spilled to disk, read back one at a time
+    def read_spilled(self, i: int) -> Iterator[bytes]:
+        if self.spill_dir is None or not os.path.isfile(self.get_spill_file(i)):
+            return
+        with open(self.get_spill_file(i), 'rb') as in_file:
+            while True:
+                header = in_file.read(LENGTH.size)
+                if not header:
+                    break
+                length, = LENGTH.unpack(header)
+                yield in_file.read(length)
+        os.remove(self.get_spill_file(i))
+
+    # yield all the rows in random order, as bytes
+    def iter_data(self) -> Iterator[bytes]:
+        # once some buckets are on disk, the others are spilled too, so that a single bucket at a time is in memory
+        if self.spill_dir is not None:
+            self.spill()
+        for i in range(self.n_buckets):
+            rows = itertools.chain(self.read_spilled(i), self.buckets[i])
+            if self.bucket_memory[i] > self.memory_limit and self.bucket_rows[i] > 1:
+                n_buckets = math.ceil(2 * self.bucket_memory[i] / self.memory_limit)
+                with BucketShuffler(n_buckets, self.memory_limit, self.tmp_dir, seed=self.rng.randrange(1 << 32)) as shuffler:
+                    for data in rows:
+                        shuffler.add_data(data)
+                    self.buckets[i] = []
+                    yield from shuffler.iter_data()
+            else:
+                rows = list(rows)
+                self.buckets[i] = []
+                self.rng.shuffle(rows)
+                yield from rows
+
+    def __iter__(self) -> Iterator[str]:
+        for data in self.iter_data():
+            yield data.decode('utf-8')
+
+    def close(self):
+        if self.spill_dir is not None:
+            self.spill_dir.cleanup()
+            self.spill_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# pack the results of the workers in order and write rows of [id, text], shuffled unless `shuffle_kwargs` is None
+def writer(
+    out_queues: List[Queue],
+    output_file: str,
+    packer_kwargs: Dict,
+    min_word_per_sentence: int = 1,
+    shuffle_kwargs: Dict = None,
+    sharding_kwargs: Dict = None,
+    metrics: ProcessMetrics = None
+):
+    metrics = metrics if metrics is not None else ProcessMetrics()
+    metrics.start()
+    rows = pack_rows(read_batches_in_order(out_queues, metrics=metrics), Packer(**packer_kwargs), min_word_per_sentence)
+
+    written_lines = 0
+    with open_output(output_file, sharding_kwargs) as out_file:
+        out_writer = csv.writer(out_file, delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+        if shuffle_kwargs is None:
+            for row in tqdm(rows, desc="Writing rows"):
+                out_writer.writerow([written_lines, row])
+                written_lines += 1
+        else:
+            with BucketShuffler(**shuffle_kwargs) as shuffler:
+                for row in tqdm(rows, desc="Packing rows"):
+                    shuffler.add(row)
+                # all the workers are done, only shuffled rows are left to write
+                for row in tqdm(shuffler, desc="Writing shuffled rows", total=shuffler.rows):
+                    out_writer.writerow([written_lines, row])
+                    written_lines += 1
+        metrics.add('rows', written_lines)
+
+    metrics.finish()
+    logging.info(f"Written {written_lines} lines successfully.")
+
+
+def main(args):
+
+    logging.info(f"Checking I/O files")
+    assert os.path.isfile(args.input_file), f"Input file {args.input_file} does not exist"
+    assert not output_exists(args.output_file) or args.force_overwrite, (
+        f"Cannot overwrite {args.output_file}, add -f option if you are cocky"
+    )
+
+    packer_kwargs = {
+        'target_len': args.target_len,
+        'separate_documents': args.separate_documents,
+        'no_split_long_paragraphs': args.no_split_long_paragraphs,
+    }
+    shuffle_kwargs = None if args.no_shuffle else {
+        'n_buckets': get_shuffle_buckets(args.input_file, args.memory_limit * 1024 * 1024, min_buckets=args.shuffle_buckets),
+        'memory_limit': args.memory_limit * 1024 * 1024,
+        'tmp_dir': args.tmp_dir if args.tmp_dir is not None else os.path.dirname(os.path.abspath(args.output_file)),
+        'seed': args.seed,
+    }
+
+    logging.info("Creating queues")
+    # stages are connected only by bounded queues, no intermediate file is written
+    in_queues = [Queue(maxsize=args.queue_size) for _ in range(args.processes)]
+    out_queues = [Queue(maxsize=args.queue_size) for _ in range(args.processes)]
+
+    registry = None
+    if args.metrics_file is not None:
+        registry = MetricsRegistry(['reader'] + [f"worker-{i}" for i in range(args.processes)] + ['writer'])
+
+    def get_metrics(name):
+        return registry.get(name) if registry is not None else None
+
+    # the tokenizer is loaded once here and shared with the workers
+    tokenizer = share_tokenizer(args.fill_for_tokenizer)
+
+    logging.info(f"Processing {get_input_size(args.input_file)} input bytes with {args.processes} workers")
+    reader_process = Process(target=reader, args=(args.input_file, in_queues, args.block_size),
+                             kwargs={'metrics': get_metrics('reader')})
+    workers = [
+        Process(target=worker,
+                args=(in_queues[i], out_queues[i]),
+                kwargs={'tokenizer': tokenizer,
+                        'batch_size': args.batch_tokenization,
+                        'metrics': get_metrics(f"worker-{i}")}) for i in range(args.processes)]
+    writer_process = Process(target=writer,
+                             args=(out_queues, args.output_file, packer_kwargs),
+                             kwargs={'min_word_per_sentence': args.min_word_per_sentence,
+                                     'shuffle_kwargs': shuffle_kwargs,
+                                     'sharding_kwargs': get_sharding_kwargs(args),
+                                     'metrics': get_metrics('writer')})
+
+    reporter = None
+    if registry is not None:
+        reporter = MetricsReporter(registry, {'input': in_queues, 'output': out_queues}, args.metrics_file,
+                                   metrics_format=args.metrics_format, interval=args.metrics_interval, script='pipeline')
+        reporter.start()
+
+    for w in workers:
+        w.start()
+    reader_process.start()
+    writer_process.start()
+
+    logging.info("Waiting for processes to finish")
+    writer_process.join()
+    if reporter is not None:
+        reporter.stop()
+    for w in workers:
+        if w.is_alive():
+            w.terminate()
+    if reader_process.is_alive():
+        reader_process.terminate()
+
+    assert writer_process.exitcode == 0, f"Writer failed with exit code {writer_process.exitcode}"
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser("Clean, pack and shuffle a corpus in a single pass, writing only the final dataset")
+
+    # Global level parameters
+    parser.add_argument('-i', '--input_file', type=str, required=True,
+                        help="Extracted corpus with a paragraph per line, the manifest of a sharded one or an openwebtext archive (.tar.xz)")
+    parser.add_argument('-o', '--output_file', type=str, required=True,
+                        help='Specify an output file')
+    parser.add_argument('-f', '--force_overwrite', action="store_true",
+                        help='Overwrite output file if it does already exist')
+    parser.add_argument('--processes', type=int, default=cpu_count(), required=False,
+                        help="Number of processes cleaning and tokenizing the input")
+    parser.add_argument('-b', '--block_size', type=int, default=4 * 1024 * 1024, required=False,
+                        help="Size in bytes of the blocks of input lines processed by a worker at once")
+    parser.add_argument('-m', '--min_word_per_sentence', type=int, required=False, default=1,
+                        help='Minimun number of words in a sentence to be considered.')
+    parser.add_argument('--fill_for_tokenizer', type=str, default=None, required=False,
+                        help="Path of some pre-trained tokenizer")
+    parser.add_argument('--separate_documents', action="store_true",
+                        help="Do not fill rows with sentences coming from different documents")
+    parser.add_argument('--target_len', type=int, default=128, required=False)
+    parser.add_argument('--batch_tokenization', type=int, default=1024, required=False)
+    parser.add_argument('--no_split_long_paragraphs', action="store_true")
+    parser.add_argument('--queue_size', type=int, default=8, required=False,
+                        help="Maximum number of units of work waiting in each queue between the processes")
+    parser.add_argument('--no_shuffle', action="store_true",
+                        help="Write rows in the order of the input, as preprocess.py and create_dataset.py do")
+    parser.add_argument('--seed', type=int, required=False, default=999,
+                        help="Seed used for shuffling")
+    parser.add_argument('--shuffle_buckets', type=int, required=False, default=64,
+                        help="Minimum number of random buckets rows are scattered in before shuffling each of them. "
+                             "More buckets are used when the input is large, so that a bucket takes about half of --memory_limit")
+    parser.add_argument('--memory_limit', type=int, required=False, default=4096,
+                        help="Approximate memory (in MB) for the rows waiting to be shuffled, beyond it buckets are spilled to disk")
+    parser.add_argument('--tmp_dir', type=str, required=False, default=None,
+                        help="Folder for buckets spilled to disk, defaults to the folder of the output file")
+    add_sharded_output_arguments(parser)
+    add_metrics_arguments(parser)
+
+    # get NameSpace of paramters
+    args = parser.parse_args()
+
+    main(args)
@@ -1,16 +1,41 @@
+import io
 import logging
 import os
+import threading
+import time
 from argparse import ArgumentParser
 from multiprocessing import Pool, cpu_count
 from pathlib import Path
+from typing import Iterator, List, Tuple, Union
 
 from blingfire import text_to_sentences
 from tqdm import tqdm
 
+from compressed_io import is_seekable, open_file
+from file_utils import (
+    get_checkpoint_file,
+    get_line_aligned_ranges,
+    load_checkpoint,
+    read_line_aligned_blocks,
+    remove_checkpoint,
+    save_checkpoint
+)
+from metrics import ScriptMetrics, TimedTask, add_metrics_arguments
+from sharding import (
+    add_sharded_output_arguments,
+    get_input_offsets,
+    get_input_size,
+    get_sharding_kwargs,
+    is_manifest,
+    open_output,
+    output_exists
+)
+
 
 FORMAT_LOGGING = '%(levelname)s: %(message)s'
 logging.basicConfig(format=FORMAT_LOGGING)
 logging.getLogger().setLevel(logging.INFO)
+PARAGRAPH_SEPARATOR = "\u2029"
 
 def clean_text(text):
     text = text.strip()
@@ -21,20 +46,106 @@ def clean_text(text):
         return "" # this was a text line that contained not parseable text
     return sentences + "\n"
 
+# clean many lines with a single blingfire call, giving the same results of `clean_text` on each line.
+# lines are joined with the unicode paragraph separator, which is always a sentence boundary for blingfire
+# and ends up at the end of the last sentence of each line, so the output can be split back into lines
+def clean_texts(texts: List[str]) -> List[str]:
+    texts = [text.strip() for text in texts]
+    non_empty = [i for i, text in enumerate(texts) if len(text) > 0]
+    if len(non_empty) == 0 or any(PARAGRAPH_SEPARATOR in texts[i] for i in non_empty):
+        return [clean_text(text) for text in texts]
+
+    sentences = text_to_sentences(PARAGRAPH_SEPARATOR.join(texts[i] for i in non_empty) + PARAGRAPH_SEPARATOR)
+    paragraphs = sentences.split(PARAGRAPH_SEPARATOR)[:-1]
+    # a sentence crossing two lines would make results different, fall back to cleaning lines one by one
+    if len(paragraphs) != len(non_empty) or any(len(p) > 0 and p[0] != "\n" for p in paragraphs[1:]):
+        return [clean_text(text) for text in texts]
+
+    res = ["\n"] * len(texts)
+    for i, paragraph in zip(non_empty, paragraphs):
+        paragraph = paragraph.replace("\n", " ").strip()
+        res[i] = paragraph + "\n" if len(paragraph) > 0 else "" # this was a text line that contained not parseable text
+    return res
+
+# clean the lines in a byte range of an input file, returning the output buffer and the end of the range
+# in the concatenation of the input files, given the offset where the file starts.
+# blocks of inputs that can only be read sequentially are given as data with the offset of their end
+def clean_block(block: Union[Tuple[str, int, int, int], Tuple[bytes, int]]):
+    if len(block) == 2:
+        data, end = block
+        data = data.decode('utf-8')
+    else:
+        filename, start, end, file_offset = block
+        with open_file(filename, 'rb', threaded=False) as in_f:
+            in_f.seek(start)
+            data = in_f.read(end - start).decode('utf-8')
+        end += file_offset
+    # split lines with universal newlines, as when reading the file in text mode
+    lines = list(io.StringIO(data, newline=None))
+    return "".join(clean_texts(lines)), end
+
+# blocks of the input from `input_offset` on. plain and seekable zstandard files are split in ranges read by the
+# workers, other compressed files are read here, waiting for a free slot before each block to bound memory
+def get_blocks(input_file: str, block_size: int, input_offset: int, slots: threading.Semaphore) -> Iterator[Tuple]:
+    for filename, file_offset in get_input_offsets(input_file):
+        start = max(input_offset - file_offset, 0)
+        if is_seekable(filename):
+            for start, end in get_line_aligned_ranges(filename, block_size, start=start):
+                slots.acquire()
+                yield filename, start, end, file_offset
+        else:
+            for data, end in read_line_aligned_blocks(filename, block_size, start=start):
+                slots.acquire()
+                yield data, file_offset + end
+
 def main(args):
 
     logging.info(f'Pre-processing {args.input_file} to {args.output_file}...')
 
-    with open(args.input_file, 'r') as in_f:
-        total = sum(1 for _ in tqdm(in_f, desc="Overviewing input files"))
-
-    with open(args.output_file, 'w') as out_f:
-        with open(args.input_file, 'r') as in_f:
-            with Pool(args.processes) as p:
-                with tqdm(total=total, desc="Preprocessing file") as pbar:                        
-                    for res in p.imap(clean_text, in_f, chunksize=args.chunk_size):
-                        pbar.update()
-                        out_f.write(res)
+    # input file must not change between a run and its resumption
+    checkpoint_file = get_checkpoint_file(args.output_file)
+    checkpoint_config = {'input_file': os.path.abspath(args.input_file), 'input_size': get_input_size(args.input_file)}
+    input_offset = 0
+    output_state = None
+
+    if args.resume and os.path.isfile(checkpoint_file):
+        checkpoint = load_checkpoint(checkpoint_file)
+        assert checkpoint['config'] == checkpoint_config, (
+            f"Checkpoint {checkpoint_file} was created for a different input: {checkpoint['config']}"
+        )
+        input_offset, output_state = checkpoint['input_offset'], checkpoint['output']
+        logging.info(f"Resuming from input byte {input_offset}")
+    else:
+        remove_checkpoint(checkpoint_file)
+
+    # workers read blocks of the input by themselves where possible, so only offsets and cleaned blocks are exchanged.
+    # shards of an input manifest are read one after the other, offsets are in their concatenation
+    slots = threading.Semaphore(2 * args.processes)
+    blocks = get_blocks(args.input_file, args.block_size, input_offset, slots)
+
+    last_checkpoint = time.time()
+    # output shards are split only at empty lines, so that each of them starts with a new document
+    with open_output(args.output_file, get_sharding_kwargs(args), document_separator="\n\n", resume_state=output_state) as out_f:
+        with Pool(args.processes) as p, ScriptMetrics(args, 'preprocess', pool=True) as metrics:
+            total = checkpoint_config['input_size']
+            with tqdm(total=total, initial=input_offset, desc="Preprocessing file", unit='B', unit_scale=True) as pbar:
+                for res, end in metrics.results(p.imap(TimedTask(clean_block), blocks)):
+                    slots.release()
+                    pbar.update(end - input_offset)
+                    metrics.main.add('bytes', end - input_offset)
+                    metrics.main.add('rows', res.count("\n"))
+                    out_f.write(res)
+                    input_offset = end
+
+                    if time.time() - last_checkpoint >= args.checkpoint_interval:
+                        save_checkpoint(checkpoint_file, {
+                            'config': checkpoint_config,
+                            'input_offset': input_offset,
+                            'output': out_f.state()
+                        })
+                        last_checkpoint = time.time()
+
+    remove_checkpoint(checkpoint_file)
 
 
 if __name__ == '__main__':
@@ -43,27 +154,42 @@ if __name__ == '__main__':
 
     # Global level parameters
     parser.add_argument('-i', '--input_file', type=str, required=True,
-                        help="List of input wikipedia processed dumps with one sentence per line")
+                        help="List of input wikipedia processed dumps with one sentence per line, or the manifest of a sharded output")
     parser.add_argument('-o', '--output_file', type=str, required=False, default=None,
                         help='Specify an output file')
     parser.add_argument('-f', '--force_overwrite', action="store_true",
                         help='Overwrite output file if it does already exist')
     parser.add_argument('-p', '--processes', type=int, default=cpu_count(),
                         help='Number of processes to use')
-    parser.add_argument('-c', '--chunk_size', type=int, default=10000,
-                        help='Number of entries per process. Increase with very large datasets.')
+    parser.add_argument('-b', '--block_size', type=int, default=4 * 1024 * 1024,
+                        help='Size in bytes of the blocks of input lines cleaned by a process at once.')
+    parser.add_argument('-c', '--chunk_size', type=int, default=None,
+                        help='Deprecated and ignored, blocks are sized in bytes by -b/--block_size')
+    parser.add_argument('--checkpoint_interval', type=int, default=300,
+                        help='Seconds between checkpoints of the run, saved to <output_file>.checkpoint.json')
+    parser.add_argument('--resume', action="store_true",
+                        help='Resume an interrupted run from its last checkpoint')
+    add_sharded_output_arguments(parser)
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
 
+    if args.chunk_size is not None:
+        logging.warning(f"-c/--chunk_size is deprecated and ignored, blocks of {args.block_size} bytes are read: "
+                        f"use -b/--block_size to change their size")
+
     assert os.path.isfile(args.input_file), (
         f"Input file {args.input_file} does not exist"
     )
 
     if args.output_file is None:
+        assert not is_manifest(args.input_file), "Output file must be specified when reading a manifest"
         input_dump_file_in = Path(args.input_file)
         args.output_file = input_dump_file_in.parent / f'{input_dump_file_in.stem}-preprocessed{input_dump_file_in.suffix}'
 
-    assert not os.path.isfile(args.output_file) or args.force_overwrite, (
+    # an existing output is overwritten unless there is a checkpoint to resume it from
+    can_resume = args.resume and os.path.isfile(get_checkpoint_file(args.output_file))
+    assert not output_exists(args.output_file) or args.force_overwrite or can_resume, (
         f"Output file {args.output_file} does already exist"
     )
 
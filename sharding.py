@@ -0,0 +1,451 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple, Union
+
+from compressed_io import CompressedWriter, get_compression, get_file_size, open_file, strip_compression_suffix
+from file_utils import save_json
+
+
+# sharded outputs are written next to the requested output file:
+#  - `<name>-00000<suffix>`, `<name>-00001<suffix>`, ...: the shards, in order
+#  - `<name>.manifest.json`: list of the shards with their number of rows, size in bytes and sha256 checksum
+# every script accepts a manifest in place of an input file and reads its shards as a single file.
+# if the output file has a compression extension, as `data.tsv.zst`, every shard is compressed (`data-00000.tsv.zst`),
+# while sizes and checksums in the manifest refer to the uncompressed data
+MANIFEST_SUFFIX = '.manifest.json'
+# data is handed to the thread writing a shard in buffers of about this size
+BUFFER_SIZE = 1024 * 1024
+# maximum number of buffers waiting to be written to a shard
+QUEUE_SIZE = 4
+
+
+def add_sharded_output_arguments(parser: ArgumentParser):
+    parser.add_argument('--shard_rows', type=int, default=None, required=False,
+                        help="Split the output in shards of at most this number of rows, listed in <output_file>.manifest.json")
+    parser.add_argument('--shard_bytes', type=int, default=None, required=False,
+                        help="Split the output in shards of about this size in bytes, listed in <output_file>.manifest.json")
+    parser.add_argument('--shard_writers', type=int, default=4, required=False,
+                        help="Maximum number of shards handled by background threads at the same time: only the last one "
+                             "receives data, while the previous ones finish to be written, compressed and hashed")
+
+
+# keyword arguments of `ShardedWriter` from the command line, None if the output is a single file
+def get_sharding_kwargs(args) -> Dict:
+    if args.shard_rows is None and args.shard_bytes is None:
+        return None
+    return {'max_rows': args.shard_rows, 'max_bytes': args.shard_bytes, 'num_writers': args.shard_writers}
+
+
+def get_manifest_file(output_file: str) -> Path:
+    return Path(strip_compression_suffix(output_file)).with_suffix(MANIFEST_SUFFIX)
+
+
+def get_shard_file(output_file: str, index: int) -> Path:
+    compression_suffix = str(output_file)[len(strip_compression_suffix(output_file)):]
+    output_file = Path(strip_compression_suffix(output_file))
+    return output_file.parent / f"{output_file.stem}-{index:05d}{output_file.suffix}{compression_suffix}"
+
+
+def is_manifest(filename: str) -> bool:
+    return str(filename).endswith(MANIFEST_SUFFIX)
+
+
+def load_manifest(manifest_file: str) -> Dict:
+    with open(manifest_file) as in_fi:
+        return json.load(in_fi)
+
+
+# files to read for an input that may be a manifest, checking that shards were not modified in size
+def get_input_files(input_file: str) -> List[str]:
+    if not is_manifest(input_file):
+        return [str(input_file)]
+
+    folder = os.path.dirname(os.path.abspath(input_file))
+    files = []
+    for shard in load_manifest(input_file)['shards']:
+        filename = os.path.join(folder, shard['file'])
+        assert os.path.isfile(filename) and os.path.getsize(filename) == shard.get('file_bytes', shard['bytes']), (
+            f"Shard {filename} of {input_file} is missing or was modified"
+        )
+        files.append(filename)
+    return files
+
+
+# files to read for an input that may be a manifest, with their number of rows when known from the manifest
+def get_input_shards(input_file: str) -> List[Tuple[str, int]]:
+    if not is_manifest(input_file):
+        return [(str(input_file), None)]
+    rows = [shard['rows'] for shard in load_manifest(input_file)['shards']]
+    return list(zip(get_input_files(input_file), rows))
+
+
+# input files with the offset where each of them starts in their concatenation.
+# offsets refer to uncompressed data, the sizes of compressed shards are taken from the manifest
+def get_input_offsets(input_file: str) -> List[Tuple[str, int]]:
+    if not is_manifest(input_file):
+        return [(str(input_file), 0)]
+    res = []
+    offset = 0
+    for filename, shard in zip(get_input_files(input_file), load_manifest(input_file)['shards']):
+        res.append((filename, offset))
+        offset += shard['bytes']
+    return res
+
+
+# total uncompressed size of an input that may be a manifest, None for a compressed file that can only be read sequentially
+def get_input_size(input_file: str) -> int:
+    if is_manifest(input_file):
+        return load_manifest(input_file)['bytes']
+    return get_file_size(input_file)
+
+
+# parsed rows of a tsv file or of all the shards of a manifest, in order
+def read_tsv_rows(input_file: str) -> Iterator[List[str]]:
+    for filename in get_input_files(input_file):
+        with open_file(filename, 'r') as in_file:
+            yield from csv.reader(in_file, delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+
+# whether a single file or a sharded output was already written to `output_file`
+def output_exists(output_file: str) -> bool:
+    return os.path.isfile(output_file) or os.path.isfile(get_manifest_file(output_file))
+
+
+# remove the shards and the manifest of a previous sharded output
+def remove_sharded_output(output_file: str):
+    manifest_file = get_manifest_file(output_file)
+    if os.path.isfile(manifest_file):
+        for shard in load_manifest(manifest_file)['shards']:
+            filename = os.path.join(os.path.dirname(os.path.abspath(manifest_file)), shard['file'])
+            if os.path.isfile(filename):
+                os.remove(filename)
+        os.remove(manifest_file)
+
+
+# a single shard, written and hashed by a background thread, that also compresses it if its name has a compression extension
+class ShardFile:
+
+    def __init__(self, filename: Path, resume_state: Dict = None):
+        self.filename = filename
+        self.compressed = get_compression(filename) is not None
+        self.checksum = hashlib.sha256()
+        self.error = None
+
+        if resume_state is not None:
+            self.rows = resume_state['rows']
+            self.bytes = resume_state['bytes']
+            if self.compressed:
+                self.out_file = CompressedWriter(filename, resume_state=resume_state['file'])
+            else:
+                os.truncate(filename, self.bytes)
+            with open_file(filename, 'rb') as in_fi:
+                for data in iter(lambda: in_fi.read(BUFFER_SIZE), b''):
+                    self.checksum.update(data)
+            if not self.compressed:
+                self.out_file = open(filename, 'ab')
+        else:
+            self.rows = 0
+            self.bytes = 0
+            self.out_file = CompressedWriter(filename) if self.compressed else open(filename, 'wb')
+
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            try:
+                if data is None:
+                    self.out_file.close()
+                    break
+                if self.error is None:
+                    self.out_file.write(data)
+                    self.checksum.update(data)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write(self, data: bytes, rows: int):
+        self.queue.put(data)
+        self.rows += rows
+        self.bytes += len(data)
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    # wait for the buffers given to the thread, flush them to disk and return what is needed to resume writing after them
+    def state(self) -> Dict:
+        self.queue.join()
+        self.check()
+        res = {'rows': self.rows, 'bytes': self.bytes}
+        if self.compressed:
+            res['file'] = self.out_file.state()
+        else:
+            self.out_file.flush()
+            os.fsync(self.out_file.fileno())
+        return res
+
+    def close(self):
+        self.queue.put(None)
+
+    # wait for the thread to finish and return the entry of the shard in the manifest
+    def join(self) -> Dict:
+        self.thread.join()
+        self.check()
+        res = {'file': self.filename.name, 'rows': self.rows, 'bytes': self.bytes, 'sha256': self.checksum.hexdigest()}
+        if self.compressed:
+            res['file_bytes'] = os.path.getsize(self.filename)
+        return res
+
+
+# write a stream of data to shards of at most `max_rows` rows or about `max_bytes` bytes, and a manifest describing them.
+# every write is a row of a tsv file or, if `document_separator` is given, a block of lines of a text file, that are
+# counted as rows and are split in shards only after a separator, so that each shard starts with a new document.
+# shards are written by background threads: only the last one receives data, while at most `num_writers - 1` previous
+# ones finish to be written
+class ShardedWriter:
+
+    def __init__(
+        self,
+        output_file: str,
+        max_rows: int = None,
+        max_bytes: int = None,
+        num_writers: int = 4,
+        document_separator: str = None,
+        resume_state: Dict = None
+    ):
+        assert max_rows is None or max_rows > 0, "Rows per shard must be a positive number"
+        assert max_bytes is None or max_bytes > 0, "Bytes per shard must be a positive number"
+        assert num_writers > 0, "At least a shard writer is needed"
+
+        self.output_file = output_file
+        self.manifest_file = get_manifest_file(output_file)
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.num_writers = num_writers
+        self.document_separator = document_separator
+
+        self.buffer = []
+        self.buffer_rows = 0
+        self.buffer_bytes = 0
+        self.pending = ''
+        self.closing = []
+
+        if resume_state is None:
+            remove_sharded_output(output_file)
+
+        if resume_state is not None:
+            self.shards = resume_state['shards']
+            self.tail = resume_state['tail']
+            self.current = ShardFile(get_shard_file(output_file, len(self.shards)), resume_state=resume_state['current'])
+        else:
+            self.shards = []
+            # the beginning of the output counts as a boundary
+            self.tail = self.document_separator if document_separator is not None else ''
+            self.current = ShardFile(get_shard_file(output_file, 0))
+
+    # a new shard can start only after a document separator, if any
+    @property
+    def at_boundary(self) -> bool:
+        return self.document_separator is None or self.tail == self.document_separator
+
+    def is_full(self) -> bool:
+        rows = self.current.rows + self.buffer_rows
+        size = self.current.bytes + self.buffer_bytes
+        return (self.max_rows is not None and rows >= self.max_rows) or (self.max_bytes is not None and size >= self.max_bytes)
+
+    def write(self, data: Union[str, bytes]):
+        if self.document_separator is None:
+            if self.is_full():
+                self.next_shard()
+            self.append(data)
+            return
+
+        # the end of a block after its last separator waits for the next write, so that the current shard can end
+        # before the document it belongs to
+        data = self.pending + data
+        end = (self.tail + data).rfind(self.document_separator) + len(self.document_separator) - len(self.tail)
+        if end <= 0:
+            self.pending = data
+            return
+        self.pending = data[end:]
+        self.write_documents(data[:end])
+
+    # write complete documents, that may fill several shards
+    def write_documents(self, data: str):
+        # positions refer to the data preceded by the end of the previous write, where a separator may start
+        text = self.tail + data
+        start = len(self.tail)
+        while start < len(text):
+            if self.is_full() and self.at_boundary:
+                self.next_shard()
+            split = self.find_split(text, start)
+            if split is None:
+                self.append(text[start:])
+                break
+            if split > start:
+                self.append(text[start:split])
+            self.next_shard()
+            start = split
+
+    # position of `text` after `start` where the current shard ends, None if all of it goes in the current shard.
+    # shards end after the last separator that keeps them within the limits or, if a document alone exceeds them,
+    # after the first separator that follows
+    def find_split(self, text: str, start: int) -> int:
+        limit = len(text)
+        if self.max_bytes is not None:
+            room = max(self.max_bytes - self.current.bytes - self.buffer_bytes, 0)
+            # characters take at least a byte, the shard is full within the next `room` of them
+            limit = start + len(text[start:start + room].encode('utf-8')[:room].decode('utf-8', errors='ignore'))
+        if self.max_rows is not None:
+            end = start
+            for _ in range(max(self.max_rows - self.current.rows - self.buffer_rows, 0)):
+                end = text.find("\n", end) + 1
+                if end == 0:
+                    end = len(text)
+                    break
+            limit = min(limit, end)
+        if limit >= len(text):
+            return None
+
+        separator = self.document_separator
+        found = text.rfind(separator, max(start - len(separator) + 1, 0), limit)
+        if found >= 0:
+            return found + len(separator)
+        # a document that does not fit starts a new shard, unless it is alone in the current one
+        if self.at_boundary and self.current.bytes + self.buffer_bytes > 0:
+            return start
+        found = text.find(separator, max(limit - len(separator) + 1, 0))
+        return found + len(separator) if found >= 0 else None
+
+    def append(self, data: Union[str, bytes]):
+        if self.document_separator is not None:
+            rows = data.count("\n")
+            self.tail = (self.tail + data)[-len(self.document_separator):]
+        else:
+            rows = 1
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        self.buffer.append(data)
+        self.buffer_rows += rows
+        self.buffer_bytes += len(data)
+        if self.buffer_bytes >= BUFFER_SIZE:
+            self.flush_buffer()
+
+    # the last document of the data, that has no separator yet
+    def flush_pending(self):
+        if len(self.pending) > 0:
+            self.write_documents(self.pending)
+            self.pending = ''
+
+    def flush_buffer(self):
+        if len(self.buffer) > 0:
+            self.current.write(b''.join(self.buffer), self.buffer_rows)
+            self.buffer = []
+            self.buffer_rows = 0
+            self.buffer_bytes = 0
+
+    def next_shard(self):
+        self.flush_buffer()
+        self.current.close()
+        self.closing.append(self.current)
+        # the shard being filled counts as a writer
+        while len(self.closing) >= self.num_writers:
+            self.shards.append(self.closing.pop(0).join())
+        self.current = ShardFile(get_shard_file(self.output_file, len(self.shards) + len(self.closing)))
+
+    def finish_closing(self):
+        while len(self.closing) > 0:
+            self.shards.append(self.closing.pop(0).join())
+
+    # flush data to disk and return what is needed to resume writing after the last row
+    def state(self) -> Dict:
+        self.flush_pending()
+        self.flush_buffer()
+        self.finish_closing()
+        return {
+            'shards': list(self.shards),
+            'current': self.current.state(),
+            'tail': self.tail
+        }
+
+    def close(self):
+        self.flush_pending()
+        self.flush_buffer()
+        self.current.close()
+        self.closing.append(self.current)
+        self.finish_closing()
+
+        # an empty last shard is left only if it is the only one
+        if self.shards[-1]['rows'] == 0 and self.shards[-1]['bytes'] == 0 and len(self.shards) > 1:
+            os.remove(self.current.filename)
+            self.shards.pop()
+
+        save_json(self.manifest_file, {
+            'shards': self.shards,
+            'rows': sum(shard['rows'] for shard in self.shards),
+            'bytes': sum(shard['bytes'] for shard in self.shards)
+        })
+        logging.info(f"Written {len(self.shards)} shards listed in {self.manifest_file}")
+
+    def __enter__(self):
+        return self
+
+    # a manifest is written only if all the data was, interrupted runs are resumed from their checkpoints
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+# write a stream of data to a single file, with the same interface of `ShardedWriter`.
+# a file with a compression extension is compressed by a background thread
+class SingleFileWriter:
+
+    def __init__(self, output_file: str, resume_state: Dict = None):
+        self.compressed = get_compression(output_file) is not None
+        if self.compressed:
+            self.out_file = open_file(output_file, 'wb', resume_state=resume_state)
+        elif resume_state is not None:
+            os.truncate(output_file, resume_state['offset'])
+            self.out_file = open(output_file, 'ab')
+        else:
+            self.out_file = open(output_file, 'wb')
+
+    def write(self, data: Union[str, bytes]):
+        self.out_file.write(data.encode('utf-8') if isinstance(data, str) else data)
+
+    # flush data to disk and return what is needed to resume writing after the last row
+    def state(self) -> Dict:
+        if self.compressed:
+            return self.out_file.state()
+        self.out_file.flush()
+        os.fsync(self.out_file.fileno())
+        return {'offset': self.out_file.tell()}
+
+    def close(self):
+        self.out_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# open a single output file or, if `sharding_kwargs` are given, a sharded output.
+# data can be written directly or through a csv writer, that writes a row at a time
+def open_output(output_file: str, sharding_kwargs: Dict = None, document_separator: str = None, resume_state: Dict = None):
+    if sharding_kwargs is not None:
+        return ShardedWriter(output_file, document_separator=document_separator, resume_state=resume_state, **sharding_kwargs)
+    return SingleFileWriter(output_file, resume_state=resume_state)
@@ -0,0 +1,50 @@
+import logging
+import pickle
+import time
+
+
+# load a pre-trained tokenizer. transformers takes about a second to import, so it is imported only here,
+# by the scripts that actually need a tokenizer
+def load_tokenizer(tokenizer_name: str):
+    start = time.perf_counter()
+    import transformers
+    tokenizer = transformers.AutoTokenizer.from_pretrained(tokenizer_name)
+    logging.info(f"Loaded tokenizer {tokenizer_name} in {time.perf_counter() - start:.2f}s")
+    return tokenizer
+
+
+# a tokenizer resolved and loaded once by the main process and shared with its workers, so that startup does not grow
+# with the number of processes. forked workers inherit the loaded tokenizer; with other start methods it is sent as
+# pickled bytes, that for fast tokenizers contain their tokenizer.json, and rebuilt without reading any file.
+# workers rebuild it only when they tokenize for the first time, so that runs reading all the lengths from the cache skip it
+class LazyTokenizer:
+
+    def __init__(self, tokenizer_name: str, tokenizer=None):
+        self.tokenizer_name = tokenizer_name
+        self.tokenizer = tokenizer
+        self.data = None
+
+    def __getstate__(self):
+        data = self.data
+        if data is None and self.tokenizer is not None:
+            data = pickle.dumps(self.tokenizer)
+        return {'tokenizer_name': self.tokenizer_name, 'tokenizer': None, 'data': data}
+
+    def get(self):
+        if self.tokenizer is None:
+            if self.data is not None:
+                self.tokenizer = pickle.loads(self.data)
+                self.data = None
+            else:
+                self.tokenizer = load_tokenizer(self.tokenizer_name)
+        return self.tokenizer
+
+    def __call__(self, *args, **kwargs):
+        return self.get()(*args, **kwargs)
+
+
+# load a tokenizer in the main process to share it with workers, None if no tokenizer is given
+def share_tokenizer(tokenizer_name: str) -> LazyTokenizer:
+    if tokenizer_name is None:
+        return None
+    return LazyTokenizer(tokenizer_name, tokenizer=load_tokenizer(tokenizer_name))
@@ -1,53 +1,61 @@
 import os
 from argparse import ArgumentParser
 import csv
+import io
 import logging
+import math
+import resource
+import tempfile
+import numpy as np
 from tqdm import tqdm
 import random
 from pathlib import Path
+from metrics import ProcessMetrics, ScriptMetrics, add_metrics_arguments
+from tsv_index import IndexedTsvReader
+from sharding import (
+    add_sharded_output_arguments,
+    get_input_files,
+    get_input_size,
+    get_sharding_kwargs,
+    is_manifest,
+    open_output,
+    output_exists,
+    read_tsv_rows
+)
 
 FORMAT_LOGGING = '%(levelname)s: %(message)s'
 logging.basicConfig(format=FORMAT_LOGGING)
 logging.getLogger().setLevel(logging.INFO)
+# typical ratio between the size of text and its gzip or xz compressed size
+COMPRESSION_RATIO = 4
+# files that may be open besides the buckets: standard streams, input, output and its index
+RESERVED_FILES = 32
 
 
-def main(args):
-
-    logging.info(f"Checking I/O files")
-    if args.output_file is None:
-        input_dump_file_in = Path(args.input_file)
-        args.output_file = input_dump_file_in.parent / f'{input_dump_file_in.stem}-shuffled{input_dump_file_in.suffix}'
-
-    assert not os.path.isfile(args.output_file) or args.force_overwrite, (
-        f"Cannot overwrite {args.output_file}, add -f option if you are cocky"
-    )
-    assert os.path.isfile(args.input_file), f"Input file {args.input_file} does not exist"
-
-    random.seed(args.seed)
+# shuffle in `rounds` passes over the input, keeping in memory the rows of a single round
+def shuffle_rounds(args, metrics: ProcessMetrics):
 
     logging.info("Assigning round number to each line")
     all_lines = []
 
-    with open(args.input_file) as in_file:
-        reader = csv.reader(in_file, delimiter="\t", quoting=csv.QUOTE_MINIMAL, quotechar='"')
-        for _ in tqdm(reader, desc="Reading input file"):
-            all_lines.append(random.randint(0, args.rounds-1))
+    for _ in tqdm(read_tsv_rows(args.input_file), desc="Reading input file"):
+        all_lines.append(random.randint(0, args.rounds-1))
+        metrics.add('lines', 1)
 
     logging.info(f"Starting {args.rounds} rounds")
 
     new_id = 0
-    with open(args.output_file, "w") as out_file:
+    with open_output(args.output_file, get_sharding_kwargs(args)) as out_file:
         writer = csv.writer(out_file, delimiter="\t", quoting=csv.QUOTE_MINIMAL, quotechar='"')
 
         for i in range(args.rounds):
             logging.info(f"Round {i+1}")
 
             lines_to_write = []
-            with open(args.input_file) as in_file:
-                reader = csv.reader(in_file, delimiter="\t", quoting=csv.QUOTE_MINIMAL, quotechar='"')
-                for row, _round in tqdm(zip(reader, all_lines), desc="Reading input file"):
-                    if _round == i:
-                        lines_to_write.append(row)
+            for row, _round in tqdm(zip(read_tsv_rows(args.input_file), all_lines), desc="Reading input file"):
+                metrics.add('lines', 1)
+                if _round == i:
+                    lines_to_write.append(row)
 
             random.shuffle(lines_to_write)
             for row in lines_to_write:
@@ -55,6 +63,145 @@ def main(args):
                     row[args.id_column] = new_id
                 writer.writerow(row)
                 new_id += 1
+            metrics.add('rows', len(lines_to_write))
+
+    return new_id
+
+
+# external-memory shuffle: scatter rows in random temporary buckets with a single read of the input,
+# then shuffle each bucket in memory and concatenate them. buckets are sized to fit in `memory_limit`
+def shuffle_buckets(args, metrics: ProcessMetrics):
+
+    # rows held in memory as python lists take a few times their size on disk.
+    # the uncompressed size of compressed inputs that can only be read sequentially is estimated from their size
+    input_size = get_input_size(args.input_file)
+    if input_size is None:
+        input_size = os.path.getsize(args.input_file) * COMPRESSION_RATIO
+    n_buckets = max(1, math.ceil(input_size * args.memory_overhead / (args.memory_limit * 1024 * 1024)))
+
+    # all the buckets are open while scattering the rows: the soft limit of open files is raised up to the hard one
+    needed_files = n_buckets + RESERVED_FILES
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit != resource.RLIM_INFINITY and needed_files > soft_limit:
+        soft_limit = needed_files if hard_limit == resource.RLIM_INFINITY else min(needed_files, hard_limit)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft_limit, hard_limit))
+    assert soft_limit == resource.RLIM_INFINITY or needed_files <= soft_limit, (
+        f"{n_buckets} buckets exceed the limit of {soft_limit} open files, increase --memory_limit to at least "
+        f"{math.ceil(input_size * args.memory_overhead / ((soft_limit - RESERVED_FILES) * 1024 * 1024))} MB"
+    )
+    logging.info(f"Scattering rows in {n_buckets} buckets")
+
+    tmp_dir = args.tmp_dir if args.tmp_dir is not None else os.path.dirname(os.path.abspath(args.output_file))
+    with tempfile.TemporaryDirectory(dir=tmp_dir, prefix="shuffle-") as buckets_dir:
+        bucket_files = [os.path.join(buckets_dir, f"bucket-{i}.tsv") for i in range(n_buckets)]
+
+        bucket_outs = [open(bucket_file, "w") for bucket_file in bucket_files]
+        try:
+            bucket_writers = [
+                csv.writer(bucket_out, delimiter="\t", quoting=csv.QUOTE_MINIMAL, quotechar='"') for bucket_out in bucket_outs
+            ]
+            for row in tqdm(read_tsv_rows(args.input_file), desc="Scattering input file"):
+                bucket_writers[random.randrange(n_buckets)].writerow(row)
+                metrics.add('lines', 1)
+        finally:
+            for bucket_out in bucket_outs:
+                bucket_out.close()
+
+        new_id = 0
+        with open_output(args.output_file, get_sharding_kwargs(args)) as out_file:
+            writer = csv.writer(out_file, delimiter="\t", quoting=csv.QUOTE_MINIMAL, quotechar='"')
+
+            for bucket_file in tqdm(bucket_files, desc="Shuffling buckets"):
+                with open(bucket_file) as in_file:
+                    reader = csv.reader(in_file, delimiter="\t", quoting=csv.QUOTE_MINIMAL, quotechar='"')
+                    lines_to_write = list(reader)
+                os.remove(bucket_file)
+
+                random.shuffle(lines_to_write)
+                for row in lines_to_write:
+                    if args.id_column is not None:
+                        row[args.id_column] = new_id
+                    writer.writerow(row)
+                    new_id += 1
+                metrics.add('rows', len(lines_to_write))
+
+    return new_id
+
+
+# replace a field of a raw tsv row without parsing it, unless quoted fields could contain tabs
+def replace_raw_field(raw: bytes, column: int, value: int) -> bytes:
+    start = 0
+    for _ in range(column):
+        start = raw.find(b'\t', start) + 1
+        if start == 0:
+            raise ValueError(f"Row {raw} does not have column {column}")
+
+    end = raw.find(b'\t', start)
+    if end < 0:
+        end = len(raw.rstrip(b'\r\n'))
+
+    if b'"' in raw[:end]:
+        row = next(csv.reader(io.StringIO(raw.decode('utf-8'), newline=''), delimiter="\t", quoting=csv.QUOTE_MINIMAL, quotechar='"'))
+        row[column] = value
+        out = io.StringIO(newline='')
+        csv.writer(out, delimiter="\t", quoting=csv.QUOTE_MINIMAL, quotechar='"').writerow(row)
+        return out.getvalue().encode('utf-8')
+
+    return raw[:start] + str(value).encode('utf-8') + raw[end:]
+
+
+# shuffle a permutation of the row offsets and copy the raw bytes of each row from a memory map of the input.
+# rows are never parsed, except to rewrite the id of rows with quoted fields before the id column
+def shuffle_offsets(args, metrics: ProcessMetrics):
+
+    readers = [IndexedTsvReader(filename) for filename in get_input_files(args.input_file)]
+    try:
+        # rows of the shards of a manifest are numbered one after the other
+        starts = np.cumsum([0] + [len(reader) for reader in readers])
+        permutation = np.random.default_rng(args.seed).permutation(starts[-1])
+        shards = np.searchsorted(starts, permutation, side='right') - 1
+        rows = permutation - starts[shards]
+
+        with open_output(args.output_file, get_sharding_kwargs(args)) as out_file:
+            for new_id, (shard, idx) in enumerate(tqdm(zip(shards, rows), desc="Copying rows", total=len(permutation))):
+                raw = readers[shard].get_raw(idx)
+                # last row of the input may miss the line terminator
+                if not raw.endswith(b'\n'):
+                    raw += b'\r\n'
+                if args.id_column is not None:
+                    raw = replace_raw_field(raw, args.id_column, new_id)
+                out_file.write(raw)
+                metrics.add('bytes', len(raw))
+                metrics.add('rows', 1)
+    finally:
+        for reader in readers:
+            reader.close()
+
+    return len(permutation)
+
+
+def main(args):
+
+    logging.info(f"Checking I/O files")
+    if args.output_file is None:
+        assert not is_manifest(args.input_file), "Output file must be specified when reading a manifest"
+        input_dump_file_in = Path(args.input_file)
+        args.output_file = input_dump_file_in.parent / f'{input_dump_file_in.stem}-shuffled{input_dump_file_in.suffix}'
+
+    assert not output_exists(args.output_file) or args.force_overwrite, (
+        f"Cannot overwrite {args.output_file}, add -f option if you are cocky"
+    )
+    assert os.path.isfile(args.input_file), f"Input file {args.input_file} does not exist"
+
+    random.seed(args.seed)
+
+    with ScriptMetrics(args, 'shuffle') as metrics:
+        if args.mode == 'buckets':
+            new_id = shuffle_buckets(args, metrics.main)
+        elif args.mode == 'offsets':
+            new_id = shuffle_offsets(args, metrics.main)
+        else:
+            new_id = shuffle_rounds(args, metrics.main)
 
     logging.info(f"Written {new_id} lines, done!")
 
@@ -65,7 +212,7 @@ if __name__ == "__main__":
 
     # Global level parameters
     parser.add_argument('-i', '--input_file', type=str, required=True,
-                        help="Preprocessed dataset")
+                        help="Preprocessed dataset, or the manifest of a sharded one")
     parser.add_argument('-o', '--output_file', type=str, required=False, default=None,
                         help='Specify an output file')
     parser.add_argument('-f', '--force_overwrite', action="store_true",
@@ -76,6 +223,17 @@ if __name__ == "__main__":
                         help="Seed used for shuffling")
     parser.add_argument('--id_column', type=int, required=False, default=None,
                         help="Id column that should be changed ")
+    parser.add_argument('--mode', type=str, required=False, default='rounds', choices=['rounds', 'buckets', 'offsets'],
+                        help="Shuffle with many passes over the input, with a single pass through temporary buckets "
+                             "or by permuting row offsets and copying raw rows")
+    parser.add_argument('--memory_limit', type=int, required=False, default=4096,
+                        help="Approximate memory (in MB) available to shuffle a single bucket")
+    parser.add_argument('--memory_overhead', type=float, required=False, default=4.0,
+                        help="Ratio between memory used by rows loaded in python and their size on disk")
+    parser.add_argument('--tmp_dir', type=str, required=False, default=None,
+                        help="Folder for temporary buckets, defaults to the folder of the output file")
+    add_sharded_output_arguments(parser)
+    add_metrics_arguments(parser)
 
     # get NameSpace of paramters
     args = parser.parse_args()
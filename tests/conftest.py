@@ -0,0 +1,5 @@
+import os
+import sys
+
+# scripts are modules in the root folder of the repository
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,65 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from dedup import hash_block
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dedup.py")
+
+
+def run_dedup(input_file, output_file, *args):
+    subprocess.run([sys.executable, SCRIPT, "-i", str(input_file), "-o", str(output_file), "-f", "-p", "2", *args],
+                   check=True, capture_output=True)
+    with open(output_file) as in_fi:
+        return in_fi.read()
+
+
+def test_block_without_candidates_has_empty_band_keys():
+    data = b"first paragraph of the document .\nsecond paragraph .\n\n"
+    lines, candidates, hashes, band_keys, end = hash_block((data, len(data)), min_words=1000, near_dedup=True, bands=16)
+    assert len(lines) == 3 and end == len(data)
+    assert len(candidates) == 0 and len(hashes) == 0
+    assert band_keys.shape == (0, 16)
+
+
+def test_near_dedup_without_candidates(tmp_path):
+    text = "a paragraph with some words .\nanother paragraph with other words .\n\na paragraph with some words .\n"
+    (tmp_path / "pre.txt").write_text(text)
+    assert run_dedup(tmp_path / "pre.txt", tmp_path / "dd.txt", "--near_dedup", "--min_words", "1000") == text
+
+
+def test_titles_are_kept(tmp_path):
+    # documents with the same title and different paragraphs, some blocks start with a title
+    rng = np.random.default_rng(0)
+    words = lambda: " ".join(f"w{i}" for i in rng.integers(0, 100000, 12))
+    documents = [f"Tu\n{words()} .\n{words()} .\n" for _ in range(50)]
+    text = "\n".join(documents)
+    (tmp_path / "pre.txt").write_text(text)
+    for args in ([], ["--near_dedup"], ["-b", "64"], ["-b", "64", "--near_dedup"]):
+        assert run_dedup(tmp_path / "pre.txt", tmp_path / "dd.txt", *args) == text
+
+
+def test_repeated_paragraphs_are_removed(tmp_path):
+    text = "Title A\nboilerplate paragraph .\nfirst text .\n\nTitle B\nsecond text .\nboilerplate paragraph .\n\nTitle A\nboilerplate paragraph .\n"
+    (tmp_path / "pre.txt").write_text(text)
+    for block_size in ("4", "4096"):
+        output = run_dedup(tmp_path / "pre.txt", tmp_path / "dd.txt", "-b", block_size)
+        assert output == "Title A\nboilerplate paragraph .\nfirst text .\n\nTitle B\nsecond text .\n\n"
+
+
+def test_duplicated_documents_are_dropped(tmp_path):
+    document = "Title A\nfirst paragraph of the document .\nsecond paragraph of the document .\n"
+    other = "Title B\nanother paragraph .\n"
+    text = document + "\n" + other + "\n" + document + "\n" + other + "\nTitle C\n\n" + document
+    (tmp_path / "pre.txt").write_text(text)
+    for args in ([], ["--near_dedup"], ["-b", "16"]):
+        output = run_dedup(tmp_path / "pre.txt", tmp_path / "dd.txt", "--report_file", str(tmp_path / "report.json"), *args)
+        # documents made only of a title are kept
+        assert output == document + "\n" + other + "\nTitle C\n\n"
+        report = json.loads((tmp_path / "report.json").read_text())
+        assert report['documents'] == 6 and report['removed_documents'] == 3
+        assert report['removed_bytes'] == len(text) - len(output)
@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+from file_utils import get_tmp_file, load_checkpoint, remove_checkpoint, save_json
+
+
+def test_failed_save_keeps_previous_file(tmp_path):
+    filename = tmp_path / "data.json"
+    save_json(str(filename), {'step': 1})
+    with pytest.raises(TypeError):
+        save_json(str(filename), {'step': 2, 'data': object()})
+
+    assert json.loads(filename.read_text()) == {'step': 1}
+    assert not (tmp_path / "data.json.tmp").exists()
+
+
+def test_stale_tmp_file_of_checkpoint_is_removed(tmp_path):
+    checkpoint_file = str(tmp_path / "out.txt.checkpoint.json")
+    save_json(checkpoint_file, {'input_offset': 10})
+    # left by a run killed while saving the next checkpoint
+    with open(get_tmp_file(checkpoint_file), 'w') as out_fi:
+        out_fi.write('{"input_off')
+
+    assert load_checkpoint(checkpoint_file) == {'input_offset': 10}
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["out.txt.checkpoint.json"]
+
+    with open(get_tmp_file(checkpoint_file), 'w') as out_fi:
+        out_fi.write('{"input_off')
+    remove_checkpoint(checkpoint_file)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+
+from length_cache import CACHE_FILE, LengthCache, consolidate_cache
+
+
+def count_words(lines):
+    return [len(line.split()) for line in lines]
+
+
+def test_lengths_are_read_from_the_cache(tmp_path):
+    lines = ["one", "one two", "one two three"]
+    cache = LengthCache(str(tmp_path))
+    assert cache.get_lengths(lines, count_words) == [1, 2, 3]
+    cache.part_file.close()
+    consolidate_cache(str(tmp_path))
+
+    assert sorted(os.listdir(tmp_path)) == [CACHE_FILE, "lock"]
+    assert np.load(tmp_path / CACHE_FILE).shape == (2, 3)
+
+    computed = []
+    def compute_lengths(missing):
+        computed.extend(missing)
+        return count_words(missing)
+    cache = LengthCache(str(tmp_path))
+    assert cache.get_lengths(lines + ["four words are here"], compute_lengths) == [1, 2, 3, 4]
+    assert computed == ["four words are here"]
+
+
+def test_parts_of_running_workers_are_kept(tmp_path):
+    finished = LengthCache(str(tmp_path))
+    finished.get_lengths(["one", "one two"], count_words)
+    finished.part_file.close()
+    running = LengthCache(str(tmp_path))
+    running.get_lengths(["one two three"], count_words)
+    running_part = running.part_file.name
+
+    consolidate_cache(str(tmp_path))
+    assert os.path.isfile(running_part)
+    assert np.load(tmp_path / CACHE_FILE).shape == (2, 2)
+
+    running.get_lengths(["four words are here"], count_words)
+    running.part_file.close()
+    consolidate_cache(str(tmp_path))
+    assert not os.path.isfile(running_part)
+    assert LengthCache(str(tmp_path)).get_lengths(
+        ["one", "one two", "one two three", "four words are here"], lambda missing: [0] * len(missing)) == [1, 2, 3, 4]
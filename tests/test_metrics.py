@@ -0,0 +1,35 @@
+import time
+from argparse import Namespace
+
+from metrics import ScriptMetrics, TimedTask
+
+
+def slow_square(x):
+    time.sleep(0.01)
+    return x * x
+
+
+def slow_results(n):
+    for result in map(TimedTask(slow_square), range(n)):
+        time.sleep(0.01)
+        yield result
+
+
+def test_script_metrics_with_pool(tmp_path):
+    args = Namespace(metrics_file=str(tmp_path / "metrics.jsonl"), metrics_format='jsonl', metrics_interval=60.0)
+    with ScriptMetrics(args, 'test', pool=True) as metrics:
+        assert list(metrics.results(slow_results(10))) == [x * x for x in range(10)]
+        metrics.main.add('rows', 10)
+        snapshot = metrics.registry.snapshot(time.time())
+
+    assert snapshot['workers']['busy_seconds'] >= 0.1
+    assert snapshot['main']['wait_input_seconds'] >= 0.15
+    assert snapshot['main']['rows'] == 10
+    assert (tmp_path / "metrics.jsonl").read_text().count("\n") == 1
+
+
+def test_script_metrics_without_file():
+    with ScriptMetrics(Namespace(metrics_file=None), 'test', pool=True) as metrics:
+        assert list(metrics.results(slow_results(2))) == [0, 1]
+        metrics.main.add('rows', 2)
+    assert metrics.registry is None and metrics.reporter is None
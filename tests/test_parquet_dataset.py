@@ -0,0 +1,16 @@
+import pyarrow.parquet as pq
+
+from parquet_dataset import ParquetDatasetWriter
+
+
+def test_row_groups_are_sized_in_bytes(tmp_path):
+    # 3 bytes per character in utf-8, 2 for à
+    text = "città " * 1000 + "€" * 10000
+    writer = ParquetDatasetWriter(str(tmp_path / "out.parquet"), row_group_mb=1)
+    for i in range(100):
+        writer.write(i, text)
+    writer.close()
+
+    metadata = pq.ParquetFile(tmp_path / "out.parquet").metadata
+    # rows of 37000 bytes, but 16000 characters
+    assert [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)] == [29, 29, 29, 13]
@@ -0,0 +1,26 @@
+import random
+import tracemalloc
+
+from pipeline import ROW_OVERHEAD, BucketShuffler
+
+
+def test_bucket_shuffler_larger_than_memory_limit(tmp_path):
+    rng = random.Random(0)
+    rows = [f"row {i} " + "x" * rng.randrange(50, 500) for i in range(5000)]
+    memory_limit = sum(len(row) + ROW_OVERHEAD for row in rows) // 10
+
+    # a single bucket holds all the rows, ten times the memory limit
+    with BucketShuffler(1, memory_limit, tmp_dir=str(tmp_path), seed=1) as shuffler:
+        for row in rows:
+            shuffler.add(row)
+
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        shuffled = []
+        for row in shuffler:
+            shuffled.append(row)
+        peak = tracemalloc.get_traced_memory()[1] - start - sum(len(row) + ROW_OVERHEAD for row in shuffled)
+        tracemalloc.stop()
+
+    assert sorted(shuffled) == sorted(rows) and shuffled != rows
+    assert peak < 2 * memory_limit
@@ -0,0 +1,51 @@
+import random
+
+import pytest
+
+from sharding import ShardedWriter, get_input_files, load_manifest
+
+
+def write_documents(output_file, blocks, **kwargs):
+    with ShardedWriter(str(output_file), document_separator="\n\n", **kwargs) as writer:
+        for block in blocks:
+            writer.write(block)
+    shards = []
+    for filename in get_input_files(str(output_file.with_suffix(".manifest.json"))):
+        with open(filename, encoding="utf-8") as in_fi:
+            shards.append(in_fi.read())
+    return shards
+
+
+@pytest.mark.parametrize("word", ["word", "parola", "città"])
+def test_blocks_larger_than_shards_are_split(tmp_path, word):
+    rng = random.Random(0)
+    documents = [
+        "\n".join(" ".join([word] * rng.randrange(1, 20)) for _ in range(rng.randrange(1, 5))) + "\n\n"
+        for _ in range(2000)
+    ]
+    text = "".join(documents)
+    # blocks of several shards, that may end inside a document or between the two newlines of a separator
+    cuts = sorted(rng.sample(range(1, len(text)), 20))
+    blocks = [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+    max_bytes = 5000
+    shards = write_documents(tmp_path / "out.txt", blocks, max_bytes=max_bytes)
+    assert "".join(shards) == text
+    assert len(shards) >= len(text.encode("utf-8")) // max_bytes
+    for shard in shards:
+        assert len(shard.encode("utf-8")) <= max_bytes
+        assert shard.endswith("\n\n") and not shard.startswith("\n")
+
+
+def test_rows_limit_inside_blocks(tmp_path):
+    documents = [f"title {i}\nfirst line\nsecond line\n\n" for i in range(100)]
+    shards = write_documents(tmp_path / "out.txt", ["".join(documents)], max_rows=10)
+    assert shards == ["".join(documents[i:i + 2]) for i in range(0, len(documents), 2)]
+    manifest = load_manifest(tmp_path / "out.manifest.json")
+    assert [shard["rows"] for shard in manifest["shards"]] == [8] * 50
+
+
+def test_documents_larger_than_shards(tmp_path):
+    documents = ["short\n\n", "long " * 100 + "\n\n", "short\n\n", "short\n\n"]
+    shards = write_documents(tmp_path / "out.txt", ["".join(documents)], max_bytes=100)
+    assert shards == [documents[0], documents[1], documents[2] + documents[3]]
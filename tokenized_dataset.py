@@ -0,0 +1,97 @@
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+# pre-tokenized datasets are stored in two files sharing the same name:
+#  - `<name>.bin`: token ids of all the rows, one after the other, as uint16 or uint32
+#  - `<name>.idx`: int64 values, a header with the token itemsize and the number of rows
+#    followed by `rows + 1` offsets (in tokens) of each row inside the `.bin` file
+IDX_HEADER_SIZE = 2
+
+
+# get paths of the .bin and .idx files of a pre-tokenized dataset
+def get_tokenized_dataset_files(filename: str) -> Tuple[Path, Path]:
+    filename = Path(filename)
+    return filename.with_suffix('.bin'), filename.with_suffix('.idx')
+
+
+# smallest unsigned type able to store all the ids of a vocabulary
+def get_token_dtype(vocab_size: int):
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+
+# write rows of token ids to a .bin file and their offsets to the .idx file.
+# `resume_state` is the value of `state()` saved by a previous interrupted run
+class TokenizedDatasetWriter:
+
+    def __init__(self, filename: str, vocab_size: int, resume_state: Dict = None):
+        self.bin_file, self.idx_file = get_tokenized_dataset_files(filename)
+        self.dtype = get_token_dtype(vocab_size)
+        itemsize = np.dtype(self.dtype).itemsize
+
+        if resume_state is not None:
+            self.rows = resume_state['rows']
+            self.offset = resume_state['offset']
+            os.truncate(self.bin_file, self.offset * itemsize)
+            os.truncate(self.idx_file, (IDX_HEADER_SIZE + self.rows + 1) * np.dtype(np.int64).itemsize)
+            self.bin_out = open(self.bin_file, 'ab')
+            self.idx_out = open(self.idx_file, 'r+b')
+            self.idx_out.seek(0, os.SEEK_END)
+        else:
+            self.rows = 0
+            self.offset = 0
+            self.bin_out = open(self.bin_file, 'wb')
+            self.idx_out = open(self.idx_file, 'wb')
+            # number of rows is written again when closing the file
+            self.idx_out.write(np.array([itemsize, 0, 0], dtype=np.int64).tobytes())
+
+    def write(self, row_id: int, ids: List[int]):
+        self.bin_out.write(np.array(ids, dtype=self.dtype).tobytes())
+        self.offset += len(ids)
+        self.rows += 1
+        self.idx_out.write(np.array([self.offset], dtype=np.int64).tobytes())
+
+    # flush data to disk and return what is needed to resume writing after the last row
+    def state(self) -> Dict:
+        for out in (self.bin_out, self.idx_out):
+            out.flush()
+            os.fsync(out.fileno())
+        return {'rows': self.rows, 'offset': self.offset}
+
+    def close(self):
+        self.bin_out.close()
+        self.idx_out.seek(np.dtype(np.int64).itemsize)
+        self.idx_out.write(np.array([self.rows], dtype=np.int64).tobytes())
+        self.idx_out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# memory-mapped access to the rows of a pre-tokenized dataset
+class TokenizedDataset:
+
+    def __init__(self, filename: str):
+        bin_file, idx_file = get_tokenized_dataset_files(filename)
+        index = np.memmap(idx_file, dtype=np.int64, mode='r')
+        itemsize, rows = index[:IDX_HEADER_SIZE]
+        dtype = np.uint16 if itemsize == np.dtype(np.uint16).itemsize else np.uint32
+
+        self.offsets = index[IDX_HEADER_SIZE:IDX_HEADER_SIZE + rows + 1]
+        self.tokens = np.memmap(bin_file, dtype=dtype, mode='r') if self.offsets[-1] > 0 else np.zeros(0, dtype=dtype)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Row {idx} out of range for dataset with {len(self)} rows")
+        return self.tokens[self.offsets[idx]:self.offsets[idx + 1]]
@@ -0,0 +1,223 @@
+import csv
+import io
+import logging
+import mmap
+import os
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Iterator, List, Tuple, Union
+
+import numpy as np
+from tqdm import tqdm
+
+from compressed_io import get_compression, get_file_size, is_seekable, open_file
+
+
+FORMAT_LOGGING = '%(levelname)s: %(message)s'
+logging.basicConfig(format=FORMAT_LOGGING)
+logging.getLogger().setLevel(logging.INFO)
+
+NEWLINE = ord('\n')
+QUOTE = ord('"')
+
+
+# default path of the row index of a tsv file
+def get_index_file(filename: str) -> Path:
+    filename = Path(filename)
+    return filename.parent / f'{filename.name}.index.npy'
+
+
+# yield consecutive chunks of a file together with the positions, inside each chunk, of the newlines that end a row.
+# a newline terminates a row only outside quoted fields, that is after an even number of quote chars,
+# since quotes inside fields are always escaped by doubling them. compressed files are decompressed on the fly
+def scan_chunks(filename: str, chunk_size: int = 64 * 1024 * 1024, desc: str = "Indexing rows", progress: bool = True) -> Iterator[Tuple[bytes, np.ndarray]]:
+    quotes = 0
+
+    with open_file(filename, 'rb') as in_fi:
+        with tqdm(total=get_file_size(filename), desc=desc, unit='B', unit_scale=True, disable=not progress) as pbar:
+            while True:
+                chunk = in_fi.read(chunk_size)
+                if not chunk:
+                    break
+
+                data = np.frombuffer(chunk, dtype=np.uint8)
+                newlines = np.flatnonzero(data == NEWLINE)
+                quote_positions = np.flatnonzero(data == QUOTE)
+                if len(quote_positions) > 0 or quotes % 2 == 1:
+                    quotes_before = quotes + np.searchsorted(quote_positions, newlines)
+                    newlines = newlines[quotes_before % 2 == 0]
+                    quotes += len(quote_positions)
+
+                yield chunk, newlines
+                pbar.update(len(chunk))
+
+
+# yield, for consecutive chunks of a file, the byte offsets where rows end and the offset where the chunk ends,
+# which after the last chunk is the size of the uncompressed file
+def iter_row_ends(filename: str, chunk_size: int = 64 * 1024 * 1024, desc: str = "Indexing rows", progress: bool = True) -> Iterator[Tuple[np.ndarray, int]]:
+    position = 0
+    for chunk, newlines in scan_chunks(filename, chunk_size, desc=desc, progress=progress):
+        ends = newlines.astype(np.int64) + position + 1
+        position += len(chunk)
+        yield ends, position
+
+
+# yield the raw bytes of the rows of a tsv file, including line terminators
+def iter_raw_rows(filename: str, chunk_size: int = 64 * 1024 * 1024, progress: bool = True) -> Iterator[bytes]:
+    rest = b''
+    for chunk, newlines in scan_chunks(filename, chunk_size, desc=f"Reading {os.path.basename(filename)}", progress=progress):
+        start = 0
+        for end in (newlines + 1).tolist():
+            yield rest + chunk[start:end] if start == 0 else chunk[start:end]
+            rest = b''
+            start = end
+        rest += chunk[start:]
+    # last row may not be terminated by a newline
+    if len(rest) > 0:
+        yield rest
+
+
+# find the byte offset of the beginning of each row, plus the file size as last element
+def find_row_offsets(filename: str, chunk_size: int = 64 * 1024 * 1024) -> np.ndarray:
+    chunks = [np.zeros(1, dtype=np.int64)]
+    size = 0
+    for ends, size in iter_row_ends(filename, chunk_size):
+        chunks.append(ends)
+    offsets = np.concatenate(chunks)
+    # last row may not be terminated by a newline
+    if offsets[-1] != size:
+        offsets = np.append(offsets, size)
+    return offsets
+
+
+# number of rows of a tsv file, without keeping their offsets in memory
+def count_rows(filename: str, chunk_size: int = 64 * 1024 * 1024, progress: bool = True) -> int:
+    rows = 0
+    last_end = 0
+    size = 0
+    for ends, size in iter_row_ends(filename, chunk_size, desc=f"Counting rows of {os.path.basename(filename)}", progress=progress):
+        rows += len(ends)
+        if len(ends) > 0:
+            last_end = ends[-1]
+    # last row may not be terminated by a newline
+    return rows + int(last_end != size)
+
+
+# byte ranges [start, end) of the rows with the given sorted indices, found with a scan of the file
+# that does not keep the offsets of all the rows in memory
+def locate_rows(filename: str, indices: np.ndarray, chunk_size: int = 64 * 1024 * 1024, progress: bool = True) -> np.ndarray:
+    ranges = np.zeros((len(indices), 2), dtype=np.int64)
+    row = 0
+    last_end = 0
+    size = 0
+    for ends, size in iter_row_ends(filename, chunk_size, desc=f"Locating rows of {os.path.basename(filename)}", progress=progress):
+        if len(ends) == 0:
+            continue
+        first, last = np.searchsorted(indices, [row, row + len(ends)])
+        local = indices[first:last] - row
+        ranges[first:last, 0] = np.concatenate([[last_end], ends[:-1]])[local]
+        ranges[first:last, 1] = ends[local]
+        row += len(ends)
+        last_end = ends[-1]
+
+    # last row may not be terminated by a newline
+    if last_end != size:
+        first, last = np.searchsorted(indices, [row, row + 1])
+        ranges[first:last] = (last_end, size)
+        row += 1
+
+    assert len(indices) == 0 or indices[-1] < row, f"File {filename} has only {row} rows"
+    return ranges
+
+
+# build the row index of a tsv file and save it as a numpy file
+def build_row_index(filename: str, index_file: str = None) -> Path:
+    index_file = Path(index_file) if index_file is not None else get_index_file(filename)
+    offsets = find_row_offsets(filename)
+    with open(index_file, 'wb') as out_fi:
+        np.save(out_fi, offsets)
+    logging.info(f"Indexed {len(offsets) - 1} rows of {filename} in {index_file}")
+    return index_file
+
+
+# random access to the rows of a tsv file through a memory map and a row index.
+# seekable zstandard files are read decompressing the frames that contain the requested rows
+class IndexedTsvReader:
+
+    def __init__(self, filename: str, index_file: str = None, build_index: bool = True):
+        assert is_seekable(filename), f"Random access to {filename} is not possible, use a plain or .zst file"
+        index_file = Path(index_file) if index_file is not None else get_index_file(filename)
+        if not index_file.is_file() or os.path.getmtime(index_file) < os.path.getmtime(filename):
+            assert build_index, f"Index {index_file} is missing or older than {filename}"
+            build_row_index(filename, index_file)
+
+        self.filename = filename
+        self.offsets = np.load(index_file, mmap_mode='r')
+        self.in_file = open_file(filename, 'rb', threaded=False)
+        if get_compression(filename) is not None:
+            self.data = None
+        else:
+            size = os.path.getsize(filename)
+            self.data = mmap.mmap(self.in_file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # raw bytes of the rows in [start, end), including line terminators
+    def get_raw(self, start: int, end: int = None) -> bytes:
+        end = start + 1 if end is None else end
+        if self.data is None:
+            self.in_file.seek(int(self.offsets[start]))
+            return self.in_file.read(int(self.offsets[end] - self.offsets[start]))
+        return self.data[self.offsets[start]:self.offsets[end]]
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[List[str], List[List[str]]]:
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            if stop <= start:
+                return []
+            return list(self._parse(self.get_raw(start, stop)))
+
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Row {idx} out of range for file with {len(self)} rows")
+        return next(self._parse(self.get_raw(idx)))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def _parse(self, data: bytes):
+        return csv.reader(io.StringIO(data.decode('utf-8'), newline=''), delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.in_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser("Build a row index to randomly access rows of a tsv dataset")
+
+    # Global level parameters
+    parser.add_argument('-i', '--input_file', type=str, required=True,
+                        help="Tsv dataset created by create_dataset.py, multilingual_dataset.py or shuffle.py")
+    parser.add_argument('-o', '--index_file', type=str, required=False, default=None,
+                        help="Output index file, defaults to <input_file>.index.npy")
+
+    # get NameSpace of paramters
+    args = parser.parse_args()
+
+    assert os.path.isfile(args.input_file), f"Input file {args.input_file} does not exist"
+
+    build_row_index(args.input_file, args.index_file)
@@ -1,48 +1,87 @@
 import os
+import re
+import sys
 from argparse import ArgumentParser
 import csv
+from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from compressed_io import open_file
+
+SPACES = re.compile(" {2,}")
+
+
+# parse a file extracted by wikiextractor in a separate process. returns the lines that continue the last
+# document of the previous file and the documents starting in this file, as lists of lines beginning with the title
+def parse_file(filename):
+    continuation = []
+    documents = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 0:
+                if line.startswith("<doc id="):
+                    documents.append([])
+                elif line.startswith("</doc>"):
+                    pass
+                else:
+                    # collapse runs of spaces in a single pass
+                    line = SPACES.sub(" ", line)
+                    (documents[-1] if len(documents) > 0 else continuation).append(line)
+    return continuation, documents
+
+
 if __name__ == "__main__":
     parser = ArgumentParser("Parse multiple wikipedia processed dumps into a single dataset")
 
     # Global level parameters
     parser.add_argument('-i', '--input_folder', type=str)
     parser.add_argument('-o', '--output_file', type=str)
+    parser.add_argument('-p', '--processes', type=int, default=cpu_count(),
+                        help="Number of processes parsing files in parallel")
     args = parser.parse_args()
 
+    # files are parsed in parallel but results are read in the same order of a sequential run,
+    # so that documents get the same ids
+    files = []
+    for subfolder in os.listdir(args.input_folder):
+        path_subfolder = os.path.join(args.input_folder, subfolder)
+        files += [(subfolder, os.path.join(path_subfolder, page)) for page in os.listdir(path_subfolder)]
+
     i = 0
-    with open(args.output_file, 'w') as fout:
+    with open_file(args.output_file, 'w') as fout, Pool(args.processes) as p:
         writer = csv.writer(fout, delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL)
 
-        subdirs = os.listdir(args.input_folder)
-        for subfolder in tqdm(subdirs, desc="Subfolder iterator", total=len(subdirs), position=1):
-
-            path_subfolder = os.path.join(args.input_folder, subfolder)
-
-            page_documents = []
-            pages = os.listdir(path_subfolder)
-            for page in tqdm(pages, desc="File iterator", total=len(pages), position=1):
-
-                with open(os.path.join(path_subfolder, page), 'r') as f:
-                    for line in f.readlines():
-                        line = line.strip()
-                        if len(line) > 0:
-                            if line.startswith("<doc id="):
-                                page_documents.append([])
-                            elif line.startswith("</doc>"):
-                                pass
-                            else:
-                                while "  " in line:
-                                    line = " ".join(line.split('  '))
-
-                                page_documents[-1].append(line)
-            
-            print('Writing {} to {}...'.format(i, i + len(page_documents)), end='\r')
-            rows = [(i + rel_idx, doc[0], ' '.join(doc[1:])) for rel_idx, doc in enumerate(page_documents)]
-            
-            for row in rows:
-                writer.writerow(row)
-            i += len(page_documents)
-
-    print('Done.')
+        def write_document(doc):
+            global i
+            writer.writerow((i, doc[0], ' '.join(doc[1:])))
+            i += 1
+
+        # the last document of a file is written only when the next file of the same subfolder does not continue it
+        last_document = None
+        last_subfolder = None
+        results = p.imap(parse_file, [filename for _, filename in files], chunksize=4)
+        for (subfolder, filename), (continuation, documents) in tqdm(zip(files, results), desc="File iterator", total=len(files)):
+
+            if subfolder != last_subfolder:
+                if last_document is not None:
+                    write_document(last_document)
+                last_document = None
+                last_subfolder = subfolder
+
+            if len(continuation) > 0:
+                assert last_document is not None, f"File {filename} starts outside of a document"
+                last_document += continuation
+
+            if len(documents) > 0:
+                if last_document is not None:
+                    write_document(last_document)
+                for doc in documents[:-1]:
+                    write_document(doc)
+                last_document = documents[-1]
+
+        if last_document is not None:
+            write_document(last_document)
+
+    print(f'Written {i} documents. Done.')
@@ -2,30 +2,132 @@ import sys
 import os
 from argparse import ArgumentParser
 import csv
+import threading
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
+from typing import Iterable, Iterator, List, Tuple
 from tqdm import tqdm
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from compressed_io import open_file
+from shared_tokenizer import LazyTokenizer, share_tokenizer
+
 csv.field_size_limit(csv.field_size_limit() * 3)
 
-def get_seq(args, ret, sequences, pos, current_len):
+# tokenizer of each worker process, used to measure the length of the sentences in tokens
+tokenizer = None
+
+
+def init_tokenizer(shared_tokenizer: LazyTokenizer):
+    global tokenizer
+    tokenizer = shared_tokenizer
+
+
+# split the text of documents in sentences and compute their lengths once, in words or, if a tokenizer is loaded,
+# in tokens with a single batched call. sentences are stripped as when their words are joined back
+def prepare_documents(rows: List[List[str]]) -> List[Tuple[str, str, List[str], List[int]]]:
+    documents = []
+    for row in rows:
+        assert len(row) == 3
+        id, title, line = row
+        if len(line) > 0:
+            sentences = [sentence.strip() for sentence in line.split('.')]
+            documents.append((id, title, sentences))
+
+    if tokenizer is not None:
+        all_sentences = [sentence for _, _, sentences in documents for sentence in sentences]
+        lengths = iter(tokenizer(all_sentences, add_special_tokens=False, return_attention_mask=False, return_length=True)['length']) if len(all_sentences) > 0 else iter([])
+        return [(id, title, sentences, list(islice(lengths, len(sentences)))) for id, title, sentences in documents]
+
+    return [(id, title, sentences, [sentence.count(' ') + 1 for sentence in sentences]) for id, title, sentences in documents]
+
+
+def get_seq(args, ret, sequences, lengths, pos, current_len):
 
     for i in range(pos, len(sequences)):
-                        
-        words = sequences[i].strip().split(' ')
 
-        if len(words) > args.max_seq_len or len(words) < args.min_seq_len:
+        if lengths[i] > args.max_seq_len or lengths[i] < args.min_seq_len:
             pos = i+1 if i+1 < len(sequences) else -1
             break
 
-        current_len += len(words)
+        current_len += lengths[i]
         if current_len > args.max_seq_len:
             pos = i
             break
-        ret.append(words)
+        ret.append(sequences[i])
         pos = -1
 
     return ret, pos, current_len
 
 
+# weave sentences of two documents at a time in pairs of sequences of at most max_seq_len words (or tokens).
+# when a document ends it is replaced by the next one, while the other goes on with its remaining sentences
+def build_pairs(args, documents: Iterable[Tuple[str, str, List[str], List[int]]]) -> Iterator[List]:
+    seq_a=None
+    seq_b=None
+    seq_A = []
+    seq_B = []
+    len_A = 0
+    len_B = 0
+    i_a = 0
+    i_b = 0
+
+    for document in documents:
+
+        if seq_a is None:
+            seq_a = document
+        elif seq_b is None:
+            seq_b = document
+
+        if seq_a and seq_b:
+
+            id_A, title_A, phrases_A, lengths_A = seq_a
+            id_B, title_B, phrases_B, lengths_B = seq_b
+
+            while seq_a is not None and seq_b is not None:
+
+                seq_A, i_a, len_A = get_seq(args, seq_A, phrases_A, lengths_A, i_a, len_A)
+                seq_B, i_b, len_B = get_seq(args, seq_B, phrases_B, lengths_B, i_b, len_B)
+
+                if len(seq_A) > 0 and len(seq_B) > 0:
+
+                    A = '.'.join(seq_A).strip()
+                    B = '.'.join(seq_B).strip()
+
+                    if len(A) > 1 and len(B) > 1:
+                        row = [int(id_A), int(id_B), title_A, title_B, A, B]
+                        assert "  " not in row[4] and "  " not in row[5]
+                        yield row
+
+                    seq_A = []
+                    seq_B = []
+                    len_A = 0
+                    len_B = 0
+
+                if i_a < 0:
+                    seq_a = None
+                    i_a = 0
+
+                if i_b < 0:
+                    seq_b = None
+                    i_b = 0
+
+
+# read consecutive rows of the input in chunks, waiting for a free slot before reading the next one
+def yield_chunks(reader, chunk_size, slots):
+    while True:
+        chunk = list(islice(reader, chunk_size))
+        if len(chunk) == 0:
+            break
+        slots.acquire()
+        yield chunk
+
+
+# build the pairs of a chunk of consecutive documents in a worker process
+def process_chunk(args, chunk):
+    return list(build_pairs(args, prepare_documents(chunk)))
+
 
 if __name__ == "__main__":
     parser = ArgumentParser("Parse multiple wikipedia processed dumps into a single dataset")
@@ -35,102 +137,38 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--output_file', type=str)
     parser.add_argument('-maxsl', '--max_seq_len', type=int, default=128)
     parser.add_argument('-minsl', '--min_seq_len', type=int, default=2)
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help="Build pairs of chunks of consecutive documents in parallel processes")
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help="Number of consecutive documents of a chunk when using more processes")
+    parser.add_argument('--tokenizer', type=str, default=None,
+                        help="Measure lengths of sequences in tokens of this pre-trained tokenizer instead of words")
+    parser.add_argument('--batch_tokenization', type=int, default=1000,
+                        help="Number of documents whose sentences are tokenized at once in a single process")
     args = parser.parse_args()
 
-    i = 0
-    with open(args.input_file, 'r') as fin, open(args.output_file, 'w') as fout:
+    with open_file(args.input_file, 'r') as fin, open_file(args.output_file, 'w') as fout:
         writer = csv.writer(fout, delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL)
         reader = csv.reader(fin, delimiter="\t", quotechar='"', quoting=csv.QUOTE_MINIMAL)
 
-        seq_a=None
-        seq_b=None
-        seq_A = []
-        seq_B = []
-        len_A = 0
-        len_B = 0
-        i_a = 0
-        i_b = 0
-
         idx = 0
-        for line in tqdm(reader):
-
-            assert len(line) == 3
-            id, title, line = line
-
-            if len(line) > 0:
-                if seq_a is None:
-                    seq_a = (id, title, line.split('.'))
-                elif seq_b is None:
-                    seq_b = (id, title, line.split('.'))
-
-            if seq_a and seq_b:
-
-                id_A, title_A, phrases_A = seq_a
-                id_B, title_B, phrases_B = seq_b
-
-                while seq_a is not None and seq_b is not None:                
-                
-                    seq_A, i_a, len_A = get_seq(args, seq_A, phrases_A, i_a, len_A)
-                    seq_B, i_b, len_B = get_seq(args, seq_B, phrases_B, i_b, len_B)
-
-                    """
-                    for i in range(i_a, len(phrases_A)):
-                        
-                        words = phrases_A[i].split(' ')
-
-                        if len(words) > args.max_seq_len or len(words) < args.min_seq_len:
-                            i_a = i+1 if i+1 < len(phrases_A) else -1
-                            break
-
-                        len_A += len(words)
-                        if len_A > args.max_seq_len:
-                            i_a = i
-                            break
-                        seq_A.append(words)
-                        i_a = -1
-
-                    for i in range(i_b, len(phrases_B)):
-
-                        if len(phrases_B[i]) > args.max_seq_len:
-                            i_b = i+1 if i+1 < len(phrases_B) else -1
-                            break
-
-                        len_B += len(phrases_B[i])
-                        if len_B > args.max_seq_len:
-                            i_b = i
-                            break
-                        seq_B.append(phrases_B[i])
-                        i_b = -1
-                    """
-
-                    if len(seq_A) > 0 and len(seq_B) > 0:
-
-                        A = '.'.join([" ".join(l).strip() for l in seq_A]).strip()
-                        B =  '.'.join([" ".join(l).strip() for l in seq_B]).strip()
-
-                        if len(A) <= 1:
-                            print(":::", len_A, "-->",seq_A, "-->", A,"<<<")
-                        if len(B) <= 1:
-                            print(":::", len_B,"-->",seq_B, "-->", B,"<<<")
-
-                        if len(A) > 1 and len(B) > 1:
-                            row = [idx, int(id_A), int(id_B), title_A, title_B, A, B]
-                            assert len(row) == 7
-                            assert "  " not in row[5] and "  " not in row[6]
-
-                        writer.writerow(row)
-                        seq_A = []
-                        seq_B = []
-                        len_A = 0
-                        len_B = 0
-                        idx+=1
-
-                    if i_a < 0:
-                        seq_a = None
-                        i_a = 0
-                    
-                    if i_b < 0:
-                        seq_b = None
-                        i_b = 0
+        if args.processes > 1:
+            # documents left without a pair at the end of a chunk are discarded, as at the end of the input
+            slots = threading.Semaphore(2 * args.processes)
+            with Pool(args.processes, initializer=init_tokenizer, initargs=(share_tokenizer(args.tokenizer),)) as p:
+                chunks = yield_chunks(tqdm(reader), args.chunk_size, slots)
+                for rows in p.imap(partial(process_chunk, args), chunks):
+                    slots.release()
+                    for row in rows:
+                        writer.writerow([idx] + row)
+                        idx += 1
+        else:
+            init_tokenizer(share_tokenizer(args.tokenizer))
+            # documents are prepared in batches, so that sentences are tokenized together
+            chunks = iter(lambda: list(islice(reader, args.batch_tokenization)), [])
+            documents = (document for chunk in chunks for document in prepare_documents(chunk))
+            for row in build_pairs(args, tqdm(documents)):
+                writer.writerow([idx] + row)
+                idx += 1
 
     print('Done.')